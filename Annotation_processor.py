@@ -14,14 +14,15 @@ def load_config():
         config = json.load(file)
     return config
 
-def run_script(script_name, input_dir, output_jsonl):
-    """Run a script with the given input directory and output JSONL."""
+def run_script(script_name, input_dir, output_jsonl, extra_args=()):
+    """Run a script with the given input directory, output JSONL and extra arguments."""
     try:
         subprocess.run([
-            "python", script_name, "--input_dir", input_dir, "--output_jsonl", output_jsonl
+            "python", script_name, "--input_dir", input_dir, "--output_jsonl", output_jsonl, *extra_args
         ], check=True)
     except subprocess.CalledProcessError as e:
         print(f"Error running {script_name}: {e}")
+        sys.exit(1)
 
 def main():
     # Parse command-line arguments
@@ -39,10 +40,15 @@ def main():
     # Derive the base name from the JSONL file
     base_name = os.path.splitext(os.path.basename(jsonl_path))[0]
 
+    # In neighborhood cell mode, neighbor images were downloaded once per cell (see Image_downloader.py)
+    use_cells = load_config().get("NEIGHBORHOOD_CELLS", {}).get("enabled", False)
+    cells_dir = os.path.join("output", base_name, "cells")
+    cells_file = os.path.join(cells_dir, f"{base_name}_cells.jsonl")
+
     # Define input directories
     street_view_dir = os.path.join("GoogleStreetViewImages", base_name)
     mapbox_house_dir = os.path.join("mapboxhouse", base_name)
-    mapbox_neighbor_dir = os.path.join("mapboxneighbor", base_name)
+    mapbox_neighbor_dir = os.path.join("mapboxneighbor", f"{base_name}_cells" if use_cells else base_name)
 
     # Validate input directories
     for folder in [street_view_dir, mapbox_house_dir, mapbox_neighbor_dir]:
@@ -61,10 +67,23 @@ def main():
 
     # Run the scripts in sequence
     print("Running openai_svi.py...")
-    run_script("utils/openai_svi.py", street_view_dir, svi_output_jsonl)
+    run_script("utils/openai_svi.py", street_view_dir, svi_output_jsonl, ["--base_file", jsonl_path])
 
     print("Running openai_neighbour.py...")
-    run_script("utils/openai_neighbour.py", mapbox_neighbor_dir, neighbor_output_jsonl)
+    if use_cells:
+        # Annotate one image per cell, then share each cell's labels with its buildings
+        cells_output_jsonl = os.path.join(cells_dir, f"{base_name}_cells_neighbor.jsonl")
+        run_script("utils/openai_neighbour.py", mapbox_neighbor_dir, cells_output_jsonl, ["--base_file", cells_file])
+        try:
+            subprocess.run([
+                "python", "utils/neighborhood_cells.py", "--base_file", jsonl_path,
+                "--cell_annotations", cells_output_jsonl, "--output_jsonl", neighbor_output_jsonl
+            ], check=True)
+        except subprocess.CalledProcessError as e:
+            print(f"Error running neighborhood_cells.py: {e}")
+            sys.exit(1)
+    else:
+        run_script("utils/openai_neighbour.py", mapbox_neighbor_dir, neighbor_output_jsonl, ["--base_file", jsonl_path])
 
     print("Running openai_house.py...")
     run_script("utils/openai_house.py", mapbox_house_dir, house_output_jsonl)
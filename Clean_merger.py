@@ -1,8 +1,12 @@
 import os
+import json
 import subprocess
 import sys
 from tqdm import tqdm
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "utils"))
+from clean_engine import is_typed_file
+
 def execute_command(command):
     try:
         print(f"Executing command: {command}")
@@ -11,20 +15,34 @@ def execute_command(command):
         print(f"Command execution failed: {e}")
         sys.exit(1)
 
+def load_config(config_path="config.json"):
+    """Load config.json, or an empty configuration when there is none."""
+    if not os.path.exists(config_path):
+        return {}
+    with open(config_path, 'r') as file:
+        return json.load(file)
+
+def needs_cleaning(base_file, stage):
+    """Return True when a stage's annotation output holds raw model answers, alone or mixed with typed records."""
+    base_name = os.path.splitext(os.path.basename(base_file))[0]
+    output_file = os.path.join("output", base_name, f"{base_name}_{stage}.jsonl")
+    return not is_typed_file(output_file)
+
 def main(base_file):
     # Ensure the base file exists
     if not os.path.exists(base_file):
         print(f"Base file does not exist: {base_file}")
         sys.exit(1)
 
-    # Define the list of commands to execute
-    commands = [
-        f"python utils/clean_house.py \"{base_file}\"",
-        f"python utils/clean_svi.py \"{base_file}\"",
-        f"python utils/clean_neighbor.py \"{base_file}\"",
-        f"python utils/merge.py --base_file \"{base_file}\"",
-        f"python utils/merge_fliter.py --base_file \"{base_file}\""
-    ]
+    # The incremental merge cleans the new records itself, only what was appended since the last merge
+    if load_config().get("MERGE", {}).get("incremental"):
+        commands = [f"python utils/merge.py --base_file \"{base_file}\" --incremental"]
+    else:
+        # Define the list of commands to execute; raw outputs of all stages are cleaned in one process,
+        # typed annotation outputs skip the clean engine
+        stages = [stage for stage in ("house", "svi", "neighbor") if needs_cleaning(base_file, stage)]
+        commands = [f"python utils/clean_engine.py \"{base_file}\" --stages {' '.join(stages)}"] if stages else []
+        commands.append(f"python utils/merge.py --base_file \"{base_file}\"")
 
     # Execute each command in sequence with a progress bar
     for command in tqdm(commands, desc="Executing commands", unit="command"):
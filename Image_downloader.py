@@ -14,14 +14,15 @@ def load_config():
         config = json.load(file)
     return config
 
-def run_mapbox_turbo(jsonl_path, api_key):
-    """Run the Mapbox Turbo script with the given JSONL path and API key."""
+def run_mapbox_turbo(jsonl_path, api_key, extra_args=()):
+    """Run the Mapbox Turbo script with the given JSONL path, API key and extra arguments."""
     try:
         subprocess.run([
-            "python", "utils/mapbox_turbo.py", jsonl_path, api_key
+            "python", "utils/mapbox_turbo.py", jsonl_path, api_key, *extra_args
         ], check=True)
     except subprocess.CalledProcessError as e:
         print(f"Error running mapbox_turbo.py: {e}")
+        sys.exit(1)
 
 def run_google_svi_turbo(jsonl_path, api_key):
     """Run the Google Street View Turbo script with the given JSONL path and API key."""
@@ -31,6 +32,17 @@ def run_google_svi_turbo(jsonl_path, api_key):
         ], check=True)
     except subprocess.CalledProcessError as e:
         print(f"Error running Google_svi_turbo.py: {e}")
+        sys.exit(1)
+
+def write_neighborhood_cells(jsonl_path, cells_file):
+    """Snap the buildings of the JSONL file to neighborhood cells."""
+    try:
+        subprocess.run([
+            "python", "utils/neighborhood_cells.py", "--base_file", jsonl_path, "--cells_file", cells_file
+        ], check=True)
+    except subprocess.CalledProcessError as e:
+        print(f"Error running neighborhood_cells.py: {e}")
+        sys.exit(1)
 
 def main():
     # Parse command-line arguments
@@ -53,8 +65,18 @@ def main():
     print("Running Google SVI Turbo...")
     run_google_svi_turbo(jsonl_path, google_api_key)
 
-    print("Running Mapbox Turbo...")
-    run_mapbox_turbo(jsonl_path, mapbox_api_key)
+    # In neighborhood cell mode, neighbor images are downloaded once per cell instead of once per building
+    if config.get("NEIGHBORHOOD_CELLS", {}).get("enabled"):
+        base_name = os.path.splitext(os.path.basename(jsonl_path))[0]
+        cells_file = os.path.join("output", base_name, "cells", f"{base_name}_cells.jsonl")
+        write_neighborhood_cells(jsonl_path, cells_file)
+
+        print("Running Mapbox Turbo...")
+        run_mapbox_turbo(jsonl_path, mapbox_api_key, ["--house_only"])
+        run_mapbox_turbo(cells_file, mapbox_api_key, ["--neighbor_only"])
+    else:
+        print("Running Mapbox Turbo...")
+        run_mapbox_turbo(jsonl_path, mapbox_api_key)
 
 if __name__ == "__main__":
     main()
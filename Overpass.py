@@ -126,14 +126,16 @@ def fetch_building_data(city_name, country_name, max_elements=100):
             print(f"Response content: {response.text}")
             return building
 
-        # Extract address and height information
+        # Extract address, height and level count information
         if details_data['elements']:
             element = details_data['elements'][0]
             building['addr_street'] = element['tags'].get('addr:street', 'N/A')
             building['height'] = element['tags'].get('height', 'N/A')
+            building['levels'] = element['tags'].get('building:levels', 'N/A')
         else:
             building['addr_street'] = 'N/A'
             building['height'] = 'N/A'
+            building['levels'] = 'N/A'
         return building
 
     # Fetch details for each sampled building in parallel
@@ -153,6 +155,7 @@ def fetch_building_data(city_name, country_name, max_elements=100):
                 'lon': building['lon'],
                 'addr_street': building['addr_street'],
                 'height': building['height'],
+                'levels': building['levels'],
                 'building_type': building_type
             }
             if building_type == 'yes':
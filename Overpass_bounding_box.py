@@ -99,9 +99,11 @@ def fetch_building_data(south, west, north, east, max_elements=100):
                     element = details_data['elements'][0]
                     building['addr_street'] = element['tags'].get('addr:street', 'N/A')
                     building['height'] = element['tags'].get('height', 'N/A')
+                    building['levels'] = element['tags'].get('building:levels', 'N/A')
                 else:
                     building['addr_street'] = 'N/A'
                     building['height'] = 'N/A'
+                    building['levels'] = 'N/A'
                 return building
             except requests.exceptions.RequestException as e:
                 logging.error(f"Error fetching details for building ID {building_id} (Attempt {attempt + 1}): {e}")
@@ -113,6 +115,7 @@ def fetch_building_data(south, west, north, east, max_elements=100):
         logging.error(f"Skipping building ID {building_id} after {retries} retries.")
         building['addr_street'] = 'Error'
         building['height'] = 'Error'
+        building['levels'] = 'Error'
         return building
 
     # Fetch details for each sampled building in parallel
@@ -132,6 +135,7 @@ def fetch_building_data(south, west, north, east, max_elements=100):
                 'lon': building['lon'],
                 'addr_street': building['addr_street'],
                 'height': building['height'],
+                'levels': building['levels'],
                 'building_type': building_type
             }
             if building_type == 'yes':
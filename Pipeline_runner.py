@@ -0,0 +1,299 @@
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "utils"))
+from dataset_store import delta_files, final_dataset_file
+
+class Stage:
+    """
+    One stage of the pipeline.
+
+    Parameters:
+        name (str): Stage name.
+        command (list): Command that runs the stage.
+        deps (list): Stages whose outputs this stage reads.
+        inputs (list): Files and folders the stage reads.
+        outputs (list): Files and folders the stage writes; the stage reruns when one is missing.
+        code (list): Scripts the stage runs, so a code change reruns it.
+        config_sections (list): config.json sections the stage depends on.
+    """
+
+    def __init__(self, name, command, deps, inputs, outputs, code, config_sections=()):
+        self.name = name
+        self.command = command
+        self.deps = deps
+        self.inputs = inputs
+        self.outputs = outputs
+        self.code = code
+        self.config_sections = config_sections
+
+def load_config():
+    config_path = "config.json"
+    if not os.path.exists(config_path):
+        return {}
+    with open(config_path, 'r') as file:
+        return json.load(file)
+
+# Module names of the import statements of a script, including imports inside functions
+IMPORT_PATTERN = re.compile(r"^\s*(?:from|import)\s+(\w+)", re.MULTILINE)
+
+def stage_code(scripts):
+    """Return the scripts a stage runs with every utils module they import, directly or through each other."""
+    code = []
+    pending = list(scripts)
+    while pending:
+        path = pending.pop(0)
+        if path in code or not os.path.exists(path):
+            continue
+        code.append(path)
+        with open(path, 'r', encoding='utf-8') as file:
+            source = file.read()
+        pending.extend(f"utils/{name}.py" for name in IMPORT_PATTERN.findall(source))
+    return sorted(code)
+
+def pipeline_stages(base_file, config):
+    """
+    Returns the stages of the pipeline for a base file, in dependency order, with the path conventions
+    of the stage scripts.
+    """
+    base_name = os.path.splitext(os.path.basename(base_file))[0]
+    output_dir = os.path.join("output", base_name)
+    use_cells = config.get("NEIGHBORHOOD_CELLS", {}).get("enabled", False)
+    image_dirs = [
+        os.path.join("GoogleStreetViewImages", base_name),
+        os.path.join("mapboxhouse", base_name),
+        os.path.join("mapboxneighbor", f"{base_name}_cells" if use_cells else base_name)
+    ]
+    annotations = [os.path.join(output_dir, f"{base_name}_{stage}.jsonl") for stage in ("house", "svi", "neighbor")]
+    final_file = final_dataset_file(base_name)
+    # The incremental merge writes delta files next to the final dataset, which readers apply
+    final_files = [final_file] + delta_files(final_file)
+    map_scripts = sorted(os.path.join("utils", name) for name in os.listdir("utils")
+                         if name.startswith(("result_map_", "resullt_map_")) and name.endswith(".py"))
+    return [
+        Stage("images", ["python", "Image_downloader.py", base_file], [],
+              [base_file], image_dirs,
+              stage_code(["Image_downloader.py", "utils/mapbox_turbo.py", "utils/Google_svi_turbo.py",
+                          "utils/neighborhood_cells.py"]),
+              ["NEIGHBORHOOD_CELLS"]),
+        Stage("annotate", ["python", "Annotation_processor.py", base_file], ["images"],
+              [base_file] + image_dirs, annotations,
+              stage_code(["Annotation_processor.py", "utils/openai_house.py", "utils/openai_svi.py",
+                          "utils/openai_neighbour.py", "utils/neighborhood_cells.py"]),
+              ["REQUEST_CONTROL", "MODEL_PRICING", "IMAGE_PREPROCESS", "FLOOR_COUNT_RULE", "GREEN_INDEX", "POOL_FILTER",
+               "ROAD_METRICS", "FOOTPRINT_METRICS", "NEIGHBORHOOD_CELLS"]),
+        Stage("merge", ["python", "Clean_merger.py", base_file], ["annotate"],
+              [base_file] + annotations, [final_file],
+              stage_code(["Clean_merger.py", "utils/merge.py"]),
+              ["MERGE", "DATASET"]),
+        Stage("maps", ["python", "Maper.py", "--base_file", base_file], ["merge"],
+              final_files, [os.path.join("maps", base_name)],
+              stage_code(["Maper.py"] + map_scripts)),
+        Stage("export", ["python", "Result_export.py", "--base_file", base_file], ["merge"],
+              final_files, [os.path.join("export", base_name)],
+              stage_code(["Result_export.py"]))
+    ]
+
+def state_path(base_file):
+    base_name = os.path.splitext(os.path.basename(base_file))[0]
+    return os.path.join("output", base_name, f"{base_name}_pipeline_state.json")
+
+def load_state(base_file):
+    path = state_path(base_file)
+    if not os.path.exists(path):
+        return {"stages": {}, "hashes": {}}
+    with open(path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+def save_state(base_file, state):
+    path = state_path(base_file)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", 'w', encoding='utf-8') as file:
+        json.dump(state, file, indent=1)
+    os.replace(f"{path}.tmp", path)
+
+def file_digest(path, hashes):
+    """
+    Return the content hash of a file. Hashes are cached by size and modification time, so unchanged
+    files, such as downloaded images, are not read again.
+    """
+    stat = os.stat(path)
+    cached = hashes.get(path)
+    if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+        return cached[2]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    hashes[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+    return digest.hexdigest()
+
+def path_digest(path, hashes):
+    """Return the content hash of a file, or of every file of a folder with its relative path; None when missing."""
+    if os.path.isfile(path):
+        return file_digest(path, hashes)
+    if not os.path.isdir(path):
+        return None
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            digest.update(os.path.relpath(file_path, path).encode("utf-8"))
+            digest.update(file_digest(file_path, hashes).encode("ascii"))
+    return digest.hexdigest()
+
+def stage_fingerprint(stage, config, hashes):
+    """Return the hash of a stage's command, code, config sections and input contents."""
+    parts = {
+        "command": stage.command,
+        "code": {path: path_digest(path, hashes) for path in stage.code},
+        "config": {section: config.get(section) for section in stage.config_sections},
+        "inputs": {path: path_digest(path, hashes) for path in stage.inputs}
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+def up_to_date(stage, fingerprint, state):
+    recorded = state["stages"].get(stage.name, {})
+    return recorded.get("fingerprint") == fingerprint and all(os.path.exists(path) for path in stage.outputs)
+
+def run_stage(stage):
+    """Run a stage's command; returns (exit code, duration in seconds)."""
+    start = time.monotonic()
+    print(f"[{stage.name}] Executing: {' '.join(stage.command)}", flush=True)
+    result = subprocess.run(stage.command)
+    return result.returncode, time.monotonic() - start
+
+def select_stages(stages, targets):
+    """Return the target stages with every stage they depend on, in pipeline order."""
+    if not targets:
+        return stages
+    by_name = {stage.name: stage for stage in stages}
+    needed = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            pending.extend(by_name[name].deps)
+    return [stage for stage in stages if stage.name in needed]
+
+def critical_path(stages, durations):
+    """
+    Returns the chain of dependent stages with the largest total duration.
+
+    Returns:
+        tuple: (stage names along the path, total duration in seconds).
+    """
+    finish = {}
+    previous = {}
+    for stage in stages:
+        deps = [dep for dep in stage.deps if dep in finish]
+        slowest = max(deps, key=lambda dep: finish[dep], default=None)
+        finish[stage.name] = (finish[slowest] if slowest else 0.0) + durations.get(stage.name, 0.0)
+        previous[stage.name] = slowest
+    if not finish:
+        return [], 0.0
+    name = max(finish, key=finish.get)
+    total = finish[name]
+    path = []
+    while name:
+        path.append(name)
+        name = previous[name]
+    return path[::-1], total
+
+def run_pipeline(base_file, targets=None, force=False, dry_run=False, max_workers=2):
+    """
+    Runs the pipeline stages of a base file as a DAG.
+
+    A stage runs once all stages it depends on have finished, so independent stages (maps and export)
+    run in parallel. It is skipped when its fingerprint, the hash of its command, code, config
+    sections and input contents, matches its last successful run and its outputs exist. A stage that
+    reruns changes the contents its dependents read, so they rerun too.
+
+    Returns:
+        bool: Whether every stage succeeded or was up to date.
+    """
+    config = load_config()
+    stages = select_stages(pipeline_stages(base_file, config), targets)
+    state = load_state(base_file)
+    hashes = state.setdefault("hashes", {})
+    done = {}
+    failed = set()
+    pending = list(stages)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for stage in list(pending):
+                if any(dep in failed for dep in stage.deps):
+                    print(f"[{stage.name}] Skipped: an upstream stage failed")
+                    failed.add(stage.name)
+                    pending.remove(stage)
+                elif all(dep in done for dep in stage.deps):
+                    pending.remove(stage)
+                    # Paths such as the newest final dataset are resolved once the upstream stages have run
+                    stage = {s.name: s for s in pipeline_stages(base_file, config)}[stage.name]
+                    fingerprint = stage_fingerprint(stage, config, hashes)
+                    # A dry run does not change the inputs of the stages after one that would run
+                    stale_upstream = dry_run and any(done[dep] == "ran" for dep in stage.deps)
+                    if not force and not stale_upstream and up_to_date(stage, fingerprint, state):
+                        print(f"[{stage.name}] Up to date, skipped", flush=True)
+                        done[stage.name] = "skipped"
+                    elif dry_run:
+                        print(f"[{stage.name}] Would run: {' '.join(stage.command)}")
+                        done[stage.name] = "ran"
+                    else:
+                        running[executor.submit(run_stage, stage)] = (stage, fingerprint)
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, fingerprint = running.pop(future)
+                returncode, duration = future.result()
+                if returncode != 0:
+                    print(f"[{stage.name}] Failed with exit code {returncode} after {duration:.1f}s")
+                    failed.add(stage.name)
+                    continue
+                # The fingerprint of the inputs the stage ran on; inputs changed meanwhile rerun it next time
+                state["stages"][stage.name] = {"fingerprint": fingerprint, "duration": duration,
+                                               "completed": time.strftime("%Y-%m-%d %H:%M:%S")}
+                save_state(base_file, state)
+                done[stage.name] = "ran"
+                print(f"[{stage.name}] Done in {duration:.1f}s")
+
+    if not dry_run:
+        save_state(base_file, state)
+    # Critical path of a full run, from the last measured duration of every stage
+    estimates = {stage.name: state["stages"].get(stage.name, {}).get("duration", 0.0) for stage in stages}
+    path, total = critical_path(stages, estimates)
+    if path:
+        print(f"Critical path: {' -> '.join(f'{name} ({estimates[name]:.1f}s)' for name in path)}, {total:.1f}s")
+    ran = [name for name, status in done.items() if status == "ran"]
+    skipped = [name for name, status in done.items() if status == "skipped"]
+    print(f"{'Would run' if dry_run else 'Ran'}: {', '.join(ran) or 'none'}; up to date: {', '.join(skipped) or 'none'}"
+          + (f"; failed: {', '.join(sorted(failed))}" if failed else ""))
+    return not failed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the pipeline stages of a base file, skipping the ones that are up to date.")
+    parser.add_argument("base_file", type=str, help="Path to the base JSONL file, e.g. Data/NewYork_United States_100.jsonl.")
+    parser.add_argument("--targets", nargs="+", choices=["images", "annotate", "merge", "maps", "export"], default=None,
+                        help="Stages to bring up to date, with the stages they depend on (default: all).")
+    parser.add_argument("--force", action="store_true", help="Run the stages even if they are up to date.")
+    parser.add_argument("--dry_run", action="store_true", help="Print the stages that would run without running them.")
+    parser.add_argument("--max_workers", type=int, default=2, help="Number of stages run in parallel.")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.base_file):
+        print(f"Base file does not exist: {args.base_file}")
+        sys.exit(1)
+    if not run_pipeline(args.base_file, args.targets, args.force, args.dry_run, args.max_workers):
+        sys.exit(1)
@@ -1,13 +1,151 @@
 import pandas as pd
 import geopandas as gpd
-from shapely.geometry import Point
 import os
+import sys
+import time
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 
-def export_results(base_file):
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "utils"))
+from dataset_store import dataset_columns, final_dataset_file, iter_dataset, read_dataset
+
+# Build the point geometries of all buildings at once from the coordinate columns
+def to_geodataframe(data):
+    geometry = gpd.points_from_xy(data['lon'], data['lat'], crs='EPSG:4326')
+    return gpd.GeoDataFrame(data, geometry=geometry)
+
+# The CSV keeps lat and lon as columns; no geometry objects are serialized into it
+def write_csv(data, export_folder, base_name):
+    csv_path = os.path.join(export_folder, f"{base_name}.csv")
+    data.to_csv(csv_path, index=False)
+    return csv_path
+
+def write_geojson(data, export_folder, base_name):
+    geojson_path = os.path.join(export_folder, f"{base_name}.geojson")
+    to_geodataframe(data).to_file(geojson_path, driver='GeoJSON')
+    return geojson_path
+
+def write_shapefile(data, export_folder, base_name):
+    shapefile_folder = os.path.join(export_folder, f"{base_name}_shapefile")
+    os.makedirs(shapefile_folder, exist_ok=True)
+    to_geodataframe(data).to_file(os.path.join(shapefile_folder, f"{base_name}.shp"))
+    return shapefile_folder
+
+# Rows per GeoParquet row group; the unit a bbox read skips or reads
+GEOPARQUET_ROW_GROUP_SIZE = 65536
+
+def write_geoparquet(data, export_folder, base_name):
+    """
+    Writes a GeoParquet file whose row groups each cover a compact area.
+
+    Rows are ordered along a Hilbert curve and every row gets a bbox covering column, so the
+    row-group statistics hold bounding boxes and bbox reads skip the row groups outside them.
+    """
+    geoparquet_path = os.path.join(export_folder, f"{base_name}.parquet")
+    gdf = to_geodataframe(data)
+    order = gdf.geometry.hilbert_distance().argsort(kind='stable')
+    gdf.iloc[order].to_parquet(geoparquet_path, index=False, compression='zstd', write_covering_bbox=True,
+                               row_group_size=GEOPARQUET_ROW_GROUP_SIZE)
+    return geoparquet_path
+
+# FlatGeobuf keeps full column names and a packed Hilbert R-tree for bbox reads
+def write_flatgeobuf(data, export_folder, base_name):
+    flatgeobuf_path = os.path.join(export_folder, f"{base_name}.fgb")
+    to_geodataframe(data).to_file(flatgeobuf_path, driver='FlatGeobuf', SPATIAL_INDEX='YES')
+    return flatgeobuf_path
+
+# Writer of each export format
+EXPORT_WRITERS = {
+    "CSV": write_csv,
+    "GeoJSON": write_geojson,
+    "Shapefile": write_shapefile,
+    "GeoParquet": write_geoparquet,
+    "FlatGeobuf": write_flatgeobuf
+}
+
+# Size of an exported file, or of all files of an exported folder
+def export_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getsize(path)
+
+def write_format(format, dataset_file, export_folder, base_name):
+    """
+    Writes one export format; runs in a worker process, which reads the dataset itself (memory-mapped
+    for Parquet and Arrow) instead of having the whole frame pickled over to it.
+
+    Returns:
+        tuple: (format, exported path, write time in seconds, size in bytes, number of rows).
+    """
+    data = read_dataset(dataset_file)
+    start = time.monotonic()
+    path = EXPORT_WRITERS[format](data, export_folder, base_name)
+    return format, path, time.monotonic() - start, export_size(path), len(data)
+
+# Formats the chunked export appends to batch by batch, with their file extensions
+STREAM_FORMATS = {"CSV": ".csv", "GeoJSONSeq": ".geojsonl"}
+
+# Rows per batch of the chunked export
+CHUNK_ROWS = 100000
+
+def geojson_features(batch):
+    """Return the GeoJSON features of a batch, one line each, assembled column-wise from its properties."""
+    properties = batch.to_json(orient='records', lines=True, force_ascii=False).splitlines()
+    lon = batch['lon']
+    lat = batch['lat']
+    points = ('{"type":"Point","coordinates":[' + lon.astype(str) + ',' + lat.astype(str) + ']}')
+    geometry = points.where(lon.notna() & lat.notna(), 'null')
+    return ('{"type":"Feature","geometry":' + geometry + ',"properties":' + pd.Series(properties, index=batch.index)
+            + '}\n').tolist()
+
+def export_chunked(base_file, formats=None, chunk_rows=CHUNK_ROWS):
+    """
+    Streams the final dataset in batches of chunk_rows rows and appends each batch to a CSV and a
+    newline-delimited GeoJSON (GeoJSONSeq) file, so peak memory depends on the batch size only.
+    """
+    base_name = os.path.splitext(os.path.basename(base_file))[0]
+    actual_file = final_dataset_file(base_name)
+    if not os.path.exists(actual_file):
+        print(f"Expected file {actual_file} does not exist. Please ensure it is generated.")
+        return
+
+    # Only GeoJSONSeq needs coordinates; check the schema before any output file is truncated
+    formats = formats or list(STREAM_FORMATS)
+    if "GeoJSONSeq" in formats and not {'lat', 'lon'}.issubset(dataset_columns(actual_file)):
+        print("The file is missing required columns: 'lat' and 'lon'. Skipping GeoJSONSeq.")
+        formats = [format for format in formats if format != "GeoJSONSeq"]
+        if not formats:
+            return
+
+    export_folder = os.path.join("export", base_name)
+    os.makedirs(export_folder, exist_ok=True)
+    paths = {format: os.path.join(export_folder, f"{base_name}{STREAM_FORMATS[format]}") for format in formats}
+    seconds = dict.fromkeys(formats, 0.0)
+
+    start = time.monotonic()
+    rows = 0
+    files = {format: open(path, 'w', encoding='utf-8', newline='') for format, path in paths.items()}
+    try:
+        for batch in iter_dataset(actual_file, chunk_rows):
+            for format, file in files.items():
+                write_start = time.monotonic()
+                if format == "CSV":
+                    batch.to_csv(file, index=False, header=rows == 0)
+                else:
+                    file.writelines(geojson_features(batch))
+                seconds[format] += time.monotonic() - write_start
+            rows += len(batch)
+    finally:
+        for file in files.values():
+            file.close()
+    for format, path in paths.items():
+        print(f"{format} exported to: {path} ({seconds[format]:.2f}s, {export_size(path) / 1e6:.2f} MB)")
+    print(f"Exported {rows} buildings in batches of {chunk_rows} in {time.monotonic() - start:.2f}s")
+
+def export_results(base_file, formats=None, max_workers=None):
     # Generate the actual file to process based on input file
     base_name = os.path.splitext(os.path.basename(base_file))[0]
-    actual_file = os.path.join("output", base_name, f"{base_name}_final.jsonl")
+    actual_file = final_dataset_file(base_name)
 
     if not os.path.exists(actual_file):
         print(f"Expected file {actual_file} does not exist. Please ensure it is generated.")
@@ -17,37 +155,37 @@ def export_results(base_file):
     export_folder = os.path.join("export", base_name)
     os.makedirs(export_folder, exist_ok=True)
 
-    # Read the JSONL file
-    data = pd.read_json(actual_file, lines=True)
-
-    # Ensure required columns for GeoDataFrame
-    if not {'lat', 'lon'}.issubset(data.columns):
+    # Ensure required columns for GeoDataFrame, from the schema of the final dataset (JSONL, Parquet or Arrow)
+    if not {'lat', 'lon'}.issubset(dataset_columns(actual_file)):
         print("The file is missing required columns: 'lat' and 'lon'. Cannot export GeoJSON or Shapefile.")
         return
 
-    # Create GeoDataFrame
-    data['geometry'] = data.apply(lambda row: Point(row['lon'], row['lat']), axis=1)
-    gdf = gpd.GeoDataFrame(data, geometry='geometry', crs='EPSG:4326')
-
-    # Export to CSV
-    csv_path = os.path.join(export_folder, f"{base_name}.csv")
-    data.to_csv(csv_path, index=False)
-    print(f"CSV exported to: {csv_path}")
-
-    # Export to GeoJSON
-    geojson_path = os.path.join(export_folder, f"{base_name}.geojson")
-    gdf.to_file(geojson_path, driver='GeoJSON')
-    print(f"GeoJSON exported to: {geojson_path}")
-
-    # Export to Shapefile
-    shapefile_folder = os.path.join(export_folder, f"{base_name}_shapefile")
-    os.makedirs(shapefile_folder, exist_ok=True)
-    gdf.to_file(os.path.join(shapefile_folder, f"{base_name}.shp"))
-    print(f"Shapefile exported to: {shapefile_folder}")
+    # Write the requested formats concurrently, one worker process per format
+    formats = formats or list(EXPORT_WRITERS)
+    start = time.monotonic()
+    rows = 0
+    with ProcessPoolExecutor(max_workers=max_workers or len(formats)) as executor:
+        futures = [executor.submit(write_format, format, actual_file, export_folder, base_name) for format in formats]
+        for future in futures:
+            format, path, seconds, size, rows = future.result()
+            print(f"{format} exported to: {path} ({seconds:.2f}s, {size / 1e6:.2f} MB)")
+    print(f"Exported {rows} buildings in {time.monotonic() - start:.2f}s")
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Export processed data to CSV, GeoJSON, and Shapefile.")
+    parser = argparse.ArgumentParser(description="Export processed data to CSV, GeoJSON, Shapefile, GeoParquet and FlatGeobuf.")
     parser.add_argument("--base_file", required=True, help="Path to the input base JSONL file (e.g., Data/base.jsonl).")
+    parser.add_argument("--formats", nargs="+", choices=list(dict.fromkeys([*EXPORT_WRITERS, *STREAM_FORMATS])), default=None,
+                        help="Formats to export (default: all formats of the chosen mode).")
+    parser.add_argument("--max_workers", type=int, default=None, help="Number of worker processes (default: one per format).")
+    parser.add_argument("--chunked", action="store_true", help="Stream the dataset in batches to CSV and GeoJSONSeq with bounded memory.")
+    parser.add_argument("--chunk_rows", type=int, default=CHUNK_ROWS, help="Rows per batch of the chunked export.")
     args = parser.parse_args()
 
-    export_results(args.base_file)
+    modes = STREAM_FORMATS if args.chunked else EXPORT_WRITERS
+    unsupported = [format for format in args.formats or [] if format not in modes]
+    if unsupported:
+        parser.error(f"{', '.join(unsupported)} cannot be exported {'in chunks' if args.chunked else 'without --chunked'}")
+    if args.chunked:
+        export_chunked(args.base_file, args.formats, args.chunk_rows)
+    else:
+        export_results(args.base_file, args.formats, args.max_workers)
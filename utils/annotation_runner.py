@@ -0,0 +1,236 @@
+import os
+import json
+import time
+from threading import Lock
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from image_payload import ImagePayload
+from image_preprocess import Preprocessor, format_savings
+from job_queue import JobQueue
+from result_sink import ResultSink, truncate_torn_tail, read_records_from
+from structured_output import MalformedPrediction, MODEL_SOURCE, parse_prediction, filename_to_id
+
+# Images kept in flight per worker thread
+IN_FLIGHT_FACTOR = 2
+
+# Number of filenames inserted into the queue per transaction
+ENQUEUE_CHUNK = 10000
+
+# Path of the task queue database that belongs to an output JSONL file
+def queue_path_for(output_jsonl):
+    return f"{os.path.splitext(output_jsonl)[0]}_queue.sqlite"
+
+# Lazily enumerate the image files of a directory
+def iter_image_files(input_dir):
+    with os.scandir(input_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith(('.jpg', '.png')) and entry.is_file():
+                yield entry.name
+
+# Group an iterable into lists of at most `size` items
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# Path of the per-call token and latency log of an output JSONL file
+def usage_path_for(output_jsonl):
+    return f"{os.path.splitext(output_jsonl)[0]}_usage.jsonl"
+
+# Stage of an output file named after the repo convention, e.g. '<base>_svi.jsonl' -> 'svi'
+def stage_for(output_jsonl):
+    return os.path.splitext(os.path.basename(output_jsonl))[0].rsplit("_", 1)[-1]
+
+# Path of the file collecting malformed model answers
+def quarantine_path_for(output_jsonl):
+    return f"{os.path.splitext(output_jsonl)[0]}_quarantine.jsonl"
+
+def write_record(filename, results, prediction_tasks, sink, prepared=None):
+    """
+    Hand the typed record of a fully annotated image to the output writer. When the image was sent to
+    the models in this run, its message reports the bytes preprocessing saved on each request.
+    """
+    record = {"id": filename_to_id(filename), "Filename": filename}
+    for task in prediction_tasks:
+        record.update(json.loads(results[task]))
+    message = f"Processed {filename} - " + ", ".join(
+        f"{key}: {value}" for key, value in record.items() if key not in ("id", "Filename")
+    )
+    if prepared is not None:
+        message += f", Saved: {(prepared.original_bytes - prepared.prepared_bytes) / 1024:.1f} KB per request"
+    sink.put(record, message)
+
+def quarantine(filename, task, response, error, output_jsonl, lock):
+    """Keep a malformed answer for inspection; the task itself is re-asked through the queue."""
+    entry = {"Filename": filename, "task": task, "response": response, "error": str(error)}
+    with lock:
+        with open(quarantine_path_for(output_jsonl), 'a') as quarantine_file:
+            quarantine_file.write(json.dumps(entry) + "\n")
+
+def process_image_tasks(filename, input_dir, tasks, prediction_tasks, preprocessor, queue, sink, output_jsonl, lock):
+    """
+    Prepares one image, runs its claimed model tasks and writes its record once every task is done.
+    Tasks answered from local data are completed first, and the image is only read when a model is needed.
+
+    Returns:
+        tuple: (True when the image's record was written, PreparedImage or None).
+    """
+    results = None
+    model_tasks = []
+    for task in tasks:
+        prediction_task = prediction_tasks[task]
+        resolved = prediction_task.resolve(filename) if prediction_task.resolve is not None else None
+        if resolved is None:
+            model_tasks.append(task)
+            continue
+        values, source = resolved
+        if prediction_task.source:
+            values = dict(values, **{prediction_task.source: source})
+        results = queue.complete(filename, task, json.dumps(values)) or results
+
+    prepared = None
+    if model_tasks:
+        try:
+            prepared = preprocessor.prepare(os.path.join(input_dir, filename))
+            payload = ImagePayload(prepared.path)
+        except OSError as e:
+            for task in model_tasks:
+                queue.fail(filename, task, e)
+            print(f"Error reading {filename}: {e}")
+            return False, None
+
+        results = run_model_tasks(filename, model_tasks, prediction_tasks, payload, queue, output_jsonl, lock) or results
+
+    if results is None:
+        return False, prepared
+    write_record(filename, results, prediction_tasks, sink, prepared)
+    return True, prepared
+
+def run_model_tasks(filename, tasks, prediction_tasks, payload, queue, output_jsonl, lock):
+    """
+    Asks the models of the given tasks about one image and completes the tasks with valid answers.
+
+    Returns:
+        dict: Results of every task of the image once all are done, otherwise None.
+    """
+    results = None
+    # Share one encoded payload across all model calls of the image
+    with payload:
+        for task in tasks:
+            try:
+                response = prediction_tasks[task].predict(payload, filename)
+            except Exception as e:
+                queue.fail(filename, task, e)
+                print(f"Error processing {filename} ({task}): {e}")
+                continue
+            # Validate the answer now; a malformed one only re-asks this model
+            try:
+                values = parse_prediction(response, prediction_tasks[task].fields)
+            except MalformedPrediction as e:
+                quarantine(filename, task, response, e, output_jsonl, lock)
+                queue.fail(filename, task, f"Malformed response: {e}")
+                print(f"Malformed response for {filename} ({task}): {e}")
+                continue
+            if prediction_tasks[task].source:
+                values[prediction_tasks[task].source] = MODEL_SOURCE
+            results = queue.complete(filename, task, json.dumps(values)) or results
+    return results
+
+def run_annotation(input_dir, output_jsonl, prediction_tasks, preprocess_settings, client, max_workers=None, retry_failed=False):
+    """
+    Annotates every image of a directory through a durable task queue.
+
+    Parameters:
+        input_dir (str): Directory containing input images.
+        output_jsonl (str): Path of the output JSONL file.
+        prediction_tasks (dict): Task name -> PredictionTask with the model call and the fields parsed from its answer.
+        preprocess_settings (PreprocessSettings): Image preprocessing settings of the stage.
+        client (ChatClient): Client used by the prediction functions, reported on at the end of the run.
+        max_workers (int): Number of worker threads (defaults to the client's highest concurrency limit).
+        retry_failed (bool): Give tasks that exhausted their attempts in a previous run a fresh budget.
+    """
+    task_names = list(prediction_tasks)
+
+    queue = JobQueue(queue_path_for(output_jsonl))
+    # Drop a line torn by a crash, then record the lines written after the last confirmed batch.
+    # For an output file written before the queue existed, this imports the whole file once.
+    if truncate_torn_tail(output_jsonl):
+        print(f"Removed a partial last line from {output_jsonl}.")
+    written_files = (record["Filename"] for record in read_records_from(output_jsonl, queue.output_offset()))
+    for chunk in chunked(written_files, ENQUEUE_CHUNK):
+        queue.mark_written(chunk, task_names)
+    if os.path.exists(output_jsonl):
+        queue.set_written([], os.path.getsize(output_jsonl))
+    # Stream the directory listing into the queue without holding it in memory
+    for chunk in chunked(iter_image_files(input_dir), ENQUEUE_CHUNK):
+        queue.enqueue(chunk, task_names)
+
+    recovered = queue.recover()
+    if recovered:
+        print(f"Recovered {recovered} tasks left in flight by a previous run.")
+    if retry_failed:
+        print(f"Retrying {queue.reset_failed()} failed tasks.")
+
+    # Calls are throttled by the client's adaptive concurrency limit, so size the pool for its ceiling
+    if max_workers is None:
+        max_workers = client.limiter.max_limit
+    window = max_workers * IN_FLIGHT_FACTOR
+    original_bytes = prepared_bytes = 0
+    images_written = 0
+    client.usage.open_log(usage_path_for(output_jsonl), stage_for(output_jsonl))
+    lock = Lock()
+    progress = tqdm(total=queue.count_unwritten(), desc="Processing Images")
+    in_flight = set()
+    # The sink is closed last, after every worker has handed over its record
+    with ResultSink(output_jsonl, on_written=queue.set_written) as sink, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor, \
+            Preprocessor(preprocess_settings) as preprocessor:
+        # Records whose tasks all finished before a crash but were never written
+        for filename, results in queue.unwritten_results():
+            write_record(filename, results, prediction_tasks, sink)
+            progress.update(1)
+            images_written += 1
+
+        while True:
+            # Keep a bounded window of images in flight, refilled as they complete
+            if len(in_flight) < window:
+                for filename, tasks in queue.claim_images(window - len(in_flight)):
+                    in_flight.add(executor.submit(process_image_tasks, filename, input_dir, tasks, prediction_tasks,
+                                                  preprocessor, queue, sink, output_jsonl, lock))
+            if not in_flight:
+                delay = queue.next_retry_delay()
+                if delay is None:
+                    break
+                # Wait for the next task whose retry backoff expires
+                time.sleep(min(delay, 5.0))
+                continue
+
+            done, in_flight = wait(in_flight, timeout=1.0, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    written, prepared = future.result()
+                except Exception as e:
+                    print(f"Error processing file: {e}")
+                    continue
+                if prepared is not None:
+                    original_bytes += prepared.original_bytes
+                    prepared_bytes += prepared.prepared_bytes
+                if written:
+                    progress.update(1)
+                    images_written += 1
+    progress.close()
+    client.usage.close()
+
+    counts = queue.counts()
+    queue.close()
+    print(format_savings(original_bytes, prepared_bytes))
+    print(client.report())
+    print(client.usage.report(images_written))
+    print("Task states: " + ", ".join(f"{state}: {count}" for state, count in sorted(counts.items())))
+    if counts.get("failed"):
+        print(f"{counts['failed']} tasks failed permanently; rerun with --retry_failed to try them again.")
@@ -0,0 +1,104 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import importlib
+from chat_client import ChatClient
+from job_queue import JobQueue
+from annotation_runner import run_annotation, queue_path_for
+from mock_openai_server import MockChatServer, add_mock_arguments, settings_from_args
+
+# Annotation module of each stage
+STAGE_MODULES = {"svi": "openai_svi", "house": "openai_house", "neighbor": "openai_neighbour"}
+
+def percentile(samples, percentile):
+    samples = sorted(samples)
+    if not samples:
+        return float("nan")
+    return samples[min(len(samples) - 1, int(len(samples) * percentile / 100))]
+
+def benchmark_stage(stage, input_dir, server, request_control, pricing=None, max_workers=None, retry_failed=False):
+    """
+    Runs one annotation stage against the mock server in a scratch directory.
+
+    Parameters:
+        stage (str): 'svi', 'house' or 'neighbor'.
+        input_dir (str): Directory containing input images.
+        server (MockChatServer): Running mock server.
+        request_control (dict): REQUEST_CONTROL settings of the benchmarked client.
+        pricing (dict): MODEL_PRICING settings, for the usage report.
+        max_workers (int): Number of worker threads passed to the runner.
+        retry_failed (bool): Retry tasks that failed permanently in the first pass.
+
+    Returns:
+        dict: Images per second, call latency percentiles, retries and task states.
+    """
+    module = importlib.import_module(STAGE_MODULES[stage])
+    # Swap the stage's client for one pointed at the mock server; the prediction functions look it up at call time
+    settings = dict(request_control, api_base=server.api_base, window=10 ** 6)
+    client = ChatClient(["mock-key"], pricing=pricing, **settings)
+    module.client = client
+
+    scratch_dir = tempfile.mkdtemp(prefix=f"benchmark_{stage}_")
+    output_jsonl = os.path.join(scratch_dir, f"benchmark_{stage}.jsonl")
+    try:
+        start = time.monotonic()
+        run_annotation(input_dir, output_jsonl, module.PREDICTION_TASKS, module.preprocess_settings, client,
+                       max_workers=max_workers, retry_failed=retry_failed)
+        elapsed = time.monotonic() - start
+
+        with open(output_jsonl, 'r') as file:
+            images = sum(1 for line in file if line.strip())
+        queue = JobQueue(queue_path_for(output_jsonl))
+        retries = queue.retries()
+        counts = queue.counts()
+        queue.close()
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    latencies = [latency for stats in client.stats.values() for latency in stats.recent]
+    return {
+        "stage": stage,
+        "images": images,
+        "seconds": round(elapsed, 2),
+        "images_per_second": round(images / elapsed, 3) if elapsed else None,
+        "calls": sum(stats.calls for stats in client.stats.values()),
+        "p50_latency": round(percentile(latencies, 50), 3),
+        "p99_latency": round(percentile(latencies, 99), 3),
+        "retries": retries,
+        "hedged": sum(stats.hedged for stats in client.stats.values()),
+        "final_concurrency": client.limiter.limit,
+        "task_states": counts
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark an annotation stage against a local mock of the OpenAI API.")
+    parser.add_argument("--stage", choices=sorted(STAGE_MODULES), required=True, help="Annotation stage to run.")
+    parser.add_argument("--input_dir", required=True, help="Directory containing input images.")
+    parser.add_argument("--max_workers", type=int, default=None, help="Number of worker threads.")
+    parser.add_argument("--deadline", type=float, default=None, help="Override REQUEST_CONTROL.deadline.")
+    parser.add_argument("--no_hedge", action="store_true", help="Disable request hedging.")
+    parser.add_argument("--results_jsonl", default=None, help="Append the benchmark result to this JSONL file.")
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    with open("config.json", "r") as file:
+        config = json.load(file)
+    request_control = config.get("REQUEST_CONTROL", {})
+    if args.deadline is not None:
+        request_control["deadline"] = args.deadline
+    if args.no_hedge:
+        request_control["hedge"] = False
+
+    with MockChatServer(settings_from_args(args)) as server:
+        result = benchmark_stage(args.stage, args.input_dir, server, request_control, config.get("MODEL_PRICING"),
+                                 args.max_workers)
+        print(server.report())
+
+    result["mock"] = vars(settings_from_args(args))
+    print(json.dumps(result, indent=4))
+    if args.results_jsonl:
+        with open(args.results_jsonl, 'a') as file:
+            file.write(json.dumps(result) + "\n")
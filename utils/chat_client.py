@@ -0,0 +1,212 @@
+import json
+import time
+import bisect
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import openai
+from concurrency import AdaptiveLimiter, OK, RATE_LIMITED, SERVER_ERROR, TIMEOUT, ERROR
+from usage_accounting import UsageLedger
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = [0.5, 1, 2, 4, 8, 16, 32, 64, float("inf")]
+
+# Classify a call's exception into a concurrency outcome
+def classify_outcome(error):
+    if error is None:
+        return OK
+    status = getattr(error, "http_status", None)
+    if status == 429:
+        return RATE_LIMITED
+    if status is not None and status >= 500:
+        return SERVER_ERROR
+    if isinstance(error, (openai.error.Timeout, openai.error.APIConnectionError, TimeoutError)):
+        return TIMEOUT
+    return ERROR
+
+class ModelStats:
+    """Latency samples, histogram and hedge counters of one model."""
+
+    def __init__(self, window):
+        self.recent = deque(maxlen=window)
+        self.histogram = [0] * len(LATENCY_BUCKETS)
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.timeouts = 0
+
+    def record_latency(self, latency):
+        self.recent.append(latency)
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+
+    def percentile(self, percentile):
+        samples = sorted(self.recent)
+        index = min(len(samples) - 1, int(len(samples) * percentile / 100))
+        return samples[index]
+
+class ChatClient:
+    """
+    Thread-safe wrapper around openai.ChatCompletion.create.
+
+    Every call gets a deadline. When hedging is enabled, a call that is still running after
+    the model's `hedge_percentile` latency is duplicated on the next API key, and the first
+    answer wins. Hedges are capped at `max_hedge_fraction` of all calls. The number of calls
+    in flight, hedges included, is bounded by an AIMD AdaptiveLimiter.
+
+    Parameters:
+        api_keys (list): OpenAI API keys used in a round-robin fashion.
+        deadline (float): Seconds before a call is abandoned with a TimeoutError.
+        hedge (bool): Whether slow calls are hedged.
+        hedge_percentile (float): Latency percentile after which a hedge is sent.
+        max_hedge_fraction (float): Upper bound of hedged calls over all calls.
+        min_samples (int): Latency samples a model needs before it is hedged.
+        window (int): Number of recent latencies kept per model.
+        concurrency (dict): Keyword arguments of the AdaptiveLimiter.
+        api_base (str): Alternative API endpoint, e.g. the local mock server used for benchmarks.
+        pricing (dict): Model prefix -> USD per 1M prompt and completion tokens, for the usage ledger.
+    """
+
+    def __init__(self, api_keys, deadline=60.0, hedge=False, hedge_percentile=95, max_hedge_fraction=0.05,
+                 min_samples=20, window=500, concurrency=None, api_base=None, pricing=None):
+        self.api_keys = api_keys
+        self.deadline = deadline
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.max_hedge_fraction = max_hedge_fraction
+        self.min_samples = min_samples
+        self.window = window
+        self.api_base = api_base
+        self.key_index = 0
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.limiter = AdaptiveLimiter(**(concurrency or {}))
+        self.usage = UsageLedger(pricing)
+        self.executor = ThreadPoolExecutor(max_workers=self.limiter.max_limit)
+
+    def next_api_key(self):
+        """Return the next API key in a round-robin fashion."""
+        with self.lock:
+            api_key = self.api_keys[self.key_index]
+            self.key_index = (self.key_index + 1) % len(self.api_keys)
+        return api_key
+
+    def model_stats(self, model):
+        with self.lock:
+            if model not in self.stats:
+                self.stats[model] = ModelStats(self.window)
+            return self.stats[model]
+
+    def hedge_delay(self, stats):
+        """Return seconds to wait before hedging a call, or None when it must not be hedged."""
+        with self.lock:
+            if not self.hedge or len(stats.recent) < self.min_samples:
+                return None
+            total_calls = sum(s.calls for s in self.stats.values())
+            total_hedged = sum(s.hedged for s in self.stats.values())
+            if total_hedged + 1 > self.max_hedge_fraction * total_calls:
+                return None
+            return stats.percentile(self.hedge_percentile)
+
+    def _send(self, api_key, **kwargs):
+        if self.api_base:
+            kwargs["api_base"] = self.api_base
+        return openai.ChatCompletion.create(api_key=api_key, request_timeout=self.deadline, **kwargs)
+
+    def _submit(self, stats, model, hedge=False, **kwargs):
+        """
+        Send one request on the next key. When it finishes, its limiter slot is released with its
+        outcome and the call is recorded in the usage ledger.
+        """
+        api_key = self.next_api_key()
+        sent_at = time.monotonic()
+        future = self.executor.submit(self._send, api_key, model=model, **kwargs)
+
+        def release(done_future):
+            latency = time.monotonic() - sent_at
+            with self.lock:
+                median_latency = stats.percentile(50) if len(stats.recent) >= self.min_samples else None
+            error = done_future.exception()
+            outcome = classify_outcome(error)
+            self.limiter.release(outcome, latency, median_latency)
+            usage = done_future.result().get("usage") if error is None else None
+            self.usage.record(model, api_key, outcome, latency, usage, hedge)
+
+        future.add_done_callback(release)
+        return future
+
+    def create(self, model, **kwargs):
+        """
+        Sends a chat completion request with a deadline and optional hedging.
+
+        Returns:
+            The response of the first request that succeeded.
+
+        Raises:
+            TimeoutError: If no request answered before the deadline.
+        """
+        stats = self.model_stats(model)
+        with self.lock:
+            stats.calls += 1
+        # The deadline starts once the call holds a slot under the concurrency limit
+        self.limiter.acquire()
+        start = time.monotonic()
+        futures = {self._submit(stats, model, **kwargs): "primary"}
+
+        delay = self.hedge_delay(stats)
+        if delay is not None and delay < self.deadline:
+            done, _ = wait(futures, timeout=delay)
+            # Hedges only use spare capacity and never wait for a slot
+            if not done and self.limiter.try_acquire():
+                with self.lock:
+                    stats.hedged += 1
+                futures[self._submit(stats, model, hedge=True, **kwargs)] = "hedge"
+
+        error = None
+        pending = set(futures)
+        while pending:
+            remaining = self.deadline - (time.monotonic() - start)
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                # The slower duplicate, if any, runs to completion in the background
+                with self.lock:
+                    stats.record_latency(time.monotonic() - start)
+                    if futures[future] == "hedge":
+                        stats.hedge_wins += 1
+                return future.result()
+
+        if error is not None and not pending:
+            raise error
+        with self.lock:
+            stats.timeouts += 1
+        raise TimeoutError(f"No answer from {model} within {self.deadline}s")
+
+    def report(self):
+        """Return the concurrency state and a per-model summary of call counts, hedge rate and latency histogram."""
+        lines = [self.limiter.report()]
+        with self.lock:
+            for model, stats in sorted(self.stats.items()):
+                hedge_rate = stats.hedged / stats.calls if stats.calls else 0.0
+                lines.append(f"{model}: {stats.calls} calls, {stats.hedged} hedged ({hedge_rate:.1%}), "
+                             f"{stats.hedge_wins} hedge wins, {stats.timeouts} timeouts")
+                if stats.recent:
+                    lines.append(f"  p50 {stats.percentile(50):.2f}s, p95 {stats.percentile(95):.2f}s, "
+                                 f"p99 {stats.percentile(99):.2f}s")
+                buckets = []
+                lower = 0
+                for upper, count in zip(LATENCY_BUCKETS, stats.histogram):
+                    label = f">{lower}s" if upper == float("inf") else f"{lower}-{upper}s"
+                    buckets.append(f"{label}: {count}")
+                    lower = upper
+                lines.append("  latency " + ", ".join(buckets))
+        return "\n".join(lines)
+
+# Build the chat client from the API keys, REQUEST_CONTROL and MODEL_PRICING settings in config.json
+def load_chat_client(config_path="config.json"):
+    with open(config_path, "r") as file:
+        config = json.load(file)
+    return ChatClient(config["OPENAI_API_KEYS"], pricing=config.get("MODEL_PRICING"), **config.get("REQUEST_CONTROL", {}))
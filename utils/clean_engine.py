@@ -0,0 +1,182 @@
+import os
+import re
+import json
+import time
+import argparse
+import pandas as pd
+
+# Stages in the order Clean_merger.py cleans them
+STAGES = ("house", "svi", "neighbor")
+
+# Fields of each stage: output column -> (raw column, answer key, lowest class, highest class).
+# Keys and ranges mirror the *_FIELDS of openai_house.py, openai_svi.py and openai_neighbour.py.
+CLEAN_FIELDS = {
+    "house": {
+        "Swimming_Pool_Prediction": ("Swimming_Pool_Prediction", "Type", 0, 1),
+        "Roof_Type_Prediction": ("Roof_Type_Prediction", "Type_Class", 0, 2),
+        "Green_Prediction": ("Green_Prediction", "Vegetation_Cover_Class", 0, 3)
+    },
+    "svi": {
+        "WWR_Prediction": ("WWR_Prediction", "WWR_Class", 0, 3),
+        "Property_Type_Prediction": ("Property_Type_Prediction", "Type_Class", 0, 6),
+        "Floor_Count_Prediction": ("Floor_Count_Prediction", "FloorCount", 1, 200)
+    },
+    "neighbor": {
+        "BD": ("Building_Footprint_Prediction", "BD", 0, 2),
+        "LB": ("Building_Footprint_Prediction", "LB", 0, 3),
+        "BDP": ("Building_Footprint_Prediction", "BDP", 0, 2),
+        "Land_Use_Prediction": ("Land_Use_Prediction", "Type_Class", 0, 9),
+        "RCR": ("Road_Prediction", "RCR", 0, 3),
+        "FD": ("Road_Prediction", "FD", 0, 3)
+    }
+}
+
+# Building id: the first run of digits of the image filename, as in structured_output.filename_to_id
+ID_PATTERN = re.compile(r"(\d+)")
+
+# Start of a typed record written by the annotation runner, e.g. '{"id": 123, ...'; other lines are decoded
+TYPED_PREFIX = re.compile(r'\{"id":\s*-?\d+\s*[,}]')
+
+def is_typed(record):
+    """Return whether a record was written by the structured annotators, i.e. carries an integer id."""
+    building_id = record.get("id")
+    return isinstance(building_id, int) and not isinstance(building_id, bool)
+
+def is_typed_file(file_path):
+    """
+    Return whether every record of an annotation output is typed. Typed records are only ever appended,
+    by a resumed run, after an older raw-text output, never before one, so a file is typed throughout
+    exactly when its first record is. Only that record is read.
+    """
+    if not os.path.exists(file_path):
+        return False
+    with open(file_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                return bool(TYPED_PREFIX.match(line)) or is_typed(json.loads(line))
+    return False
+
+def typed_rows(frame):
+    """Return the mask of the rows of a raw frame that are typed records."""
+    if "id" not in frame:
+        return pd.Series(False, index=frame.index)
+    ids = frame["id"]
+    if pd.api.types.is_bool_dtype(ids):
+        return pd.Series(False, index=frame.index)
+    if pd.api.types.is_numeric_dtype(ids):
+        # Typed and raw-text rows mixed in one file make id a float column, NaN on the raw-text rows
+        return ids.notna()
+    return ids.map(lambda value: isinstance(value, int) and not isinstance(value, bool)).astype(bool)
+
+def answer_pattern(key):
+    """Return the compiled pattern of a 'Key: <integer>' answer; 'BD' does not match 'BDP: 1'."""
+    return re.compile(rf"\b{re.escape(key)}\s*:\s*(-?\d+)")
+
+def stage_paths(base_file, stage):
+    """Return the raw, cleaned and unparsed file paths of a stage's annotation output."""
+    base_name = os.path.splitext(os.path.basename(base_file))[0]
+    prefix = os.path.join("output", base_name, f"{base_name}_{stage}")
+    return f"{prefix}.jsonl", f"{prefix}_cleaned.jsonl", f"{prefix}_unparsed.jsonl"
+
+def read_records(file_path):
+    """Load a JSONL file into a DataFrame of its raw values, decoding all lines in one call."""
+    with open(file_path, 'r', encoding='utf-8') as file:
+        lines = [line for line in file.read().split("\n") if line.strip()]
+    return pd.DataFrame.from_records(json.loads("[" + ",".join(lines) + "]"))
+
+def extract_ids(frame):
+    """Extract the building ids of a raw frame as nullable int64."""
+    if "Filename" in frame:
+        source = frame["Filename"]
+    else:
+        source = frame.get("id", pd.Series(pd.NA, index=frame.index))
+    digits = source.astype("string").str.extract(ID_PATTERN, expand=False)
+    return pd.to_numeric(digits, errors="coerce").astype("Int64")
+
+def clean_frame(frame, stage):
+    """
+    Extracts the typed fields of a stage's annotation output.
+
+    Each row is handled on its own, since a resumed run appends typed records to an older raw-text
+    output. Typed records written by the structured annotators only have their fields cast; legacy
+    text answers are matched column-wise with compiled patterns. Values outside a field's class range
+    count as unparseable.
+
+    Returns:
+        tuple: (cleaned frame with an int64 id and Int64 fields, frame of the rows that could not be fully parsed).
+    """
+    fields = CLEAN_FIELDS[stage]
+    typed = typed_rows(frame)
+    any_typed = bool(typed.any())
+    ids = extract_ids(frame)
+    if any_typed:
+        typed_ids = pd.to_numeric(frame["id"].where(typed), errors="coerce").astype("Int64")
+        ids = typed_ids.where(typed, ids)
+    cleaned = pd.DataFrame({"id": ids})
+    for column, (raw_column, key, lowest, highest) in fields.items():
+        if raw_column in frame:
+            values = pd.to_numeric(frame[raw_column].astype("string").str.extract(answer_pattern(key), expand=False),
+                                   errors="coerce").astype("Float64")
+        else:
+            values = pd.Series(pd.NA, index=frame.index, dtype="Float64")
+        if any_typed:
+            typed_values = pd.to_numeric(frame.get(column, pd.Series(pd.NA, index=frame.index)).where(typed),
+                                         errors="coerce").astype("Float64")
+            values = typed_values.where(typed, values)
+        cleaned[column] = values.where((values >= lowest) & (values <= highest)).astype("Int64")
+    if any_typed:
+        # Provenance columns of locally answered fields are kept as they are
+        raw_columns = {raw_column for raw_column, _, _, _ in fields.values()}
+        extra = [column for column in frame.columns
+                 if column not in cleaned and column != "Filename" and column not in raw_columns]
+        cleaned = pd.concat([cleaned, frame[extra].where(typed, None)], axis=1)
+
+    unparsed = cleaned["id"].isna()
+    for column in fields:
+        unparsed |= cleaned[column].isna()
+    rejects = frame[unparsed.to_numpy()]
+    cleaned = cleaned[cleaned["id"].notna()].astype({"id": "int64"})
+    return cleaned, rejects
+
+def report_unparsed(cleaned, rejects, stage, total):
+    """Print the number of unparseable values of every field of a stage."""
+    missing = {column: int(cleaned[column].isna().sum()) for column in CLEAN_FIELDS[stage]}
+    dropped = total - len(cleaned)
+    summary = ", ".join(f"{column}: {count}" for column, count in missing.items() if count)
+    print(f"[{stage}] {len(rejects)} of {total} rows not fully parsed"
+          + (f" ({dropped} without an id)" if dropped else "") + (f"; missing {summary}" if summary else ""))
+
+def clean_stage(base_file, stage):
+    """
+    Cleans one stage's annotation output into its _cleaned file; unparseable rows go to its _unparsed file.
+
+    Returns:
+        tuple: (rows read, rows written, rows not fully parsed).
+    """
+    raw_file, cleaned_file, unparsed_file = stage_paths(base_file, stage)
+    frame = read_records(raw_file)
+    cleaned, rejects = clean_frame(frame, stage)
+    report_unparsed(cleaned, rejects, stage, len(frame))
+    cleaned.to_json(cleaned_file, orient="records", lines=True)
+    if len(rejects):
+        rejects.to_json(unparsed_file, orient="records", lines=True, force_ascii=False)
+    elif os.path.exists(unparsed_file):
+        os.remove(unparsed_file)
+    return len(frame), len(cleaned), len(rejects)
+
+def clean_outputs(base_file, stages=STAGES):
+    """Clean the annotation outputs of the given stages in this process."""
+    for stage in stages:
+        start = time.monotonic()
+        read, written, unparsed = clean_stage(base_file, stage)
+        elapsed = time.monotonic() - start
+        rate = read / elapsed * 60 if elapsed else 0.0
+        print(f"[{stage}] cleaned {written} records in {elapsed:.2f}s ({rate:,.0f} records/min)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Clean the _house, _svi and _neighbor annotation outputs in one process.")
+    parser.add_argument("input_base_path", type=str, help="Path to the base JSONL file, e.g. Data/NewYork_United States_100.jsonl.")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES), help="Stages to clean.")
+    args = parser.parse_args()
+
+    clean_outputs(args.input_base_path, args.stages)
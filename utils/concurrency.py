@@ -0,0 +1,106 @@
+import time
+import threading
+from collections import deque
+
+# Outcomes of a finished call, as classified by the chat client
+OK = "ok"
+RATE_LIMITED = "rate_limited"
+SERVER_ERROR = "server_error"
+TIMEOUT = "timeout"
+ERROR = "error"
+
+# Outcomes that signal congestion and cut the concurrency limit
+CONGESTION = (RATE_LIMITED, SERVER_ERROR, TIMEOUT)
+
+class AdaptiveLimiter:
+    """
+    AIMD limit on the number of concurrent model calls.
+
+    The limit grows by one after `limit` consecutive healthy calls (additive increase) and is
+    multiplied by `backoff_ratio` on a 429, a 5xx or a timeout (multiplicative decrease). A
+    call is healthy when it succeeded within `latency_tolerance` times the model's median
+    latency. After a cut, further congestion signals are ignored for `cooldown` seconds so
+    the calls already in flight do not cut the limit again.
+
+    Parameters:
+        initial (int): Starting limit.
+        min_limit (int): Lowest limit.
+        max_limit (int): Highest limit.
+        backoff_ratio (float): Factor applied to the limit on congestion.
+        latency_tolerance (float): Latency, relative to the model's median, still counted as healthy.
+        cooldown (float): Seconds after a cut during which congestion is not acted on again.
+    """
+
+    def __init__(self, initial=8, min_limit=1, max_limit=64, backoff_ratio=0.5, latency_tolerance=2.0, cooldown=5.0):
+        self.limit = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_ratio = backoff_ratio
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self.in_use = 0
+        self.healthy_streak = 0
+        self.last_cut = 0.0
+        self.outcomes = {}
+        self.adjustments = deque(maxlen=20)
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Block until a call slot is free under the current limit."""
+        with self.condition:
+            while self.in_use >= self.limit:
+                self.condition.wait()
+            self.in_use += 1
+
+    def try_acquire(self):
+        """Take a call slot if one is free right now."""
+        with self.condition:
+            if self.in_use >= self.limit:
+                return False
+            self.in_use += 1
+            return True
+
+    def release(self, outcome, latency=None, median_latency=None):
+        """
+        Frees a call slot and adjusts the limit from the call's outcome.
+
+        Parameters:
+            outcome (str): One of OK, RATE_LIMITED, SERVER_ERROR, TIMEOUT or ERROR.
+            latency (float): Duration of the call in seconds.
+            median_latency (float): Recent median latency of the model, if known.
+        """
+        with self.condition:
+            self.in_use -= 1
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+            now = time.monotonic()
+            if outcome in CONGESTION:
+                self.healthy_streak = 0
+                if now - self.last_cut >= self.cooldown:
+                    self.last_cut = now
+                    self._adjust(max(self.min_limit, int(self.limit * self.backoff_ratio)), outcome)
+            elif outcome == OK:
+                slow = median_latency is not None and latency > self.latency_tolerance * median_latency
+                if slow:
+                    self.healthy_streak = 0
+                else:
+                    self.healthy_streak += 1
+                    if self.healthy_streak >= self.limit and self.limit < self.max_limit:
+                        self.healthy_streak = 0
+                        self._adjust(self.limit + 1, "healthy")
+            self.condition.notify_all()
+
+    def _adjust(self, new_limit, reason):
+        if new_limit == self.limit:
+            return
+        message = f"Concurrency {self.limit} -> {new_limit} ({reason})"
+        self.adjustments.append(message)
+        self.limit = new_limit
+        print(message)
+
+    def report(self):
+        """Return the current limit, call outcomes and most recent adjustments."""
+        with self.condition:
+            outcomes = ", ".join(f"{outcome}: {count}" for outcome, count in sorted(self.outcomes.items()))
+            lines = [f"Concurrency limit {self.limit} (min {self.min_limit}, max {self.max_limit}); outcomes {outcomes}"]
+            lines.extend(f"  {message}" for message in self.adjustments)
+        return "\n".join(lines)
@@ -0,0 +1,461 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from clean_engine import CLEAN_FIELDS
+
+# Storage formats of the final dataset; Arrow IPC files are uncompressed so they can be memory-mapped
+DATASET_FORMATS = ("jsonl", "parquet", "arrow")
+
+# File extension of each format
+DATASET_EXTENSIONS = {"jsonl": ".jsonl", "parquet": ".parquet", "arrow": ".arrow"}
+
+# Columns stored as int64
+INT64_COLUMNS = ("id", "Neighborhood_Cell")
+
+# Columns stored as float64; float32 would round coordinates to about a metre, which exports would carry
+FLOAT64_COLUMNS = ("lat", "lon")
+
+# Prediction columns, stored in the smallest integer type that holds their classes
+PREDICTION_TYPES = {
+    column: "int8" if highest <= 127 else "int16"
+    for fields in CLEAN_FIELDS.values() for column, (_, _, _, highest) in fields.items()
+}
+
+# Rows per Parquet row group; a streaming read holds about one row group in memory
+PARQUET_ROW_GROUP_SIZE = 131072
+
+# Delta files of a final dataset file are named <stem>_delta_<sequence><extension> and applied on read in sequence order
+DELTA_INFIX = "_delta_"
+
+# Low-cardinality text columns stored as categoricals (dictionary encoded); so are all *_Source columns
+CATEGORY_COLUMNS = ("building_type",)
+
+class DatasetSettings:
+    """
+    Settings of the final dataset storage.
+
+    Parameters:
+        format (str): 'jsonl', 'parquet' or 'arrow'.
+        keep_jsonl (bool): Whether _final.jsonl is also written next to a columnar file.
+        chunk_rows (int): Rows converted at a time when a columnar file is built from JSONL.
+    """
+
+    def __init__(self, format="parquet", keep_jsonl=True, chunk_rows=1000000):
+        if format not in DATASET_FORMATS:
+            raise ValueError(f"Unsupported dataset format: {format}")
+        self.format = format
+        self.keep_jsonl = keep_jsonl
+        self.chunk_rows = chunk_rows
+
+# Load the dataset settings from config.json
+def load_dataset_settings(config_path="config.json"):
+    if not os.path.exists(config_path):
+        return DatasetSettings()
+    with open(config_path, "r") as file:
+        config = json.load(file)
+    return DatasetSettings(**config.get("DATASET", {}))
+
+def final_stem(base_name):
+    """Return the path of the final dataset of a city without its extension."""
+    return os.path.join("output", base_name, f"{base_name}_final")
+
+def final_dataset_file(base_name):
+    """
+    Returns the most recently written final dataset of a city in any format, so readers never pick a
+    stale copy; the JSONL path is returned when none exists.
+    """
+    stem = final_stem(base_name)
+    existing = [stem + extension for extension in DATASET_EXTENSIONS.values() if os.path.exists(stem + extension)]
+    if not existing:
+        return stem + DATASET_EXTENSIONS["jsonl"]
+    return max(existing, key=os.path.getmtime)
+
+def is_category(column):
+    return column in CATEGORY_COLUMNS or column.endswith("_Source")
+
+def compact_frame(frame, categories=None):
+    """
+    Casts a merged frame to the compact storage schema.
+
+    Ids are int64, coordinates float64, prediction codes nullable int8 (int16 for floor counts),
+    provenance and building type columns categorical. Every other column is stored as text.
+
+    Parameters:
+        categories (dict): Column -> fixed category list, so that chunks share one dictionary.
+    """
+    compact = pd.DataFrame(index=frame.index)
+    for column in frame.columns:
+        values = frame[column]
+        if column in INT64_COLUMNS:
+            compact[column] = pd.to_numeric(values, errors="coerce").astype("Int64")
+        elif column in FLOAT64_COLUMNS:
+            compact[column] = pd.to_numeric(values, errors="coerce").astype("float64")
+        elif column in PREDICTION_TYPES:
+            compact[column] = pd.to_numeric(values, errors="coerce").astype(PREDICTION_TYPES[column].capitalize())
+        elif is_category(column):
+            text = values.where(values.isna(), values.astype(str))
+            known = None if categories is None else categories.get(column)
+            compact[column] = pd.Categorical(text, categories=known)
+        else:
+            compact[column] = values.where(values.isna(), values.astype(str)).astype(object)
+    return compact
+
+def arrow_schema(columns):
+    """Return the Arrow schema of the compact storage schema for the given columns."""
+    import pyarrow as pa
+    fields = []
+    for column in columns:
+        if column in INT64_COLUMNS:
+            arrow_type = pa.int64()
+        elif column in FLOAT64_COLUMNS:
+            arrow_type = pa.float64()
+        elif column in PREDICTION_TYPES:
+            arrow_type = pa.int8() if PREDICTION_TYPES[column] == "int8" else pa.int16()
+        elif is_category(column):
+            arrow_type = pa.dictionary(pa.int32(), pa.string())
+        else:
+            arrow_type = pa.string()
+        fields.append(pa.field(column, arrow_type))
+    return pa.schema(fields)
+
+def _write_table(table, path, format):
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+    if format == "parquet":
+        pq.write_table(table, path, compression="zstd", row_group_size=PARQUET_ROW_GROUP_SIZE)
+    else:
+        with ipc.new_file(path, table.schema) as writer:
+            writer.write_table(table)
+
+def write_dataset(frame, stem, format):
+    """Write a merged frame in a columnar format, atomically, and return the file path."""
+    import pyarrow as pa
+    path = stem + DATASET_EXTENSIONS[format]
+    temp_path = f"{path}.tmp"
+    table = pa.Table.from_pandas(compact_frame(frame), schema=arrow_schema(frame.columns), preserve_index=False)
+    _write_table(table, temp_path, format)
+    os.replace(temp_path, path)
+    return path
+
+def _read_chunks(jsonl_path, chunk_rows):
+    with open(jsonl_path, 'r', encoding='utf-8') as file:
+        lines = []
+        for line in file:
+            if line.strip():
+                lines.append(line)
+            if len(lines) == chunk_rows:
+                yield pd.DataFrame.from_records(json.loads("[" + ",".join(lines) + "]"))
+                lines = []
+        if lines:
+            yield pd.DataFrame.from_records(json.loads("[" + ",".join(lines) + "]"))
+
+def convert_jsonl(jsonl_path, stem, format, chunk_rows=1000000):
+    """
+    Builds a columnar file from a final JSONL file chunk by chunk, with bounded memory.
+
+    A first pass collects the columns and the values of the categorical columns, so every chunk is
+    written with the same schema and dictionaries.
+    """
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+    columns = {}
+    categories = {}
+    with open(jsonl_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            columns.update(dict.fromkeys(record))
+            for column, value in record.items():
+                if value is not None and is_category(column):
+                    categories.setdefault(column, set()).add(str(value))
+    columns = list(columns)
+    categories = {column: sorted(categories.get(column, ())) for column in columns if is_category(column)}
+
+    path = stem + DATASET_EXTENSIONS[format]
+    temp_path = f"{path}.tmp"
+    schema = arrow_schema(columns)
+    if format == "parquet":
+        writer = pq.ParquetWriter(temp_path, schema, compression="zstd")
+    else:
+        writer = ipc.new_file(temp_path, schema)
+    with writer:
+        for chunk in _read_chunks(jsonl_path, chunk_rows):
+            compact = compact_frame(chunk.reindex(columns=columns), categories)
+            table = pa.Table.from_pandas(compact, schema=schema, preserve_index=False)
+            if format == "parquet":
+                writer.write_table(table, row_group_size=PARQUET_ROW_GROUP_SIZE)
+            else:
+                writer.write_table(table)
+    os.replace(temp_path, path)
+    return path
+
+# Arrow types read back as pandas nullable types, so prediction codes stay small integers
+def _pandas_type(arrow_type):
+    import pyarrow as pa
+    return {pa.int8(): pd.Int8Dtype(), pa.int16(): pd.Int16Dtype(), pa.int64(): pd.Int64Dtype()}.get(arrow_type)
+
+def _read_file(path, columns=None):
+    """Read one dataset file in any format, without its delta files."""
+    if path.endswith(DATASET_EXTENSIONS["jsonl"]):
+        data = pd.read_json(path, lines=True)
+        return data if columns is None else data[[column for column in columns if column in data.columns]]
+
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+    if path.endswith(DATASET_EXTENSIONS["parquet"]):
+        names = pq.read_schema(path).names
+        selected = None if columns is None else [column for column in columns if column in names]
+        table = pq.read_table(path, columns=selected, memory_map=True)
+    else:
+        with pa.memory_map(path) as source:
+            table = ipc.open_file(source).read_all()
+        if columns is not None:
+            table = table.select([column for column in columns if column in table.column_names])
+    return table.to_pandas(types_mapper=_pandas_type)
+
+def _file_columns(path):
+    """Return the column names of one dataset file from its schema, or the keys of the first record of a JSONL file."""
+    if path.endswith(DATASET_EXTENSIONS["jsonl"]):
+        with open(path, 'r', encoding='utf-8') as file:
+            for line in file:
+                if line.strip():
+                    return list(json.loads(line))
+        return []
+
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+    if path.endswith(DATASET_EXTENSIONS["parquet"]):
+        return pq.read_schema(path).names
+    with pa.memory_map(path) as source:
+        return ipc.open_file(source).schema.names
+
+def dataset_columns(path):
+    """
+    Returns the columns of a final dataset without reading its rows: those of the file's schema,
+    followed by any that only its delta files have. Every line of a final JSONL file has every column.
+    """
+    columns = _file_columns(path)
+    for delta_path in delta_files(path):
+        columns += [column for column in _file_columns(delta_path) if column not in columns]
+    return columns
+
+def delta_files(path):
+    """Return the delta files of a final dataset file, oldest first."""
+    stem, extension = os.path.splitext(path)
+    folder = os.path.dirname(path)
+    prefix = os.path.basename(stem) + DELTA_INFIX
+    if not os.path.isdir(folder or "."):
+        return []
+    names = sorted(name for name in os.listdir(folder or ".") if name.startswith(prefix) and name.endswith(extension)
+                   and name[len(prefix):-len(extension)].isdigit())
+    return [os.path.join(folder, name) for name in names]
+
+def clear_deltas(stem):
+    """Remove the delta files of every format of a final dataset, once it has been written in full."""
+    for extension in DATASET_EXTENSIONS.values():
+        for path in delta_files(stem + extension):
+            os.remove(path)
+
+def write_delta(rows, columns, path):
+    """
+    Writes rows as the next delta file of a final dataset file, atomically.
+
+    A delta row upserts the building with its id: its values replace the stored ones, and a missing
+    value leaves the stored one unchanged. Rows of new ids are appended.
+
+    Parameters:
+        rows (list): Rows as dicts with an 'id'.
+        columns (list): Columns of the final dataset.
+        path (str): The final dataset file.
+
+    Returns:
+        str: Path of the delta file.
+    """
+    stem, extension = os.path.splitext(path)
+    existing = delta_files(path)
+    sequence = int(existing[-1][len(stem) + len(DELTA_INFIX):-len(extension)]) + 1 if existing else 1
+    delta_stem = f"{stem}{DELTA_INFIX}{sequence:05d}"
+    if extension != DATASET_EXTENSIONS["jsonl"]:
+        format = next(name for name, ext in DATASET_EXTENSIONS.items() if ext == extension)
+        return write_dataset(pd.DataFrame.from_records(rows, columns=columns), delta_stem, format)
+    delta_path = delta_stem + extension
+    with open(f"{delta_path}.tmp", 'w', encoding='utf-8') as file:
+        file.writelines(json.dumps(row, separators=(",", ":")) + "\n" for row in rows)
+    os.replace(f"{delta_path}.tmp", delta_path)
+    return delta_path
+
+def _shared_categories(left, right):
+    """Give two categorical columns the union of their categories, so values of one can be set in the other."""
+    if isinstance(left.dtype, pd.CategoricalDtype) and isinstance(right.dtype, pd.CategoricalDtype):
+        categories = left.cat.categories.union(right.cat.categories)
+        return left.cat.set_categories(categories), right.cat.set_categories(categories)
+    return left, right
+
+def apply_delta(frame, delta, insert=True):
+    """
+    Upserts the rows of a delta into a frame by id. Only the columns a delta row sets are replaced;
+    with insert, the delta rows of ids missing from the frame are appended.
+    """
+    positions = pd.Index(delta['id']).get_indexer(frame['id'])
+    hit = positions >= 0
+    if hit.any():
+        matched = delta.iloc[np.where(hit, positions, 0)].set_axis(frame.index)
+        for column in delta.columns:
+            if column == 'id' or column not in frame.columns:
+                continue
+            use = hit & matched[column].notna().to_numpy()
+            if use.any():
+                current, values = _shared_categories(frame[column], matched[column])
+                frame[column] = current.where(~use, values)
+    if not insert:
+        return frame
+    new = delta[~delta['id'].isin(frame['id'])].reindex(columns=frame.columns)
+    if not len(new):
+        return frame
+    for column in frame.columns:
+        frame[column], new[column] = _shared_categories(frame[column], new[column])
+    return pd.concat([frame, new], ignore_index=True)
+
+def _read_deltas(path, columns):
+    """Read the delta files of a final dataset file folded into one frame, or None when there are none."""
+    folded = None
+    for delta_path in delta_files(path):
+        delta = _read_file(delta_path, columns).drop_duplicates('id', keep='last')
+        folded = delta if folded is None else apply_delta(folded, delta)
+    return folded
+
+def read_dataset(path, columns=None):
+    """
+    Reads a final dataset in any format.
+
+    Columnar files only read the requested columns, memory-mapped. Requested columns missing from the
+    dataset are skipped, so callers can check for them as with JSONL. Delta files written by the
+    incremental merge are applied.
+
+    Parameters:
+        path (str): .jsonl, .parquet or .arrow file.
+        columns (list): Columns to read; all of them when None.
+
+    Returns:
+        pandas.DataFrame: The dataset.
+    """
+    # Deltas are matched by id, which is read even when not requested
+    selected = columns if columns is None or 'id' in columns else ['id'] + list(columns)
+    deltas = _read_deltas(path, selected)
+    if deltas is None:
+        return _read_file(path, columns)
+    data = apply_delta(_read_file(path, selected), deltas)
+    return data if selected is columns else data.drop(columns='id')
+
+def _iter_file(path, batch_rows=100000, columns=None):
+    """Read one dataset file in any format as frames of at most batch_rows rows, without its delta files."""
+    if path.endswith(DATASET_EXTENSIONS["jsonl"]):
+        for chunk in _read_chunks(path, batch_rows):
+            yield chunk if columns is None else chunk[[column for column in columns if column in chunk.columns]]
+        return
+
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+    if path.endswith(DATASET_EXTENSIONS["parquet"]):
+        parquet_file = pq.ParquetFile(path, memory_map=True)
+        selected = None if columns is None else [column for column in columns if column in parquet_file.schema_arrow.names]
+        for batch in parquet_file.iter_batches(batch_size=batch_rows, columns=selected):
+            yield batch.to_pandas(types_mapper=_pandas_type)
+        return
+
+    with pa.memory_map(path) as source:
+        reader = ipc.open_file(source)
+        selected = None if columns is None else [column for column in columns if column in reader.schema.names]
+        for k in range(reader.num_record_batches):
+            batch = reader.get_batch(k)
+            if selected is not None:
+                batch = batch.select(selected)
+            for offset in range(0, batch.num_rows, batch_rows):
+                yield batch.slice(offset, batch_rows).to_pandas(types_mapper=_pandas_type)
+
+def iter_dataset(path, batch_rows=100000, columns=None):
+    """
+    Reads a final dataset in any format as a sequence of frames of at most batch_rows rows, so
+    memory does not grow with the dataset. Delta files written by the incremental merge are applied
+    to each frame; their rows of new buildings come last.
+
+    Parameters:
+        path (str): .jsonl, .parquet or .arrow file.
+        batch_rows (int): Rows per frame.
+        columns (list): Columns to read; all of them when None.
+
+    Yields:
+        pandas.DataFrame: The next batch of rows.
+    """
+    selected = columns if columns is None or 'id' in columns else ['id'] + list(columns)
+    deltas = _read_deltas(path, selected)
+    if deltas is None:
+        yield from _iter_file(path, batch_rows, columns)
+        return
+    seen = np.zeros(len(deltas), dtype=bool)
+    for batch in _iter_file(path, batch_rows, selected):
+        seen |= deltas['id'].isin(batch['id']).to_numpy()
+        batch = apply_delta(batch, deltas, insert=False)
+        yield batch if selected is columns else batch.drop(columns='id')
+    inserted = deltas[~seen]
+    for offset in range(0, len(inserted), batch_rows):
+        batch = inserted.iloc[offset:offset + batch_rows].reset_index(drop=True)
+        yield batch if selected is columns else batch.drop(columns='id')
+
+def line_id(line):
+    """Return the id of a final JSONL line, which starts with it, without decoding the whole line."""
+    prefix = '{"id":'
+    end = line.find(',', len(prefix))
+    if line.startswith(prefix) and end != -1:
+        try:
+            return int(line[len(prefix):end])
+        except ValueError:
+            pass
+    return json.loads(line).get('id')
+
+def compact_dataset(path):
+    """
+    Folds the delta files of a final dataset file into it and removes them.
+
+    A JSONL file is rewritten line by line, copying the lines of buildings without a delta verbatim;
+    a columnar file is read with its deltas and written again.
+    """
+    deltas = delta_files(path)
+    if not deltas:
+        return path
+    stem, extension = os.path.splitext(path)
+    if extension == DATASET_EXTENSIONS["jsonl"]:
+        updates = {}
+        for delta_path in deltas:
+            with open(delta_path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    if line.strip():
+                        row = json.loads(line)
+                        if row['id'] in updates:
+                            updates[row['id']].update((key, value) for key, value in row.items() if value is not None)
+                        else:
+                            updates[row['id']] = row
+        with open(path, 'r', encoding='utf-8') as infile, open(f"{path}.tmp", 'w', encoding='utf-8') as outfile:
+            for line in infile:
+                if not line.strip():
+                    continue
+                building_id = line_id(line)
+                if building_id in updates:
+                    record = json.loads(line)
+                    record.update((key, value) for key, value in updates.pop(building_id).items() if value is not None)
+                    line = json.dumps(record, separators=(",", ":")) + "\n"
+                outfile.write(line)
+            outfile.writelines(json.dumps(row, separators=(",", ":")) + "\n" for row in updates.values())
+        os.replace(f"{path}.tmp", path)
+    else:
+        format = next(name for name, ext in DATASET_EXTENSIONS.items() if ext == extension)
+        write_dataset(read_dataset(path), stem, format)
+    for delta_path in deltas:
+        os.remove(delta_path)
+    return path
@@ -0,0 +1,109 @@
+import re
+import json
+import os
+
+# Provenance of a floor count taken from OSM tags instead of the model
+SOURCE_LEVELS = "osm_levels"
+SOURCE_HEIGHT = "osm_height"
+SOURCE_MODEL = "model"
+
+# Metres per unit of the height suffixes found in OSM data
+HEIGHT_UNITS = {"": 1.0, "m": 1.0, "meter": 1.0, "meters": 1.0, "metre": 1.0, "metres": 1.0,
+                "ft": 0.3048, "feet": 0.3048, "'": 0.3048}
+
+def parse_height(value):
+    """Return an OSM height tag such as '9.3', '9.3 m' or '30 ft' in metres, or None when absent or unreadable."""
+    if not isinstance(value, (str, int, float)) or isinstance(value, bool):
+        return None
+    match = re.fullmatch(r"\s*(\d+(?:[.,]\d+)?)\s*([a-z']*)\s*", str(value).lower())
+    if match is None or match.group(2) not in HEIGHT_UNITS:
+        return None
+    return float(match.group(1).replace(",", ".")) * HEIGHT_UNITS[match.group(2)]
+
+def parse_levels(value):
+    """Return an OSM building:levels tag as a whole number of floors, or None when absent or unreadable."""
+    if not isinstance(value, (str, int, float)) or isinstance(value, bool):
+        return None
+    match = re.fullmatch(r"\s*(\d+)(?:\.0+)?\s*", str(value))
+    if match is None or int(match.group(1)) < 1:
+        return None
+    return int(match.group(1))
+
+class FloorCountRule:
+    """
+    Derives the floor count of a building from its OSM tags, so the floor count model is only asked
+    when the tags do not answer it.
+
+    Parameters:
+        tags (dict): Building id -> (height tag, building:levels tag), as read from the base data file.
+        enabled (bool): Whether OSM tags are used at all.
+        sources (list): Trusted tags in order of preference, among 'levels' and 'height'.
+        metres_per_floor (float): Storey height used to convert a height into floors.
+        max_rounding (float): Largest distance, in floors, between height / metres_per_floor and the
+            nearest whole number for the height to be trusted; ambiguous heights are left to the model.
+        min_height (float): Heights below this are treated as mapping errors.
+        max_height (float): Heights above this are treated as mapping errors.
+        max_floors (int): Highest floor count accepted from the tags.
+    """
+
+    def __init__(self, tags, enabled=True, sources=("levels", "height"), metres_per_floor=3.0, max_rounding=0.35,
+                 min_height=2.0, max_height=500.0, max_floors=200):
+        self.tags = tags
+        self.enabled = enabled
+        self.sources = list(sources)
+        self.metres_per_floor = metres_per_floor
+        self.max_rounding = max_rounding
+        self.min_height = min_height
+        self.max_height = max_height
+        self.max_floors = max_floors
+
+    def floors_from_height(self, height):
+        if height is None or not self.min_height <= height <= self.max_height:
+            return None
+        floors = height / self.metres_per_floor
+        if abs(floors - round(floors)) > self.max_rounding:
+            return None
+        return max(1, int(round(floors)))
+
+    def resolve(self, building_id):
+        """
+        Returns:
+            tuple: (floor count, provenance) from the OSM tags, or None when the model has to be asked.
+        """
+        if not self.enabled or building_id not in self.tags:
+            return None
+        height, levels = self.tags[building_id]
+        for source in self.sources:
+            if source == "levels":
+                floors, provenance = parse_levels(levels), SOURCE_LEVELS
+            elif source == "height":
+                floors, provenance = self.floors_from_height(parse_height(height)), SOURCE_HEIGHT
+            else:
+                raise ValueError(f"Unknown floor count source: {source}")
+            if floors is not None and floors <= self.max_floors:
+                return floors, provenance
+        return None
+
+# Read the height and building:levels tags of every building in a base data file
+def load_osm_tags(base_file):
+    tags = {}
+    with open(base_file, 'r', encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                building = json.loads(line)
+                tags[int(building["id"])] = (building.get("height"), building.get("levels"))
+    return tags
+
+def load_floor_count_rule(base_file, config_path="config.json"):
+    """
+    Builds the floor count rule from FLOOR_COUNT_RULE in config.json and the OSM tags of the base data file.
+
+    Returns:
+        FloorCountRule: A disabled rule when the base data file does not exist.
+    """
+    with open(config_path, 'r') as file:
+        settings = json.load(file).get("FLOOR_COUNT_RULE", {})
+    if base_file is None or not os.path.exists(base_file):
+        print(f"Base data file not found ({base_file}); every floor count is asked from the model.")
+        return FloorCountRule({}, enabled=False)
+    return FloorCountRule(load_osm_tags(base_file), **settings)
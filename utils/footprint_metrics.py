@@ -0,0 +1,332 @@
+import os
+import json
+import math
+import time
+import bisect
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from osm_tiles import METRES_PER_DEGREE, OSM_CACHE_DIR, group_by_tile, load_tile_ways, read_buildings
+from spatial_index import GridIndex
+from structured_output import MalformedPrediction, filename_to_id, parse_prediction
+from road_metrics import matching_bounds
+
+# Provenance of building footprint classes computed from OSM building polygons
+FOOTPRINT_METRICS_SOURCE = "osm_footprints"
+
+# Result of the last calibration against model labels, required to enable the metrics
+CALIBRATION_FILE = os.path.join("cache", "footprint_metrics_calibration.json")
+
+class FootprintMetricsSettings:
+    """
+    Settings of the local building footprint metrics.
+
+    In the `window_meters` window centred on each building, the same extent as the Mapbox neighbor
+    image, footprints are counted by their centroid:
+    - BD is the footprint area over the window area: 0 (0-10%), 1 (10-25%), 2 (25%-100%).
+    - LB is the number of footprints of at least `large_area` square metres: 0 (0), 1 (1-5), 2 (5-20), 3 (20+).
+    - BDP is read from the Clark-Evans ratio of the mean nearest-neighbour distance between footprint
+      centroids to its expected value under complete spatial randomness: 0 (clustered), 1 (random), 2 (uniform).
+
+    The metrics can only be enabled once the calibration mode of this script has measured, for the
+    current settings, an agreement of all three classes with existing model labels of at least `min_agreement`.
+
+    Parameters:
+        enabled (bool): Whether the footprint model is replaced by the local metrics.
+        window_meters (float): Side of the neighborhood window.
+        tile_size (float): Side in degrees of the tiles footprints are fetched and cached by.
+        bd_bounds (list): Coverage ratios separating the BD classes.
+        large_area (float): Footprint area in square metres from which a building is large.
+        lb_bounds (list): Smallest large-building counts of LB classes 1 to 3.
+        bdp_bounds (list): Clark-Evans ratios separating clustered, random and uniform patterns.
+        min_buildings (int): Windows with fewer footprints are left to the model, as OSM may not map them.
+        index_cell (float): Cell side in metres of the spatial index.
+        min_agreement (float): Calibrated agreement with the model labels the three classes must reach.
+        max_workers (int): Processes computing tiles (defaults to the CPU count).
+    """
+
+    def __init__(self, enabled=False, window_meters=500, tile_size=0.05, bd_bounds=(0.10, 0.25), large_area=1000,
+                 lb_bounds=(1, 6, 21), bdp_bounds=(0.8, 1.2), min_buildings=5, index_cell=100, min_agreement=0.8,
+                 max_workers=None):
+        self.enabled = enabled
+        self.window_meters = window_meters
+        self.tile_size = tile_size
+        self.bd_bounds = list(bd_bounds)
+        self.large_area = large_area
+        self.lb_bounds = list(lb_bounds)
+        self.bdp_bounds = list(bdp_bounds)
+        self.min_buildings = min_buildings
+        self.index_cell = index_cell
+        self.min_agreement = min_agreement
+        self.max_workers = max_workers
+
+    def metric_parameters(self):
+        """Return the settings a calibration is valid for."""
+        return {"window_meters": self.window_meters, "bd_bounds": self.bd_bounds, "large_area": self.large_area,
+                "lb_bounds": self.lb_bounds, "bdp_bounds": self.bdp_bounds, "min_buildings": self.min_buildings}
+
+    def check_calibration(self, calibration_file=CALIBRATION_FILE):
+        """Raise ValueError unless enabled metrics were calibrated to agree enough with the model."""
+        if not self.enabled:
+            return
+        hint = "run `python utils/footprint_metrics.py --calibrate --base_file ... --labels_jsonl ...` to calibrate them"
+        if not os.path.exists(calibration_file):
+            raise ValueError(f"FOOTPRINT_METRICS can only be enabled after a calibration against model labels; {hint}")
+        with open(calibration_file, "r") as file:
+            calibration = json.load(file)
+        if calibration.get("parameters") != self.metric_parameters():
+            raise ValueError(f"The footprint metrics calibration was made with other settings; {hint}")
+        for name, agreement in calibration["agreement"].items():
+            if agreement < self.min_agreement:
+                raise ValueError(f"Footprint {name} classes agree with the model labels on {agreement:.1%} of the "
+                                 f"buildings, below min_agreement {self.min_agreement:.0%}; keep FOOTPRINT_METRICS "
+                                 f"disabled or use the suggested bounds")
+
+# Load the footprint metrics settings from config.json
+def load_footprint_metrics_settings(config_path="config.json"):
+    with open(config_path, "r") as file:
+        config = json.load(file)
+    settings = FootprintMetricsSettings(**config.get("FOOTPRINT_METRICS", {}))
+    settings.check_calibration()
+    return settings
+
+def footprint_geometry(ways, origin):
+    """
+    Computes the area and centroid of every building polygon at once.
+
+    The rings of all ways are concatenated and the shoelace sums are reduced per ring, in a local
+    equirectangular projection in metres from `origin` (lat, lon).
+
+    Returns:
+        tuple: (xs, ys, areas) arrays of centroid coordinates and areas in square metres.
+    """
+    rings = [way["coords"] for way in ways if len(way["coords"]) >= 3]
+    if not rings:
+        return np.empty(0), np.empty(0), np.empty(0)
+    lengths = np.array([len(ring) for ring in rings])
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    points = np.concatenate([np.asarray(ring, dtype=np.float64) for ring in rings])
+    ys = (points[:, 0] - origin[0]) * METRES_PER_DEGREE
+    xs = (points[:, 1] - origin[1]) * METRES_PER_DEGREE * math.cos(math.radians(origin[0]))
+
+    # Pair every vertex with the next vertex of its own ring, wrapping at the end of each ring
+    following = np.arange(1, len(points) + 1)
+    following[starts + lengths - 1] = starts
+    cross = xs * ys[following] - xs[following] * ys
+    signed_area = np.add.reduceat(cross, starts) / 2.0
+    centroid_x = np.add.reduceat((xs + xs[following]) * cross, starts)
+    centroid_y = np.add.reduceat((ys + ys[following]) * cross, starts)
+    # Degenerate rings fall back to the mean of their vertices
+    degenerate = np.abs(signed_area) < 1e-9
+    safe_area = np.where(degenerate, 1.0, signed_area)
+    mean_x = np.add.reduceat(xs, starts) / lengths
+    mean_y = np.add.reduceat(ys, starts) / lengths
+    centroid_x = np.where(degenerate, mean_x, centroid_x / (6.0 * safe_area))
+    centroid_y = np.where(degenerate, mean_y, centroid_y / (6.0 * safe_area))
+    return centroid_x, centroid_y, np.abs(signed_area)
+
+def window_nearest(xs, ys, settings):
+    """
+    Returns the distance from every footprint of a window to its nearest other footprint of the same
+    window, so the Clark-Evans ratio compares distances and density of one area.
+    """
+    distances = GridIndex(xs, ys, settings.index_cell).nearest_distances(settings.window_meters / 2.0)
+    # The few footprints with no neighbour nearby are compared with every footprint of the window
+    far = np.flatnonzero(~np.isfinite(distances))
+    if len(far):
+        squared = (xs[far, None] - xs[None, :]) ** 2 + (ys[far, None] - ys[None, :]) ** 2
+        squared[np.arange(len(far)), far] = np.inf
+        distances[far] = np.sqrt(squared.min(axis=1))
+    return distances
+
+def window_metrics(x, y, index, areas, settings):
+    """
+    Computes the footprint statistics of the window centred on a building.
+
+    Returns:
+        tuple: (coverage ratio, large building count, Clark-Evans ratio, footprint count).
+    """
+    half_window = settings.window_meters / 2.0
+    inside = index.query_box(x - half_window, y - half_window, x + half_window, y + half_window)
+    window_area = float(settings.window_meters) ** 2
+    count = len(inside)
+    coverage = float(areas[inside].sum()) / window_area
+    large = int(np.count_nonzero(areas[inside] >= settings.large_area))
+    if count < 2:
+        return coverage, large, None, count
+    distances = window_nearest(index.xs[inside], index.ys[inside], settings)
+    expected = 0.5 / math.sqrt(count / window_area)
+    return coverage, large, float(distances.mean()) / expected, count
+
+def _tile_metrics(buildings, ways, settings):
+    origin = (min(building["lat"] for building in buildings), min(building["lon"] for building in buildings))
+    xs, ys, areas = footprint_geometry(ways, origin)
+    index = GridIndex(xs, ys, settings.index_cell)
+    metres_per_lon = METRES_PER_DEGREE * math.cos(math.radians(origin[0]))
+    results = []
+    for building in buildings:
+        x = (building["lon"] - origin[1]) * metres_per_lon
+        y = (building["lat"] - origin[0]) * METRES_PER_DEGREE
+        results.append((building["id"],) + window_metrics(x, y, index, areas, settings))
+    return results
+
+def compute_footprint_metrics(buildings, settings, cache_dir=OSM_CACHE_DIR):
+    """
+    Computes footprint metrics for buildings, fetching the building polygons of each tile once.
+
+    Parameters:
+        buildings (list): Buildings as {"id", "lat", "lon"}.
+        settings (FootprintMetricsSettings): Metric settings.
+
+    Returns:
+        dict: Building id -> (coverage ratio, large building count, Clark-Evans ratio, footprint count);
+        buildings of tiles whose footprints could not be fetched are missing.
+    """
+    metrics = {}
+    start = time.monotonic()
+    with ProcessPoolExecutor(max_workers=settings.max_workers) as executor:
+        futures = []
+        for tile, tile_buildings in group_by_tile(buildings, settings.tile_size).items():
+            ways = load_tile_ways("buildings", '"building"', tile, settings.tile_size, settings.window_meters, cache_dir)
+            if ways is None:
+                print(f"No building footprints for tile {tile}; its {len(tile_buildings)} buildings are left to the model.")
+                continue
+            futures.append(executor.submit(_tile_metrics, tile_buildings, ways, settings))
+        for future in futures:
+            for building_id, *values in future.result():
+                metrics[building_id] = tuple(values)
+    print(f"Computed footprint metrics of {len(metrics)} buildings in {time.monotonic() - start:.1f}s")
+    return metrics
+
+def footprint_classes(coverage, large, clark_evans, count, settings):
+    """
+    Returns:
+        dict: BD, LB and BDP classes, or None when the window has too few footprints to be trusted.
+    """
+    if count < settings.min_buildings or clark_evans is None:
+        return None
+    return {"BD": bisect.bisect_right(settings.bd_bounds, coverage),
+            "LB": bisect.bisect_right(settings.lb_bounds, large),
+            "BDP": bisect.bisect_right(settings.bdp_bounds, clark_evans)}
+
+class FootprintMetrics:
+    """
+    BD, LB and BDP classes of the buildings of a base data file, computed from OSM footprints.
+
+    Parameters:
+        settings (FootprintMetricsSettings): Metric settings.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.metrics = {}
+
+    def compute(self, base_file):
+        """Compute the metrics of every building of the base data file, when enabled."""
+        if not self.settings.enabled:
+            return
+        if base_file is None or not os.path.exists(base_file):
+            print(f"Base data file not found ({base_file}); footprint classes are asked from the model.")
+            return
+        self.metrics = compute_footprint_metrics(read_buildings(base_file), self.settings)
+
+    def resolve(self, building_id):
+        """
+        Returns:
+            dict: BD, LB and BDP classes, or None when the model has to be asked.
+        """
+        if building_id not in self.metrics:
+            return None
+        return footprint_classes(*self.metrics[building_id], self.settings)
+
+# Read BD, LB and BDP labels from a neighbor annotation file, typed or in the legacy text format
+def load_footprint_labels(labels_jsonl):
+    fields = {"BD": ("BD", 0, 2), "LB": ("LB", 0, 3), "BDP": ("BDP", 0, 2)}
+    labels = {}
+    with open(labels_jsonl, 'r', encoding='utf-8') as file:
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            # Only model answers are ground truth; classes from an earlier local run are left out
+            if record.get("Building_Footprint_Source", "model") != "model":
+                continue
+            try:
+                building_id = filename_to_id(record["Filename"])
+                if all(isinstance(record.get(name), int) for name in fields):
+                    labels[building_id] = {name: record[name] for name in fields}
+                else:
+                    labels[building_id] = parse_prediction(record.get("Building_Footprint_Prediction"), fields)
+            except (MalformedPrediction, KeyError, ValueError):
+                continue
+    return labels
+
+def calibrate(base_file, labels_jsonl, settings, calibration_file=CALIBRATION_FILE):
+    """
+    Compares the BD, LB and BDP classes of the local metrics with existing model labels, for the
+    windows with at least `min_buildings` footprints, suggests the bounds giving each the label class
+    shares, and records the agreement so the metrics can be enabled.
+
+    Returns:
+        dict: Agreement of the BD, LB and BDP classes with the labels, or None when nothing could be compared.
+    """
+    labels = load_footprint_labels(labels_jsonl)
+    buildings = [building for building in read_buildings(base_file) if building["id"] in labels]
+    metrics = compute_footprint_metrics(buildings, settings)
+    compared = [building_id for building_id in labels if building_id in metrics
+                and footprint_classes(*metrics[building_id], settings) is not None]
+    print(f"{len(compared)} labelled buildings with enough mapped footprints "
+          f"({len(compared) / max(len(labels), 1):.1%} of the labelled buildings)")
+    if not compared:
+        print("No labelled buildings with enough mapped footprints; agreement cannot be measured.")
+        return None
+
+    agreement = {}
+    for index, (name, bounds_key) in enumerate((("BD", "bd_bounds"), ("LB", "lb_bounds"), ("BDP", "bdp_bounds"))):
+        values = [metrics[building_id][index] for building_id in compared]
+        expected = [labels[building_id][name] for building_id in compared]
+        bounds = getattr(settings, bounds_key)
+        suggested = matching_bounds(values, expected, len(bounds) + 1)
+        agreement[name] = float(np.mean([bisect.bisect_right(bounds, value) == label
+                                         for value, label in zip(values, expected)]))
+        suggested_agreement = np.mean([bisect.bisect_right(suggested, value) == label
+                                       for value, label in zip(values, expected)])
+        print(f"{name}: {agreement[name]:.1%} agreement with {bounds_key} {bounds}; "
+              f"{suggested_agreement:.1%} with suggested {bounds_key} {suggested}")
+
+    os.makedirs(os.path.dirname(calibration_file), exist_ok=True)
+    with open(calibration_file, "w") as file:
+        json.dump({"parameters": settings.metric_parameters(), "labelled": len(compared), "agreement": agreement},
+                  file, indent=2)
+    if min(agreement.values()) < settings.min_agreement:
+        print(f"Agreement is below {settings.min_agreement:.0%}; keep FOOTPRINT_METRICS disabled or use the suggested bounds.")
+    print(f"Calibration saved to {calibration_file}")
+    return agreement
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute building density, large building count and distribution pattern from OSM footprints.")
+    parser.add_argument("--base_file", required=True, help="Base data file, e.g. Data/NewYork_United States_100.jsonl.")
+    parser.add_argument("--output_jsonl", help="Path to save the footprint metrics JSONL file.")
+    parser.add_argument("--calibrate", action="store_true", help="Compare the footprint classes with existing labels instead.")
+    parser.add_argument("--labels_jsonl", help="Existing _neighbor.jsonl annotation file to calibrate against.")
+    args = parser.parse_args()
+
+    if args.calibrate and not args.labels_jsonl:
+        parser.error("--calibrate requires --labels_jsonl")
+    if not args.calibrate and not args.output_jsonl:
+        parser.error("--output_jsonl is required unless --calibrate is given")
+
+    # Raw metrics and calibration do not need the metrics to be enabled or calibrated
+    with open("config.json", "r") as config_file:
+        settings = FootprintMetricsSettings(**json.load(config_file).get("FOOTPRINT_METRICS", {}))
+    if args.calibrate:
+        calibrate(args.base_file, args.labels_jsonl, settings)
+    else:
+        metrics = compute_footprint_metrics(read_buildings(args.base_file), settings)
+        with open(args.output_jsonl, 'w', encoding='utf-8') as file:
+            for building_id, (coverage, large, clark_evans, count) in metrics.items():
+                record = {"id": building_id, **(footprint_classes(coverage, large, clark_evans, count, settings) or {}),
+                          "Footprint_Coverage": round(coverage, 4), "Large_Buildings": large,
+                          "Clark_Evans": None if clark_evans is None else round(clark_evans, 4), "Footprints": count}
+                file.write(json.dumps(record) + "\n")
+        print(f"Footprint metrics saved to {args.output_jsonl}")
@@ -0,0 +1,267 @@
+import os
+import json
+import bisect
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+from structured_output import MalformedPrediction, parse_prediction
+
+# Provenance of a vegetation cover class computed from the image pixels
+GREEN_INDEX_SOURCE = "green_index"
+
+# Modes: 'model' always asks the model, 'replace' never does, 'gate' only asks it near a class boundary
+GREEN_INDEX_MODES = ("model", "replace", "gate")
+
+# Result of the last calibration against model labels, required by the 'replace' and 'gate' modes
+CALIBRATION_FILE = os.path.join("cache", "green_index_calibration.json")
+
+# Gate margins reported by the calibration, besides the configured one
+CALIBRATION_MARGINS = (0.0, 0.02, 0.05, 0.08, 0.10, 0.15, 0.20)
+
+class GreenIndexSettings:
+    """
+    Settings of the local vegetation cover estimate.
+
+    A pixel counts as vegetation when its excess green index 2g - r - b, on chromatic coordinates, is
+    above `exg_threshold` and it is not in deep shadow. The vegetation fraction of the image is mapped
+    to the model's classes (0: 0-10%, 1: 10-30%, 2: 30-60%, 3: 60%+) through `class_bounds`.
+
+    The 'replace' and 'gate' modes are only accepted once the calibration mode of this script has
+    measured, for the current index settings and gate margin, an agreement with existing model labels
+    of at least `min_agreement`.
+
+    Parameters:
+        mode (str): 'model', 'replace' or 'gate'.
+        exg_threshold (float): Excess green index above which a pixel is vegetation.
+        min_brightness (float): Mean channel value, from 0 to 1, below which a pixel is shadow.
+        sample_size (int): Approximate longest side the image is decoded at before scoring.
+        class_bounds (list): Vegetation fractions separating the classes.
+        gate_margin (float): In 'gate' mode, fractions closer than this to a bound are left to the model.
+        min_agreement (float): Calibrated agreement with the model labels the local classes must reach.
+        max_workers (int): Processes scoring images (defaults to the CPU count).
+    """
+
+    def __init__(self, mode="model", exg_threshold=0.08, min_brightness=0.08, sample_size=128,
+                 class_bounds=(0.10, 0.30, 0.60), gate_margin=0.05, min_agreement=0.9, max_workers=None):
+        if mode not in GREEN_INDEX_MODES:
+            raise ValueError(f"Unsupported green index mode: {mode}")
+        self.mode = mode
+        self.exg_threshold = exg_threshold
+        self.min_brightness = min_brightness
+        self.sample_size = int(sample_size)
+        self.class_bounds = list(class_bounds)
+        self.gate_margin = gate_margin
+        self.min_agreement = min_agreement
+        self.max_workers = max_workers
+
+    def effective_margin(self):
+        """Return the gate margin of the mode: 'replace' answers every image locally."""
+        return 0.0 if self.mode == "replace" else self.gate_margin
+
+    def index_parameters(self):
+        """Return the settings a calibration is valid for."""
+        return {"exg_threshold": self.exg_threshold, "min_brightness": self.min_brightness,
+                "sample_size": self.sample_size, "class_bounds": self.class_bounds}
+
+    def check_calibration(self, calibration_file=CALIBRATION_FILE):
+        """Raise ValueError unless the local classes were calibrated to agree enough with the model."""
+        if self.mode == "model":
+            return
+        hint = "run `python utils/green_index.py --input_dir ... --labels_jsonl ...` to calibrate it"
+        if not os.path.exists(calibration_file):
+            raise ValueError(f"GREEN_INDEX mode '{self.mode}' needs a calibration against model labels; {hint}")
+        with open(calibration_file, "r") as file:
+            calibration = json.load(file)
+        if calibration.get("parameters") != self.index_parameters():
+            raise ValueError(f"The green index calibration was made with other settings; {hint}")
+        margin = self.effective_margin()
+        agreement = next((entry["agreement"] for entry in calibration.get("margins", [])
+                          if abs(entry["gate_margin"] - margin) < 1e-9), None)
+        if agreement is None:
+            raise ValueError(f"The green index was not calibrated for gate_margin {margin}; {hint}")
+        if agreement < self.min_agreement:
+            raise ValueError(f"GREEN_INDEX mode '{self.mode}' agrees with the model labels on {agreement:.1%} of "
+                             f"the images it answers, below min_agreement {self.min_agreement:.0%}; "
+                             f"keep 'model' or raise gate_margin")
+
+# Load the green index settings from config.json
+def load_green_index_settings(config_path="config.json"):
+    with open(config_path, "r") as file:
+        config = json.load(file)
+    settings = GreenIndexSettings(**config.get("GREEN_INDEX", {}))
+    settings.check_calibration()
+    return settings
+
+def vegetation_fraction(pixels, exg_threshold=0.08, min_brightness=0.08):
+    """
+    Returns the fraction of vegetation pixels in an RGB image.
+
+    Parameters:
+        pixels (numpy.ndarray): uint8 array of shape (height, width, 3).
+    """
+    red = pixels[..., 0].astype(np.int16)
+    green = pixels[..., 1].astype(np.int16)
+    blue = pixels[..., 2].astype(np.int16)
+    total = red + green + blue
+    # 2g - r - b > t on chromatic coordinates, multiplied through by the pixel total to avoid a division
+    vegetation = (2 * green - red - blue > exg_threshold * total) & (total > min_brightness * 3 * 255)
+    return float(np.count_nonzero(vegetation)) / vegetation.size
+
+def score_image(image_path, sample_size=128, exg_threshold=0.08, min_brightness=0.08):
+    """Return the vegetation fraction of an image file, or None when it cannot be read."""
+    try:
+        with Image.open(image_path) as image:
+            # JPEG images are decoded directly at a reduced scale, which barely changes the fraction
+            image.draft("RGB", (sample_size, sample_size))
+            if max(image.size) > 2 * sample_size:
+                image.thumbnail((sample_size, sample_size), Image.NEAREST)
+            pixels = np.asarray(image.convert("RGB"))
+    except OSError:
+        return None
+    return vegetation_fraction(pixels, exg_threshold, min_brightness)
+
+def _score_batch(image_paths, sample_size, exg_threshold, min_brightness):
+    return [score_image(path, sample_size, exg_threshold, min_brightness) for path in image_paths]
+
+def score_images(image_paths, settings, batch_size=64):
+    """
+    Scores images in a process pool.
+
+    Returns:
+        dict: Image path -> vegetation fraction, or None for unreadable images.
+    """
+    batches = [image_paths[i:i + batch_size] for i in range(0, len(image_paths), batch_size)]
+    scores = {}
+    with ProcessPoolExecutor(max_workers=settings.max_workers) as executor:
+        futures = [executor.submit(_score_batch, batch, settings.sample_size, settings.exg_threshold,
+                                   settings.min_brightness) for batch in batches]
+        for batch, future in zip(batches, futures):
+            scores.update(zip(batch, future.result()))
+    return scores
+
+def green_class(fraction, class_bounds):
+    """Map a vegetation fraction to its cover class."""
+    return bisect.bisect_right(class_bounds, fraction)
+
+class GreenIndex:
+    """
+    Vegetation cover classes computed locally for the images of a directory.
+
+    Images are scored when a worker claims them, in a process pool opened with `open`, so images
+    already annotated in an earlier run are never read.
+
+    Parameters:
+        settings (GreenIndexSettings): Index and mode settings.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.input_dir = None
+        self.executor = None
+
+    def open(self, input_dir):
+        """Start scoring the images of a directory, unless the mode always asks the model."""
+        self.input_dir = input_dir
+        if self.settings.mode != "model" and self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.settings.max_workers)
+        return self
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def resolve(self, filename):
+        """
+        Returns:
+            int: The local vegetation cover class, or None when the model has to be asked.
+        """
+        if self.settings.mode == "model" or self.executor is None:
+            return None
+        fraction = self.executor.submit(score_image, os.path.join(self.input_dir, filename), self.settings.sample_size,
+                                        self.settings.exg_threshold, self.settings.min_brightness).result()
+        if fraction is None:
+            return None
+        bounds = self.settings.class_bounds
+        if self.settings.mode == "gate" and any(abs(fraction - bound) < self.settings.gate_margin for bound in bounds):
+            return None
+        return green_class(fraction, bounds)
+
+# Read vegetation cover labels from a house annotation file, typed or in the legacy text format
+def load_green_labels(labels_jsonl):
+    fields = {"Vegetation_Cover_Class": ("Green_Prediction", 0, 3)}
+    labels = {}
+    with open(labels_jsonl, 'r', encoding='utf-8') as file:
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            # Only model answers are ground truth; classes from an earlier local run are left out
+            if record.get("Green_Source", "model") != "model":
+                continue
+            value = record.get("Green_Prediction")
+            if isinstance(value, int):
+                labels[record["Filename"]] = value
+                continue
+            try:
+                labels[record["Filename"]] = parse_prediction(value, fields)["Green_Prediction"]
+            except (MalformedPrediction, KeyError):
+                continue
+    return labels
+
+def calibrate(input_dir, labels_jsonl, settings, calibration_file=CALIBRATION_FILE):
+    """
+    Compares the local classes with existing model labels for a range of gate margins, reporting the
+    share of images answered locally and their agreement with the model, and records the result so
+    the 'replace' and 'gate' modes can be enabled.
+
+    Returns:
+        float: The smallest calibrated margin reaching `min_agreement`, or None when none does.
+    """
+    labels = load_green_labels(labels_jsonl)
+    filenames = [name for name in labels if os.path.exists(os.path.join(input_dir, name))]
+    scores = score_images([os.path.join(input_dir, name) for name in filenames], settings)
+    scored = [(scores[os.path.join(input_dir, name)], labels[name]) for name in filenames
+              if scores[os.path.join(input_dir, name)] is not None]
+    print(f"{len(scored)} labelled images scored")
+    if not scored:
+        print("No labelled images; agreement cannot be measured.")
+        return None
+
+    margins = []
+    suggested = None
+    for margin in sorted(set(CALIBRATION_MARGINS) | {settings.gate_margin}):
+        answered = [(green_class(fraction, settings.class_bounds), label) for fraction, label in scored
+                    if not any(abs(fraction - bound) < margin for bound in settings.class_bounds)]
+        agreement = sum(1 for local, label in answered if local == label) / len(answered) if answered else 0.0
+        margins.append({"gate_margin": margin, "agreement": agreement, "answered": len(answered) / len(scored)})
+        print(f"gate_margin {margin:.2f}: {len(answered) / len(scored):.1%} of images answered locally, "
+              f"{agreement:.1%} agreement with the model")
+        if answered and agreement >= settings.min_agreement and suggested is None:
+            suggested = margin
+
+    os.makedirs(os.path.dirname(calibration_file), exist_ok=True)
+    with open(calibration_file, "w") as file:
+        json.dump({"parameters": settings.index_parameters(), "labelled": len(scored), "margins": margins}, file, indent=2)
+    if suggested is None:
+        print(f"No gate margin reaches {settings.min_agreement:.0%} agreement; keep GREEN_INDEX mode 'model'.")
+    else:
+        print(f"Smallest gate_margin reaching {settings.min_agreement:.0%} agreement: {suggested:.2f}")
+    print(f"Calibration saved to {calibration_file}")
+    return suggested
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate the green index against existing vegetation cover labels.")
+    parser.add_argument("--input_dir", required=True, help="Directory containing Mapbox house images.")
+    parser.add_argument("--labels_jsonl", required=True, help="Existing _house.jsonl annotation file.")
+    args = parser.parse_args()
+
+    with open("config.json", "r") as config_file:
+        calibrate(args.input_dir, args.labels_jsonl, GreenIndexSettings(**json.load(config_file).get("GREEN_INDEX", {})))
@@ -0,0 +1,73 @@
+import base64
+import os
+
+# Magic-number prefixes of the image formats produced by the downloaders
+IMAGE_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+]
+
+EXTENSION_MIME_TYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".gif": "image/gif",
+    ".webp": "image/webp",
+}
+
+def detect_mime_type(data, image_path=""):
+    """
+    Detects the real MIME type of an image from its leading bytes.
+
+    Parameters:
+        data (bytes): Raw image content.
+        image_path (str): Path of the image, used as a fallback when the signature is unknown.
+
+    Returns:
+        str: MIME type such as 'image/png' or 'image/jpeg'.
+    """
+    for signature, mime_type in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return mime_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    extension = os.path.splitext(image_path)[1].lower()
+    return EXTENSION_MIME_TYPES.get(extension, "image/jpeg")
+
+class ImagePayload:
+    """
+    Prepared request payload for a single image.
+
+    The file is read and base64-encoded once, and the resulting data URL is shared by
+    every model call made on that image. Use it as a context manager so the encoded
+    buffer is released as soon as the image's calls are finished.
+    """
+
+    def __init__(self, image_path):
+        self.image_path = image_path
+        with open(image_path, "rb") as image_file:
+            data = image_file.read()
+        self.mime_type = detect_mime_type(data, image_path)
+        self.num_bytes = len(data)
+        self.data_url = f"data:{self.mime_type};base64,{base64.b64encode(data).decode('utf-8')}"
+
+    def image_content(self, detail=None):
+        """Return the chat message content part carrying this image, optionally with a `detail` level."""
+        if self.data_url is None:
+            raise ValueError(f"Payload for {self.image_path} has already been released.")
+        image_url = {"url": self.data_url}
+        if detail:
+            image_url["detail"] = detail
+        return {"type": "image_url", "image_url": image_url}
+
+    def release(self):
+        """Drop the encoded buffer."""
+        self.data_url = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
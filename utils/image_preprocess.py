@@ -0,0 +1,138 @@
+import os
+import json
+import hashlib
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+
+# Default cache folder for transcoded images
+CACHE_DIR = os.path.join("cache", "preprocessed")
+
+# Output file extension for each supported target format
+FORMAT_EXTENSIONS = {"JPEG": ".jpg", "WEBP": ".webp"}
+
+# Result of preparing a single image
+PreparedImage = namedtuple("PreparedImage", ["path", "original_bytes", "prepared_bytes"])
+
+class PreprocessSettings:
+    """
+    Preprocessing settings for one annotation stage.
+
+    Parameters:
+        enabled (bool): Whether images are transcoded before being sent to the models.
+        max_size (int): Longest side in pixels after resizing (images are never upscaled).
+        format (str): Target format, 'JPEG' or 'WEBP'.
+        quality (int): Encoder quality for the target format.
+        detail (str): Default image `detail` level sent with each request ('low', 'high' or 'auto').
+        model_detail (dict): Optional per-model overrides of `detail`, keyed by model ID.
+    """
+
+    def __init__(self, enabled=False, max_size=768, format="JPEG", quality=85, detail="auto", model_detail=None):
+        if format.upper() not in FORMAT_EXTENSIONS:
+            raise ValueError(f"Unsupported preprocessing format: {format}")
+        self.enabled = enabled
+        self.max_size = int(max_size)
+        self.format = format.upper()
+        self.quality = int(quality)
+        self.detail = detail
+        self.model_detail = model_detail or {}
+
+    def detail_for(self, model):
+        """Return the image `detail` level to request for the given model."""
+        return self.model_detail.get(model, self.detail)
+
+    def cache_tag(self):
+        """Return a string identifying the settings that affect the transcoded output."""
+        return f"{self.max_size}-{self.format}-{self.quality}"
+
+# Load the preprocessing settings of a stage ('svi', 'house' or 'neighbor') from config.json
+def load_preprocess_settings(stage, config_path="config.json"):
+    with open(config_path, "r") as file:
+        config = json.load(file)
+    stage_config = config.get("IMAGE_PREPROCESS", {}).get(stage)
+    if stage_config is None:
+        return PreprocessSettings()
+    return PreprocessSettings(**stage_config)
+
+def transcode_image(image_path, settings, cache_dir=CACHE_DIR):
+    """
+    Resizes and re-encodes one image, reusing a cached output when one exists.
+
+    Parameters:
+        image_path (str): Path of the source image.
+        settings (PreprocessSettings): Target resolution, format and quality.
+        cache_dir (str): Folder holding the transcoded images.
+
+    Returns:
+        PreparedImage: Path to send to the model together with the original and prepared sizes.
+    """
+    original_bytes = os.path.getsize(image_path)
+    stat = os.stat(image_path)
+    key_source = f"{os.path.abspath(image_path)}|{stat.st_mtime_ns}|{original_bytes}|{settings.cache_tag()}"
+    cache_key = hashlib.sha1(key_source.encode("utf-8")).hexdigest()
+    output_path = os.path.join(cache_dir, cache_key + FORMAT_EXTENSIONS[settings.format])
+
+    if not os.path.exists(output_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        with Image.open(image_path) as image:
+            image = image.convert("RGB")
+            image.thumbnail((settings.max_size, settings.max_size), Image.LANCZOS)
+            # Write to a process-specific temporary file so concurrent workers never see a partial image
+            temp_path = f"{output_path}.{os.getpid()}.tmp"
+            image.save(temp_path, format=settings.format, quality=settings.quality)
+            os.replace(temp_path, output_path)
+
+    prepared_bytes = os.path.getsize(output_path)
+    # Keep the original when re-encoding does not make it smaller
+    if prepared_bytes >= original_bytes:
+        return PreparedImage(image_path, original_bytes, original_bytes)
+    return PreparedImage(output_path, original_bytes, prepared_bytes)
+
+def prepare_image(image_path, settings, cache_dir=CACHE_DIR):
+    """Transcode one image, falling back to the original file when it cannot be decoded."""
+    try:
+        return transcode_image(image_path, settings, cache_dir)
+    except OSError as e:
+        print(f"Could not preprocess {image_path}, sending the original: {e}")
+        size = os.path.getsize(image_path)
+        return PreparedImage(image_path, size, size)
+
+class Preprocessor:
+    """
+    Prepares images one at a time on a shared process pool.
+
+    Parameters:
+        settings (PreprocessSettings): Preprocessing settings of the stage.
+        cache_dir (str): Folder holding the transcoded images.
+        max_workers (int): Number of worker processes (defaults to the CPU count).
+    """
+
+    def __init__(self, settings, cache_dir=CACHE_DIR, max_workers=None):
+        self.settings = settings
+        self.cache_dir = cache_dir
+        self.executor = ProcessPoolExecutor(max_workers=max_workers) if settings.enabled else None
+
+    def prepare(self, image_path):
+        """Return the PreparedImage of one image, blocking until its worker process is done."""
+        if self.executor is None:
+            size = os.path.getsize(image_path)
+            return PreparedImage(image_path, size, size)
+        return self.executor.submit(prepare_image, image_path, self.settings, self.cache_dir).result()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def format_savings(original_bytes, prepared_bytes):
+    """Return a one-line summary of the bytes saved by preprocessing."""
+    saved_bytes = original_bytes - prepared_bytes
+    if not original_bytes:
+        return "Preprocessing saved 0.0 KB"
+    return (f"Preprocessing saved {saved_bytes / 1024:.1f} KB "
+            f"({saved_bytes / original_bytes:.1%} of {original_bytes / 1024:.1f} KB)")
@@ -0,0 +1,309 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+from clean_engine import clean_frame, clean_outputs, is_typed, is_typed_file, report_unparsed, stage_paths
+from dataset_store import DATASET_EXTENSIONS, compact_dataset, delta_files, final_stem, load_dataset_settings, write_delta
+from merge import MERGE_STAGES, annotation_file, column_mapping, load_merge_settings, parse_id
+import merge
+
+# Bytes at the start of a file and before a high-water mark whose hash tells a file that was appended
+# to from one that was rewritten
+FINGERPRINT_BYTES = 4096
+
+# Delta files per final dataset file from which they are folded into it
+MAX_DELTAS = 16
+
+def state_path(base_name):
+    """Return the path of the merge state of a city."""
+    return os.path.join("output", base_name, f"{base_name}_merge_state.json")
+
+def ids_path(base_name):
+    """Return the path of the ids of the buildings in the final dataset, as raw int64 values."""
+    return os.path.join("output", base_name, f"{base_name}_merge_ids.bin")
+
+def final_files(base_name, dataset):
+    """Return the final dataset files the merge writes: the columnar file and, when kept, the JSONL file."""
+    stem = final_stem(base_name)
+    formats = [format for format in DATASET_EXTENSIONS if format == dataset.format or (format == "jsonl" and dataset.keep_jsonl)]
+    return [stem + DATASET_EXTENSIONS[format] for format in formats]
+
+def complete_end(path):
+    """Return the offset just past the last complete line of a file; a line still being written is left out."""
+    with open(path, 'rb') as file:
+        position = file.seek(0, os.SEEK_END)
+        while position > 0:
+            block_start = max(0, position - 65536)
+            file.seek(block_start)
+            newline = file.read(position - block_start).rfind(b"\n")
+            if newline != -1:
+                return block_start + newline + 1
+            position = block_start
+    return 0
+
+def fingerprint(path, offset):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        digest.update(file.read(min(offset, FINGERPRINT_BYTES)))
+        file.seek(max(0, offset - FINGERPRINT_BYTES))
+        digest.update(file.read(min(offset, FINGERPRINT_BYTES)))
+    return digest.hexdigest()
+
+def high_water_mark(path):
+    """Return the high-water mark {"offset", "fingerprint"} of a file at its last complete line."""
+    offset = complete_end(path) if os.path.exists(path) else 0
+    return {"offset": offset, "fingerprint": fingerprint(path, offset) if offset else None}
+
+def mark_valid(path, mark):
+    """Return whether a file still holds the bytes read up to a mark, i.e. was only appended to since."""
+    if not mark["offset"]:
+        return True
+    return (os.path.exists(path) and os.path.getsize(path) >= mark["offset"]
+            and fingerprint(path, mark["offset"]) == mark["fingerprint"])
+
+def read_delta(path, offset):
+    """
+    Reads the records appended to a JSONL file after an offset.
+
+    Returns:
+        tuple: (records up to the last complete line, new high-water mark).
+    """
+    if not os.path.exists(path):
+        return [], {"offset": 0, "fingerprint": None}
+    end = complete_end(path)
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        data = file.read(max(0, end - offset))
+    records = [json.loads(line) for line in data.decode('utf-8').split("\n") if line.strip()]
+    return records, {"offset": end, "fingerprint": fingerprint(path, end) if end else None}
+
+def stage_delta(base_file, stage, records, cleaned):
+    """
+    Brings the new records of a stage to the merge schema.
+
+    When the stage is merged from its _cleaned file, the records, raw-text and typed alike, are cleaned
+    row by row with the clean engine and appended to the _cleaned and _unparsed files, so a later full
+    merge sees them as well. Otherwise the records only lose their Filename.
+
+    Parameters:
+        cleaned (bool): Whether the stage is merged from its _cleaned file.
+
+    Returns:
+        dict: Building id -> record, the last record of an id winning as in the full merge; None when
+        raw-text records were appended to a typed output, which then has to be cleaned as a whole.
+    """
+    if not records:
+        return {}
+    if not cleaned:
+        if not all(is_typed(record) for record in records):
+            return None
+        rows = [{key: value for key, value in record.items() if key != 'Filename'} for record in records]
+    else:
+        frame = pd.DataFrame.from_records(records)
+        cleaned, rejects = clean_frame(frame, stage)
+        report_unparsed(cleaned, rejects, stage, len(frame))
+        _, cleaned_file, unparsed_file = stage_paths(base_file, stage)
+        lines = [line for line in cleaned.to_json(orient='records', lines=True).splitlines() if line]
+        with open(cleaned_file, 'a', encoding='utf-8') as file:
+            file.writelines(line + "\n" for line in lines)
+        if len(rejects):
+            rejected = rejects.to_json(orient='records', lines=True, force_ascii=False).splitlines()
+            with open(unparsed_file, 'a', encoding='utf-8') as file:
+                file.writelines(line + "\n" for line in rejected if line)
+        rows = [json.loads(line) for line in lines]
+    delta = {}
+    for row in rows:
+        building_id = parse_id(row.get('id'))
+        if building_id is not None:
+            delta[building_id] = row
+    return delta
+
+def scan_records(file_path, skip_ids=None):
+    """
+    Scans a JSONL file line by line.
+
+    Parameters:
+        skip_ids (set): Ids whose records are not collected; no records are collected when None.
+
+    Returns:
+        tuple: (columns in order of first appearance, id -> last record of every id not in skip_ids).
+    """
+    columns = {}
+    records = {}
+    with open(file_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            record.pop('Filename', None)
+            columns.update(dict.fromkeys(record))
+            if skip_ids is not None:
+                building_id = parse_id(record.get('id'))
+                if building_id is not None and building_id not in skip_ids:
+                    records[building_id] = record
+    return list(columns), records
+
+def write_state(base_name, state):
+    path = state_path(base_name)
+    with open(f"{path}.tmp", 'w', encoding='utf-8') as file:
+        json.dump(state, file)
+    os.replace(f"{path}.tmp", path)
+
+def full_rebuild(base_file, settings, dataset):
+    """
+    Cleans and merges everything, then records the high-water marks, the column layout and the
+    annotations of ids that are not in the base file yet.
+
+    The marks are taken before any file is read, so records appended meanwhile are applied again by
+    the next increment; upserts by id are idempotent.
+    """
+    base_name = os.path.splitext(os.path.basename(base_file))[0]
+    raw_files = {stage: stage_paths(base_file, stage)[0] for stage in MERGE_STAGES}
+    marks = {"base": high_water_mark(base_file)}
+    marks.update({stage: high_water_mark(path) for stage, path in raw_files.items() if os.path.exists(path)})
+
+    legacy = [stage for stage in raw_files if stage in marks and not is_typed_file(raw_files[stage])]
+    if legacy:
+        clean_outputs(base_file, legacy)
+    merge.main(base_file, settings.get("streaming", False), settings.get("buckets", 64))
+
+    base_columns, _ = scan_records(base_file)
+    with open(base_file, 'r', encoding='utf-8') as file:
+        base_ids = {parse_id(json.loads(line).get('id')) for line in file if line.strip()}
+    base_ids.discard(None)
+    np.array(sorted(base_ids), dtype=np.int64).tofile(ids_path(base_name))
+    source_columns = {}
+    pending = {}
+    for stage in MERGE_STAGES:
+        stage_file = annotation_file(base_name, stage)
+        if os.path.exists(stage_file):
+            source_columns[stage], pending[stage] = scan_records(stage_file, base_ids)
+    columns, mapping = column_mapping(base_columns, source_columns)
+    orphans = {stage: {str(building_id): {final: record.get(raw) for raw, final in mapping[stage].items()}
+                       for building_id, record in records.items()}
+               for stage, records in pending.items()}
+    write_state(base_name, {"format": dataset.format, "marks": marks, "columns": columns,
+                            "mapping": mapping, "cleaned": legacy, "orphans": orphans})
+    print(f"Merge state rebuilt: {state_path(base_name)}")
+
+def load_state(base_file, dataset):
+    """Return the saved merge state when every input was only appended to since, otherwise None."""
+    base_name = os.path.splitext(os.path.basename(base_file))[0]
+    path = state_path(base_name)
+    if not os.path.exists(path) or not os.path.exists(ids_path(base_name)):
+        return None
+    if not all(os.path.exists(final_file) for final_file in final_files(base_name, dataset)):
+        return None
+    with open(path, 'r', encoding='utf-8') as file:
+        state = json.load(file)
+    if "cleaned" not in state:
+        return None
+    if state.get("format") != dataset.format:
+        print("Dataset format changed since the last merge; merging everything")
+        return None
+    files = {"base": base_file}
+    files.update({stage: stage_paths(base_file, stage)[0] for stage in MERGE_STAGES})
+    for name, file_path in files.items():
+        if name not in state["marks"]:
+            if os.path.exists(file_path):
+                print(f"[{name}] New annotation output since the last merge; merging everything")
+                return None
+        elif not mark_valid(file_path, state["marks"][name]):
+            print(f"[{name}] {file_path} was rewritten rather than appended to; merging everything")
+            return None
+    return state
+
+def incremental_merge(base_file):
+    """
+    Merges only what was appended to the base file and the annotation outputs since the last merge.
+
+    New base rows with their annotations, and the new annotations of buildings already in the
+    dataset, are written to a delta file next to each final dataset file, which readers apply by id;
+    the final files themselves are not rewritten. Once MERGE.max_deltas delta files have accumulated,
+    they are folded into the final files. Annotations of ids that are not in the base file are kept
+    in the merge state until their building arrives. An input that was rewritten rather than
+    appended to, or a new column, falls back to a full merge.
+    """
+    base_name = os.path.splitext(os.path.basename(base_file))[0]
+    settings = load_merge_settings()
+    dataset = load_dataset_settings()
+    state = load_state(base_file, dataset)
+    if state is None:
+        full_rebuild(base_file, settings, dataset)
+        return
+
+    start = time.monotonic()
+    columns = state["columns"]
+    marks = {}
+    base_records, marks["base"] = read_delta(base_file, state["marks"]["base"]["offset"])
+    new_columns = {column for record in base_records for column in record if column not in columns}
+    stage_updates = {}
+    for stage, mapping in state["mapping"].items():
+        raw_file = stage_paths(base_file, stage)[0]
+        records, marks[stage] = read_delta(raw_file, state["marks"][stage]["offset"])
+        delta = stage_delta(base_file, stage, records, stage in state["cleaned"])
+        if delta is None:
+            print(f"[{stage}] Raw-text records appended to a typed output; merging everything")
+            full_rebuild(base_file, settings, dataset)
+            return
+        new_columns.update(column for row in delta.values() for column in row if column != 'id' and column not in mapping)
+        stage_updates[stage] = {building_id: {final: row.get(raw) for raw, final in mapping.items()}
+                                for building_id, row in delta.items()}
+    if new_columns:
+        print(f"New columns {sorted(new_columns)} since the last merge; merging everything")
+        full_rebuild(base_file, settings, dataset)
+        return
+
+    # New base rows are appended with their new and previously held annotations
+    appended = []
+    for record in base_records:
+        building_id = parse_id(record.get('id'))
+        if building_id is None:
+            continue
+        row = dict.fromkeys(columns)
+        row.update(record)
+        row['id'] = building_id
+        for stage, updates in stage_updates.items():
+            row.update(state["orphans"][stage].pop(str(building_id), {}))
+            row.update(updates.pop(building_id, {}))
+        appended.append(row)
+
+    # Annotations of buildings in the dataset are upserted; the others wait in the state for their building
+    updates = {}
+    for stage_values in stage_updates.values():
+        for building_id, values in stage_values.items():
+            updates.setdefault(building_id, {}).update(values)
+    update_ids = np.fromiter(updates, dtype=np.int64, count=len(updates))
+    found = set(update_ids[np.isin(update_ids, np.fromfile(ids_path(base_name), dtype=np.int64))].tolist())
+    changed = [{'id': building_id, **updates[building_id]} for building_id in found]
+    for stage, stage_values in stage_updates.items():
+        for building_id, values in stage_values.items():
+            if building_id not in found:
+                state["orphans"][stage][str(building_id)] = values
+
+    # The columnar file is written after the JSONL so readers pick it as the newest file
+    if changed or appended:
+        for final_file in final_files(base_name, dataset):
+            write_delta(appended + changed, columns, final_file)
+        with open(ids_path(base_name), 'ab') as file:
+            np.array([row['id'] for row in appended], dtype=np.int64).tofile(file)
+    for final_file in final_files(base_name, dataset):
+        if len(delta_files(final_file)) >= settings.get("max_deltas", MAX_DELTAS):
+            compact_dataset(final_file)
+            print(f"Folded the delta files into {final_file}")
+
+    state["marks"] = marks
+    write_state(base_name, state)
+    held = sum(len(orphans) for orphans in state["orphans"].values())
+    print(f"Incremental merge done in {time.monotonic() - start:.2f}s: {len(appended)} rows appended, "
+          f"{len(changed)} rows updated, {held} annotations waiting for their building")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge only the records appended since the last merge")
+    parser.add_argument('--base_file', type=str, required=True, help="Path to base JSONL file")
+    args = parser.parse_args()
+
+    incremental_merge(args.base_file)
@@ -0,0 +1,255 @@
+import sqlite3
+import time
+import threading
+
+# Task states
+PENDING = "pending"
+IN_FLIGHT = "in_flight"
+DONE = "done"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    filename TEXT NOT NULL,
+    task TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    result TEXT,
+    lease_expires REAL,
+    next_attempt_at REAL NOT NULL DEFAULT 0,
+    updated_at REAL,
+    PRIMARY KEY (filename, task)
+);
+CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, next_attempt_at);
+CREATE TABLE IF NOT EXISTS images (
+    filename TEXT PRIMARY KEY,
+    written INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+class JobQueue:
+    """
+    Durable SQLite-backed queue with one task per (image, model).
+
+    Tasks move from pending to in_flight when claimed and end up done or failed. A claim
+    holds a lease; tasks whose lease expired (e.g. after a crash) are claimable again.
+    Failed attempts are retried with exponential backoff until `max_attempts` is reached.
+
+    Parameters:
+        db_path (str): Path of the SQLite database file.
+        lease_timeout (float): Seconds a claimed task stays reserved.
+        max_attempts (int): Number of attempts before a task is marked failed.
+        backoff_base (float): Delay in seconds before the first retry, doubled on each attempt.
+        backoff_max (float): Upper bound of the retry delay in seconds.
+    """
+
+    def __init__(self, db_path, lease_timeout=600, max_attempts=5, backoff_base=2.0, backoff_max=300.0):
+        self.db_path = db_path
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def enqueue(self, filenames, tasks):
+        """Add the given tasks for every image; existing rows are left untouched."""
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO images (filename) VALUES (?)",
+                ((filename,) for filename in filenames)
+            )
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO tasks (filename, task, updated_at) VALUES (?, ?, ?)",
+                ((filename, task, now) for filename in filenames for task in tasks)
+            )
+            self.conn.execute("COMMIT")
+
+    def mark_written(self, filenames, tasks):
+        """Record images whose output line already exists in the output file."""
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.executemany(
+                "INSERT INTO images (filename, written) VALUES (?, 1) "
+                "ON CONFLICT (filename) DO UPDATE SET written = 1",
+                ((filename,) for filename in filenames)
+            )
+            self.conn.executemany(
+                "INSERT INTO tasks (filename, task, state, updated_at) VALUES (?, ?, 'done', ?) "
+                "ON CONFLICT (filename, task) DO UPDATE SET state = 'done', updated_at = excluded.updated_at",
+                ((filename, task, now) for filename in filenames for task in tasks)
+            )
+            self.conn.execute("COMMIT")
+
+    def recover(self):
+        """
+        Returns tasks left in flight by a crashed run to pending.
+
+        A stage is annotated by a single process, so any in-flight task found at startup
+        belongs to a run that no longer exists.
+        """
+        with self.lock:
+            cursor = self.conn.execute(
+                "UPDATE tasks SET state = 'pending', lease_expires = NULL, next_attempt_at = 0, updated_at = ? "
+                "WHERE state = 'in_flight'", (time.time(),)
+            )
+            return cursor.rowcount
+
+    def reset_failed(self):
+        """Move failed tasks back to pending with a fresh attempt budget."""
+        with self.lock:
+            cursor = self.conn.execute(
+                "UPDATE tasks SET state = 'pending', attempts = 0, next_attempt_at = 0, updated_at = ? "
+                "WHERE state = 'failed'", (time.time(),)
+            )
+            return cursor.rowcount
+
+    def claim_images(self, limit):
+        """
+        Leases the claimable tasks of up to `limit` images.
+
+        Returns:
+            list: (filename, [task, ...]) pairs; all tasks of an image are claimed together
+            so the image is only read and encoded once.
+        """
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            filenames = [row[0] for row in self.conn.execute(
+                "SELECT DISTINCT filename FROM tasks "
+                "WHERE (state = 'pending' AND next_attempt_at <= ?) OR (state = 'in_flight' AND lease_expires < ?) "
+                "LIMIT ?", (now, now, limit)
+            )]
+            claimed = []
+            for filename in filenames:
+                tasks = [row[0] for row in self.conn.execute(
+                    "SELECT task FROM tasks WHERE filename = ? AND "
+                    "((state = 'pending' AND next_attempt_at <= ?) OR (state = 'in_flight' AND lease_expires < ?))",
+                    (filename, now, now)
+                )]
+                self.conn.executemany(
+                    "UPDATE tasks SET state = 'in_flight', attempts = attempts + 1, lease_expires = ?, updated_at = ? "
+                    "WHERE filename = ? AND task = ?",
+                    ((now + self.lease_timeout, now, filename, task) for task in tasks)
+                )
+                claimed.append((filename, tasks))
+            self.conn.execute("COMMIT")
+        return claimed
+
+    def complete(self, filename, task, result):
+        """
+        Stores the result of a task.
+
+        Returns:
+            dict: All task results of the image once every task is done, otherwise None.
+        """
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.execute(
+                "UPDATE tasks SET state = 'done', result = ?, last_error = NULL, lease_expires = NULL, updated_at = ? "
+                "WHERE filename = ? AND task = ?", (result, time.time(), filename, task)
+            )
+            rows = self.conn.execute(
+                "SELECT task, state, result FROM tasks WHERE filename = ?", (filename,)
+            ).fetchall()
+            self.conn.execute("COMMIT")
+        if all(state == DONE for _, state, _ in rows):
+            return {name: value for name, _, value in rows}
+        return None
+
+    def fail(self, filename, task, error):
+        """Records a failed attempt and schedules a retry, or marks the task failed when attempts are exhausted."""
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            attempts = self.conn.execute(
+                "SELECT attempts FROM tasks WHERE filename = ? AND task = ?", (filename, task)
+            ).fetchone()[0]
+            if attempts >= self.max_attempts:
+                self.conn.execute(
+                    "UPDATE tasks SET state = 'failed', last_error = ?, lease_expires = NULL, updated_at = ? "
+                    "WHERE filename = ? AND task = ?", (str(error), now, filename, task)
+                )
+            else:
+                delay = min(self.backoff_base * (2 ** (attempts - 1)), self.backoff_max)
+                self.conn.execute(
+                    "UPDATE tasks SET state = 'pending', last_error = ?, lease_expires = NULL, next_attempt_at = ?, "
+                    "updated_at = ? WHERE filename = ? AND task = ?", (str(error), now + delay, now, filename, task)
+                )
+            self.conn.execute("COMMIT")
+
+    def set_written(self, filenames, output_offset):
+        """Mark images whose records are durably written, together with the output file offset they end at."""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.executemany(
+                "UPDATE images SET written = 1 WHERE filename = ?", ((filename,) for filename in filenames)
+            )
+            self.conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('output_offset', ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value", (str(output_offset),)
+            )
+            self.conn.execute("COMMIT")
+
+    def output_offset(self):
+        """Return the output file offset up to which written records are recorded in the queue."""
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'output_offset'").fetchone()
+        return int(row[0]) if row else 0
+
+    def unwritten_results(self):
+        """Return (filename, results) for images whose tasks are all done but whose record was never written."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT t.filename, t.task, t.result FROM tasks t JOIN images i ON i.filename = t.filename "
+                "WHERE i.written = 0 AND NOT EXISTS "
+                "(SELECT 1 FROM tasks o WHERE o.filename = t.filename AND o.state != 'done') "
+                "ORDER BY t.filename"
+            ).fetchall()
+        results = {}
+        for filename, task, result in rows:
+            results.setdefault(filename, {})[task] = result
+        return list(results.items())
+
+    def next_retry_delay(self):
+        """Return seconds until the next waiting task becomes claimable, or None when nothing is waiting."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT MIN(CASE WHEN state = 'pending' THEN next_attempt_at ELSE lease_expires END) "
+                "FROM tasks WHERE state IN ('pending', 'in_flight')"
+            ).fetchone()
+        if row[0] is None:
+            return None
+        return max(0.0, row[0] - time.time())
+
+    def retries(self):
+        """Return the number of attempts made beyond the first one of each task."""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COALESCE(SUM(attempts - 1), 0) FROM tasks WHERE attempts > 1"
+            ).fetchone()[0]
+
+    def counts(self):
+        """Return the number of tasks in each state."""
+        with self.lock:
+            return dict(self.conn.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state").fetchall())
+
+    def count_unwritten(self):
+        """Return the number of images whose record has not been written yet."""
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM images WHERE written = 0").fetchone()[0]
@@ -8,13 +8,16 @@ import sys
 
 
 class MapboxImageDownloader:
-    def __init__(self, api_key, jsonl_path, house_zoom, neighbor_zoom, house_dim_meters, neighbor_dim_meters):
+    def __init__(self, api_key, jsonl_path, house_zoom, neighbor_zoom, house_dim_meters, neighbor_dim_meters,
+                 download_house=True, download_neighbor=True):
         self.api_key = api_key
         self.jsonl_path = jsonl_path
         self.house_zoom = house_zoom
         self.neighbor_zoom = neighbor_zoom
         self.house_dim_meters = house_dim_meters
         self.neighbor_dim_meters = neighbor_dim_meters
+        self.download_house = download_house
+        self.download_neighbor = download_neighbor
 
         # Prepare output folder paths
         base_folder_name = os.path.splitext(os.path.basename(self.jsonl_path))[0]
@@ -23,8 +26,10 @@ class MapboxImageDownloader:
         self.error_log_file = 'check.txt'
 
         # Create output directories
-        os.makedirs(self.house_folder, exist_ok=True)
-        os.makedirs(self.neighbor_folder, exist_ok=True)
+        if self.download_house:
+            os.makedirs(self.house_folder, exist_ok=True)
+        if self.download_neighbor:
+            os.makedirs(self.neighbor_folder, exist_ok=True)
 
     @staticmethod
     def ground_resolution(latitude, zoom):
@@ -65,7 +70,7 @@ class MapboxImageDownloader:
         neighbor_file = os.path.join(self.neighbor_folder, f"mapbox_image_{location_id}_neighbor.png")
 
         # Download house image
-        if not os.path.exists(house_file):
+        if self.download_house and not os.path.exists(house_file):
             house_res = self.ground_resolution(latitude, self.house_zoom)
             width, height = self.get_pixel_dimensions(self.house_dim_meters, house_res)
             house_url = (
@@ -76,7 +81,7 @@ class MapboxImageDownloader:
                 error_log.write(f"House image failed - Lat: {latitude}, Lon: {longitude}\n")
 
         # Download neighbor image
-        if not os.path.exists(neighbor_file):
+        if self.download_neighbor and not os.path.exists(neighbor_file):
             neighbor_res = self.ground_resolution(latitude, self.neighbor_zoom)
             width, height = self.get_pixel_dimensions(self.neighbor_dim_meters, neighbor_res)
             neighbor_url = (
@@ -96,12 +101,13 @@ class MapboxImageDownloader:
 
 if __name__ == "__main__":
     # Parse command-line arguments
-    if len(sys.argv) != 3:
-        print("Usage: python mapbox_turbo.py <JSONL_PATH> <API_KEY>")
+    if len(sys.argv) not in (3, 4) or (len(sys.argv) == 4 and sys.argv[3] not in ("--house_only", "--neighbor_only")):
+        print("Usage: python mapbox_turbo.py <JSONL_PATH> <API_KEY> [--house_only | --neighbor_only]")
         sys.exit(1)
 
     JSONL_PATH = sys.argv[1]
     MAPBOX_API_KEY = sys.argv[2]
+    ONLY = sys.argv[3] if len(sys.argv) == 4 else None
 
     # Configuration parameters
     HOUSE_ZOOM = 20
@@ -116,6 +122,8 @@ if __name__ == "__main__":
         house_zoom=HOUSE_ZOOM,
         neighbor_zoom=NEIGHBOR_ZOOM,
         house_dim_meters=HOUSE_DIM_METERS,
-        neighbor_dim_meters=NEIGHBOR_DIM_METERS
+        neighbor_dim_meters=NEIGHBOR_DIM_METERS,
+        download_house=ONLY != "--neighbor_only",
+        download_neighbor=ONLY != "--house_only"
     )
     downloader.process_all_locations()
@@ -1,46 +1,331 @@
 import pandas as pd
 import argparse
+import heapq
+import json
 import os
+import re
+import tempfile
+import time
+from clean_engine import is_typed_file, read_records
+from dataset_store import clear_deltas, convert_jsonl, load_dataset_settings, write_dataset
 
-# 读取 JSONL 文件
-def read_jsonl(file_path):
-    return pd.read_json(file_path, lines=True)
+# 参与合并的标注阶段，按列顺序排列
+MERGE_STAGES = ("house", "neighbor", "svi")
 
-def main(base_file):
-    # 提取 base 文件的目录和文件名
-    base_dir = os.path.dirname(base_file)
+# 全部为结构化记录的输出直接参与合并，其余（含续跑产生的新旧格式混合输出）使用清洗后的文件
+def annotation_file(base_name, stage):
+    raw_file = os.path.join("output", base_name, f"{base_name}_{stage}.jsonl")
+    if is_typed_file(raw_file):
+        return raw_file
+    return os.path.join("output", base_name, f"{base_name}_{stage}_cleaned.jsonl")
+
+def enforce_id_schema(frame):
+    """
+    将 id 列统一为 int64。
+
+    旧格式清洗结果中的 id 可能是字符串，这里按文本解析（不经过 float，避免大 id 丢失精度），
+    无法解析的行被丢弃。
+
+    Returns:
+        tuple: (id 为 int64 的数据框, 丢弃的行数)
+    """
+    if 'id' not in frame:
+        return frame.iloc[0:0].assign(id=pd.Series(dtype='int64')), len(frame)
+    ids = frame['id']
+    if not pd.api.types.is_integer_dtype(ids):
+        text = ids.astype('string').str.strip().str.replace(r'\.0+$', '', regex=True)
+        ids = text.where(text.str.fullmatch(r'-?\d+').fillna(False)).astype('Int64')
+    valid = ids.notna().to_numpy()
+    frame = frame[valid].copy()
+    frame['id'] = ids[valid].astype('int64').to_numpy()
+    return frame, int((~valid).sum())
+
+# 单个 id 的解析规则，与 enforce_id_schema 一致；无法解析时返回 None
+def parse_id(value):
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    text = re.sub(r'\.0+$', '', str(value).strip())
+    return int(text) if re.fullmatch(r'-?\d+', text) else None
+
+# 读取标注文件，去掉仅用于追踪的 Filename 列，预测列转为可空整数
+def read_annotations(file_path):
+    frame = read_records(file_path).drop(columns=['Filename'], errors='ignore')
+    return frame.convert_dtypes(convert_string=False, convert_boolean=False)
+
+class JoinStats:
+    """
+    一个来源的合并统计。
+
+    Parameters:
+        source (str): 来源名称（house、neighbor、svi）。
+        rows (int): 来源的行数。
+        invalid_ids (int): id 无法解析为整数而丢弃的行数。
+        duplicates (int): 重复 id 的行数（保留最后一条）。
+        matched (int): 在来源中找到的 base id 数量。
+        orphans (int): 来源中不在 base 里的 id 数量。
+        base_rows (int): base 的行数。
+    """
+
+    def __init__(self, source, rows, invalid_ids, duplicates, matched, orphans, base_rows):
+        self.source = source
+        self.rows = rows
+        self.invalid_ids = invalid_ids
+        self.duplicates = duplicates
+        self.matched = matched
+        self.orphans = orphans
+        self.base_rows = base_rows
+
+    def match_rate(self):
+        return self.matched / self.base_rows if self.base_rows else 0.0
+
+    def __str__(self):
+        return (f"[{self.source}] {self.matched}/{self.base_rows} base ids matched ({self.match_rate():.1%}); "
+                f"{self.rows} rows, {self.orphans} ids not in base, {self.duplicates} duplicate ids, "
+                f"{self.invalid_ids} invalid ids")
+
+def hash_join(base, sources):
+    """
+    以 base 为左表，通过哈希索引一次性左连接所有来源。
+
+    每个来源按 id 建立哈希索引（pandas.Index），用 get_indexer 找到每个 base id 所在的行，
+    未匹配的位置填充缺失值。各来源的列最后一次性拼接，而不是链式 merge。
+
+    Parameters:
+        base (DataFrame): id 为 int64 的 base 数据。
+        sources (dict): 来源名称 -> id 为 int64 的标注数据。
+
+    Returns:
+        tuple: (合并后的数据框, JoinStats 列表)
+    """
+    base = base.reset_index(drop=True)
+    base_index = pd.Index(base['id'])
+    columns = [base]
+    stats = []
+    seen = set(base.columns)
+    for source, (frame, invalid_ids) in sources.items():
+        rows = len(frame) + invalid_ids
+        deduplicated = frame.drop_duplicates(subset='id', keep='last')
+        index = pd.Index(deduplicated['id'])
+        positions = index.get_indexer(base['id'])
+        matched = positions >= 0
+        values = deduplicated.drop(columns=['id']).reset_index(drop=True)
+        # 未匹配的位置为 -1，不在 RangeIndex 中，reindex 后整行为缺失值
+        joined = values.reindex(positions).reset_index(drop=True)
+        joined.columns = [f"{column}_{source}" if column in seen else column for column in joined.columns]
+        seen.update(joined.columns)
+        columns.append(joined)
+        orphans = int((~index.isin(base_index)).sum())
+        stats.append(JoinStats(source, rows, invalid_ids, len(frame) - len(deduplicated), int(matched.sum()), orphans, len(base)))
+    return pd.concat(columns, axis=1), stats
+
+# 读取 base 与各阶段标注并统一 id 类型
+def load_sources(base_file):
+    base_name = os.path.splitext(os.path.basename(base_file))[0]
+    base, invalid_base = enforce_id_schema(read_records(base_file))
+    if invalid_base:
+        print(f"base 文件中有 {invalid_base} 行 id 无法解析，已跳过")
+    sources = {}
+    for stage in MERGE_STAGES:
+        stage_file = annotation_file(base_name, stage)
+        if not os.path.exists(stage_file):
+            print(f"[{stage}] 标注文件不存在，跳过: {stage_file}")
+            continue
+        sources[stage] = enforce_id_schema(read_annotations(stage_file))
+    return base, sources
+
+# 读取合并配置（config.json 中的 MERGE）
+def load_merge_settings(config_path="config.json"):
+    if not os.path.exists(config_path):
+        return {}
+    with open(config_path, 'r') as file:
+        return json.load(file).get("MERGE", {})
+
+# 按 id 哈希分桶（Fibonacci 哈希，避免 id 的规律性造成桶大小不均）
+def bucket_of(building_id, buckets):
+    return ((building_id * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) % buckets
+
+def partition_file(file_path, work_dir, name, buckets, drop=(), with_position=False):
+    """
+    逐行读取 JSONL 文件，按 id 哈希写入磁盘上的分桶文件，内存占用与文件大小无关。
+
+    Parameters:
+        with_position (bool): 是否记录行号（_position），用于按 base 原始顺序输出。
+
+    Returns:
+        tuple: (按首次出现顺序排列的列名列表, id 无法解析的行数)
+    """
+    columns = {}
+    invalid = 0
+    files = [open(os.path.join(work_dir, f"{name}_{k}.jsonl"), 'w', encoding='utf-8') for k in range(buckets)]
+    try:
+        with open(file_path, 'r', encoding='utf-8') as infile:
+            position = 0
+            for line in infile:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                for column in drop:
+                    record.pop(column, None)
+                columns.update(dict.fromkeys(record))
+                building_id = parse_id(record.get('id'))
+                if building_id is None:
+                    invalid += 1
+                    continue
+                record['id'] = building_id
+                if with_position:
+                    record = {'_position': position, **record}
+                    position += 1
+                files[bucket_of(building_id, buckets)].write(json.dumps(record) + "\n")
+    finally:
+        for file in files:
+            file.close()
+    return list(columns), invalid
+
+def column_mapping(base_columns, source_columns):
+    """
+    按 hash_join 的命名规则（重名列加 _<来源> 后缀）计算最终列顺序。
+
+    Returns:
+        tuple: (最终列名列表, 来源名称 -> {来源列名: 最终列名})
+    """
+    columns = list(base_columns)
+    seen = set(base_columns)
+    mapping = {}
+    for source, names in source_columns.items():
+        mapping[source] = {}
+        for column in names:
+            if column == 'id':
+                continue
+            renamed = f"{column}_{source}" if column in seen else column
+            columns.append(renamed)
+            seen.add(renamed)
+            mapping[source][column] = renamed
+    return columns, mapping
+
+def merged_columns(base_columns, source_columns):
+    """按 hash_join 的命名规则计算最终列顺序。"""
+    return column_mapping(base_columns, source_columns)[0]
+
+# 逐个读取已按 _position 排序的分桶结果，多路归并后去掉 _position 写出
+def merge_sorted_buckets(bucket_files, final_file):
+    prefix = '{"_position":'
+    def keyed(path):
+        with open(path, 'r', encoding='utf-8') as file:
+            for line in file:
+                end = line.index(',', len(prefix))
+                yield int(line[len(prefix):end]), '{' + line[end + 1:]
+    with open(final_file, 'w', encoding='utf-8') as outfile:
+        for _, line in heapq.merge(*[keyed(path) for path in bucket_files], key=lambda item: item[0]):
+            outfile.write(line)
+
+def streaming_merge(base_file, final_file, buckets=64, work_dir=None):
+    """
+    外存合并：先把 base 和各来源按 id 哈希分桶写到磁盘，再逐桶用 hash_join 合并，
+    最后按 base 的原始行序多路归并写出。内存只需容纳一个桶，结果与内存合并一致。
+
+    Parameters:
+        buckets (int): 分桶数量，数据量越大应越多。
+        work_dir (str): 分桶临时目录的父目录，默认为输出目录。
+
+    Returns:
+        list: 各来源的 JoinStats。
+    """
     base_name = os.path.splitext(os.path.basename(base_file))[0]
+    with tempfile.TemporaryDirectory(dir=work_dir or os.path.dirname(final_file)) as temp_dir:
+        base_columns, invalid_base = partition_file(base_file, temp_dir, "base", buckets, with_position=True)
+        if invalid_base:
+            print(f"base 文件中有 {invalid_base} 行 id 无法解析，已跳过")
+        source_columns = {}
+        invalid_ids = {}
+        for stage in MERGE_STAGES:
+            stage_file = annotation_file(base_name, stage)
+            if not os.path.exists(stage_file):
+                print(f"[{stage}] 标注文件不存在，跳过: {stage_file}")
+                continue
+            source_columns[stage], invalid_ids[stage] = partition_file(stage_file, temp_dir, stage, buckets, drop=('Filename',))
+        columns = ['_position'] + merged_columns(base_columns, source_columns)
 
-    # 定义其他文件路径
-    house_file = os.path.join("output", base_name, base_name + '_house_cleaned.jsonl')
-    neighbor_file = os.path.join("output", base_name, base_name + '_neighbor_cleaned.jsonl')
-    svi_file = os.path.join("output", base_name, base_name + '_svi_cleaned.jsonl')
+        totals = {stage: JoinStats(stage, invalid_ids[stage], invalid_ids[stage], 0, 0, 0, 0) for stage in source_columns}
+        bucket_files = []
+        for k in range(buckets):
+            base = read_records(os.path.join(temp_dir, f"base_{k}.jsonl"))
+            sources = {stage: (read_annotations(os.path.join(temp_dir, f"{stage}_{k}.jsonl")), 0) for stage in source_columns}
+            if len(base):
+                base, _ = enforce_id_schema(base)
+            else:
+                base = pd.DataFrame({column: pd.Series(dtype='int64' if column in ('id', '_position') else object)
+                                     for column in ['_position'] + base_columns})
+            sources = {stage: enforce_id_schema(frame) if len(frame) else (pd.DataFrame({'id': pd.Series(dtype='int64')}), 0)
+                       for stage, (frame, _) in sources.items()}
+            merged_df, stats = hash_join(base, sources)
+            for stat in stats:
+                total = totals[stat.source]
+                total.rows += stat.rows
+                total.duplicates += stat.duplicates
+                total.matched += stat.matched
+                total.orphans += stat.orphans
+                total.base_rows += stat.base_rows
+            if len(merged_df):
+                bucket_file = os.path.join(temp_dir, f"joined_{k}.jsonl")
+                merged_df.reindex(columns=columns).sort_values('_position').to_json(bucket_file, orient='records', lines=True)
+                bucket_files.append(bucket_file)
+        merge_sorted_buckets(bucket_files, final_file)
+    return list(totals.values())
+
+def main(base_file, streaming=False, buckets=64):
+    base_name = os.path.splitext(os.path.basename(base_file))[0]
 
     # 输出文件路径
     output_dir = os.path.join("output", base_name)
     os.makedirs(output_dir, exist_ok=True)
-    output_file = os.path.join(output_dir, base_name + '_merged.jsonl')
-
-    # 读取每个文件
-    df_house = read_jsonl(house_file)
-    df_neighbor = read_jsonl(neighbor_file)
-    df_svi = read_jsonl(svi_file)
-    df_base = read_jsonl(base_file)
-
-    # 合并数据框（通过 'id' 列）
-    merged_df = df_base
-    merged_df = merged_df.merge(df_house, on='id', how='left')
-    merged_df = merged_df.merge(df_neighbor, on='id', how='left')
-    merged_df = merged_df.merge(df_svi, on='id', how='left')
+    final_file = os.path.join(output_dir, base_name + '_final.jsonl')
 
-    # 保存合并后的结果
-    merged_df.to_json(output_file, orient='records', lines=True)
-    print(f"合并完成，结果已保存到 {output_file}")
+    # 最终文件的存储格式（config.json 中的 DATASET）
+    dataset = load_dataset_settings()
+    stem = os.path.splitext(final_file)[0]
+    start = time.monotonic()
+    if streaming:
+        # 外存合并先写 JSONL，再分块转换为列式文件
+        stats = streaming_merge(base_file, final_file, buckets)
+        rows = stats[0].base_rows if stats else None
+        if dataset.format != "jsonl":
+            final_file = convert_jsonl(final_file, stem, dataset.format, dataset.chunk_rows)
+            if not dataset.keep_jsonl:
+                os.remove(stem + '.jsonl')
+    else:
+        base, sources = load_sources(base_file)
+        merged_df, stats = hash_join(base, sources)
+        rows = len(merged_df)
+        # 只写一次最终文件；列式文件在 JSONL 之后写入，读取时以最新的为准
+        if dataset.format == "jsonl" or dataset.keep_jsonl:
+            merged_df.to_json(final_file, orient='records', lines=True)
+        if dataset.format != "jsonl":
+            final_file = write_dataset(merged_df, stem, dataset.format)
+    # 完整合并的结果已包含增量合并写入的差量文件
+    clear_deltas(stem)
+    for stat in stats:
+        print(stat)
+    print(f"合并完成（{rows} 行，{time.monotonic() - start:.2f}s），结果已保存到 {final_file}")
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Merge JSONL files by ID")
+    parser = argparse.ArgumentParser(description="Merge the annotation outputs into the base JSONL file by ID")
     parser.add_argument('--base_file', type=str, required=True, help="Path to base JSONL file")
+    parser.add_argument('--streaming', action='store_true', default=None, help="Merge out of core through on-disk id buckets")
+    parser.add_argument('--buckets', type=int, default=None, help="Number of id buckets of the streaming merge")
+    parser.add_argument('--incremental', action='store_true', default=None, help="Only merge the records appended since the last merge")
 
     args = parser.parse_args()
 
-    main(args.base_file)
+    # 命令行参数优先于 config.json 中的 MERGE 设置
+    settings = load_merge_settings()
+    streaming = args.streaming if args.streaming is not None else settings.get("streaming", False)
+    buckets = args.buckets or settings.get("buckets", 64)
+    incremental = args.incremental if args.incremental is not None else settings.get("incremental", False)
+    if incremental:
+        # 增量合并：只清洗并合并上次合并后追加的记录
+        from incremental_merge import incremental_merge
+        incremental_merge(args.base_file)
+    else:
+        main(args.base_file, streaming, buckets)
@@ -0,0 +1,261 @@
+import io
+import re
+import json
+import math
+import time
+import base64
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from PIL import Image
+
+# Keys requested by json_instruction, e.g. 'Output a JSON object {"BD": <BD>, "LB": <LB>} ...'
+REQUESTED_KEY = re.compile(r'"(\w+)": <')
+
+# Filename mentioned in the user message of the annotation prompts
+REQUESTED_FILE = re.compile(r"Classify the image '([^']+)'")
+
+# Estimate the prompt tokens of an image part the way the API bills them: 85 base tokens plus 170 per 512px tile
+def image_tokens(url, detail):
+    if detail == "low":
+        return 85
+    try:
+        width, height = Image.open(io.BytesIO(base64.b64decode(url.split(",", 1)[1]))).size
+    except (IndexError, ValueError, OSError):
+        return 765
+    # The image is fitted within 2048x2048, then its shortest side is scaled down to 768
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+# Estimate the prompt tokens of a chat request, at about four characters per text token
+def prompt_tokens(messages):
+    tokens = 0
+    for message in messages:
+        parts = message["content"] if isinstance(message["content"], list) else [message["content"]]
+        for part in parts:
+            if isinstance(part, str):
+                tokens += len(part) // 4 + 1
+            elif part.get("type") == "image_url":
+                tokens += image_tokens(part["image_url"]["url"], part["image_url"].get("detail", "auto"))
+            else:
+                tokens += len(part.get("text", "")) // 4 + 1
+    return tokens
+
+class MockSettings:
+    """
+    Behaviour of the mock chat completions server.
+
+    Parameters:
+        latency (str): Latency distribution, one of 'fixed', 'uniform' or 'lognormal'.
+        latency_median (float): Median latency in seconds.
+        latency_spread (float): Half-width of the uniform distribution, or sigma of the lognormal one.
+        slow_fraction (float): Fraction of requests slowed down by `slow_factor`, to simulate stragglers.
+        slow_factor (float): Latency multiplier of slowed down requests.
+        rate_limit_fraction (float): Fraction of requests answered with a 429.
+        max_concurrent (int): Requests in flight at which further requests get a 429 (0 for no limit).
+        error_fraction (float): Fraction of requests answered with a 500.
+        malformed_fraction (float): Fraction of answers that cannot be parsed.
+        response_format (str): 'json' for JSON answers, 'legacy' for 'Filename: <name>, Key: <value>' answers.
+        label (int): Class value returned for every requested key.
+        seed (int): Random seed, for reproducible runs.
+    """
+
+    def __init__(self, latency="lognormal", latency_median=1.0, latency_spread=0.3, slow_fraction=0.0,
+                 slow_factor=10.0, rate_limit_fraction=0.0, max_concurrent=0, error_fraction=0.0,
+                 malformed_fraction=0.0, response_format="json", label=1, seed=None):
+        self.latency = latency
+        self.latency_median = latency_median
+        self.latency_spread = latency_spread
+        self.slow_fraction = slow_fraction
+        self.slow_factor = slow_factor
+        self.rate_limit_fraction = rate_limit_fraction
+        self.max_concurrent = max_concurrent
+        self.error_fraction = error_fraction
+        self.malformed_fraction = malformed_fraction
+        self.response_format = response_format
+        self.label = label
+        self.seed = seed
+
+class MockChatServer:
+    """
+    Local stand-in for the OpenAI chat completions endpoint, used to benchmark the annotation stages.
+
+    Answers are canned: every key requested by the system prompt gets `settings.label`, in the JSON
+    or legacy text format of the annotators. Latency, 429s, 500s and malformed answers are injected
+    according to the settings.
+
+    Parameters:
+        settings (MockSettings): Behaviour of the server.
+        host (str): Interface to bind.
+        port (int): Port to bind (0 picks a free port).
+    """
+
+    def __init__(self, settings, host="127.0.0.1", port=0):
+        self.settings = settings
+        self.random = random.Random(settings.seed)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.counts = {"requests": 0, "ok": 0, "rate_limited": 0, "server_error": 0, "malformed": 0}
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def api_base(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        """Serve requests from a background thread."""
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="mock-openai", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _draw(self):
+        """Draw the outcome and latency of one request."""
+        settings = self.settings
+        with self.lock:
+            self.counts["requests"] += 1
+            overloaded = 0 < settings.max_concurrent <= self.in_flight
+            roll = self.random.random()
+            if settings.latency == "fixed":
+                latency = settings.latency_median
+            elif settings.latency == "uniform":
+                latency = self.random.uniform(settings.latency_median - settings.latency_spread,
+                                              settings.latency_median + settings.latency_spread)
+            else:
+                latency = self.random.lognormvariate(0.0, settings.latency_spread) * settings.latency_median
+            if self.random.random() < settings.slow_fraction:
+                latency *= settings.slow_factor
+            malformed = self.random.random() < settings.malformed_fraction
+
+        if overloaded or roll < settings.rate_limit_fraction:
+            outcome = "rate_limited"
+        elif roll < settings.rate_limit_fraction + settings.error_fraction:
+            outcome = "server_error"
+        elif malformed:
+            outcome = "malformed"
+        else:
+            outcome = "ok"
+        with self.lock:
+            self.counts[outcome] += 1
+        return outcome, max(0.0, latency)
+
+    def answer(self, messages, malformed=False):
+        """Return the canned answer to the annotation prompt in `messages`."""
+        system_prompt = " ".join(m["content"] for m in messages if m["role"] == "system" and isinstance(m["content"], str))
+        user_text = " ".join(m["content"] for m in messages if m["role"] == "user" and isinstance(m["content"], str))
+        keys = REQUESTED_KEY.findall(system_prompt)
+        if malformed:
+            return "I cannot determine the class of this image."
+        if self.settings.response_format == "legacy":
+            match = REQUESTED_FILE.search(user_text)
+            filename = match.group(1) if match else "unknown"
+            return ", ".join([f"Filename: {filename}"] + [f"{key}: {self.settings.label}" for key in keys])
+        return json.dumps({key: self.settings.label for key in keys})
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self._reply(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+                    return
+                outcome, latency = server._draw()
+                if outcome == "rate_limited":
+                    # Rate limits are answered right away, like the real API does
+                    self._reply(429, {"error": {"message": "Rate limit reached (mock)", "type": "requests"}})
+                    return
+                with server.lock:
+                    server.in_flight += 1
+                try:
+                    time.sleep(latency)
+                finally:
+                    with server.lock:
+                        server.in_flight -= 1
+                if outcome == "server_error":
+                    self._reply(500, {"error": {"message": "Internal server error (mock)", "type": "server_error"}})
+                    return
+                content = server.answer(body.get("messages", []), malformed=outcome == "malformed")
+                prompt = prompt_tokens(body.get("messages", []))
+                completion = max(1, len(content) // 4)
+                self._reply(200, {
+                    "id": f"chatcmpl-mock-{int(time.time() * 1000)}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body.get("model", "mock"),
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": prompt + completion}
+                })
+
+            def _reply(self, status, payload):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def report(self):
+        with self.lock:
+            return "Mock server: " + ", ".join(f"{key}: {value}" for key, value in self.counts.items())
+
+# Command-line options shared with the benchmark harness
+def add_mock_arguments(parser):
+    parser.add_argument("--latency", choices=["fixed", "uniform", "lognormal"], default="lognormal", help="Latency distribution.")
+    parser.add_argument("--latency_median", type=float, default=1.0, help="Median latency in seconds.")
+    parser.add_argument("--latency_spread", type=float, default=0.3, help="Uniform half-width or lognormal sigma.")
+    parser.add_argument("--slow_fraction", type=float, default=0.0, help="Fraction of straggling requests.")
+    parser.add_argument("--slow_factor", type=float, default=10.0, help="Latency multiplier of straggling requests.")
+    parser.add_argument("--rate_limit_fraction", type=float, default=0.0, help="Fraction of requests answered with a 429.")
+    parser.add_argument("--max_concurrent", type=int, default=0, help="Concurrent requests at which further requests get a 429.")
+    parser.add_argument("--error_fraction", type=float, default=0.0, help="Fraction of requests answered with a 500.")
+    parser.add_argument("--malformed_fraction", type=float, default=0.0, help="Fraction of unparseable answers.")
+    parser.add_argument("--response_format", choices=["json", "legacy"], default="json", help="Format of the canned answers.")
+    parser.add_argument("--label", type=int, default=1, help="Class value returned for every field.")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed.")
+
+def settings_from_args(args):
+    return MockSettings(args.latency, args.latency_median, args.latency_spread, args.slow_fraction, args.slow_factor,
+                        args.rate_limit_fraction, args.max_concurrent, args.error_fraction, args.malformed_fraction,
+                        args.response_format, args.label, args.seed)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local mock of the OpenAI chat completions API.")
+    parser.add_argument("--host", default="127.0.0.1", help="Interface to bind.")
+    parser.add_argument("--port", type=int, default=8000, help="Port to bind.")
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    server = MockChatServer(settings_from_args(args), args.host, args.port)
+    print(f"Mock OpenAI API listening on {server.api_base} (set REQUEST_CONTROL.api_base in config.json to use it)")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+        print(server.report())
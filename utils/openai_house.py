@@ -1,121 +1,94 @@
-import openai
-import base64
-import os
-import json
 import argparse
-from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor
-
-# Load API Keys from config.json
-def load_api_keys():
-    with open("config.json", "r") as file:
-        config = json.load(file)
-    return config["OPENAI_API_KEYS"]
+from image_preprocess import load_preprocess_settings
+from annotation_runner import run_annotation
+from structured_output import PredictionTask, json_instruction
+from chat_client import load_chat_client
+from green_index import GreenIndex, GREEN_INDEX_SOURCE, load_green_index_settings
+from pool_filter import PoolFilter, POOL_FILTER_SOURCE, load_pool_filter_settings
 
 # Configuration: Model IDs
 SWIMMING_POOL_MODEL = "ft:gpt-4o-2024-08-06:personal:swimmingpoolnew:AdCojiTM"
 ROOF_TYPE_MODEL = "ft:gpt-4o-2024-08-06:personal:rooftype:AVZlEsqs"
 GREEN_MODEL = "ft:gpt-4o-2024-08-06:personal:greenratio:AYqejz1M"
 
-# Function to set API key in a round-robin fashion
-api_keys = load_api_keys()
-api_key_index = 0
-def set_next_api_key():
-    global api_key_index
-    openai.api_key = api_keys[api_key_index]
-    api_key_index = (api_key_index + 1) % len(api_keys)
+# Answer fields of each model: JSON key -> (output column, lowest class, highest class)
+SWIMMING_POOL_FIELDS = {"Type": ("Swimming_Pool_Prediction", 0, 1)}
+ROOF_TYPE_FIELDS = {"Type_Class": ("Roof_Type_Prediction", 0, 2)}
+GREEN_FIELDS = {"Vegetation_Cover_Class": ("Green_Prediction", 0, 3)}
+
+# OpenAI client with round-robin API keys, per-call deadlines and optional hedging (see config.json)
+client = load_chat_client()
+
+# Image preprocessing settings for this stage (see IMAGE_PREPROCESS in config.json)
+preprocess_settings = load_preprocess_settings("house")
+
+# Vegetation cover computed from the image pixels (see GREEN_INDEX in config.json); scored per claimed image
+green_index = GreenIndex(load_green_index_settings())
 
-# Function to encode an image as a base64 string
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
+# Pixel pre-filter answering 'no pool' without the model (see POOL_FILTER in config.json); scored per claimed image
+pool_filter = PoolFilter(load_pool_filter_settings())
 
 # Generalized prediction function
-def predict(image_path, filename, model, system_prompt):
-    set_next_api_key()
-    base64_image = encode_image(image_path)
+def predict(payload, filename, model, system_prompt):
     messages = [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": f"Classify the image '{filename}'."},
-        {"role": "user", "content": [{"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}]}
+        {"role": "user", "content": [payload.image_content(preprocess_settings.detail_for(model))]}
     ]
-    response = openai.ChatCompletion.create(model=model, messages=messages)
+    response = client.create(model=model, messages=messages, response_format={"type": "json_object"})
     return response.choices[0].message["content"]
 
 # Wrapper functions for predictions
-def predict_swimming_pool(image_path, filename):
+def predict_swimming_pool(payload, filename):
     system_prompt = (
         "You are given a remote sensing image. Determine whether it has swimming pools (YES:1, NO:0). "
-        "Output: 'Filename: <filename>, Type: <1or0>'."
-    )
-    return predict(image_path, filename, SWIMMING_POOL_MODEL, system_prompt)
+    ) + json_instruction(SWIMMING_POOL_FIELDS)
+    return predict(payload, filename, SWIMMING_POOL_MODEL, system_prompt)
 
-def predict_roof_type(image_path, filename):
+def predict_roof_type(payload, filename):
     system_prompt = (
         "You are given a remote sensing image. Determine the roof type (0: flat, 1: gabled, 2: hipped). "
-        "Output: 'Filename: <filename>, Type_Class: <class>'."
-    )
-    return predict(image_path, filename, ROOF_TYPE_MODEL, system_prompt)
+    ) + json_instruction(ROOF_TYPE_FIELDS)
+    return predict(payload, filename, ROOF_TYPE_MODEL, system_prompt)
 
-def predict_green(image_path, filename):
+def predict_green(payload, filename):
     system_prompt = (
         "You are given a remote sensing image. Determine the vegetation cover density class "
-        "(0: 0-10%, 1: 10-30%, 2: 30-60%, 3: 60%+). Output: 'Filename: <filename>, Vegetation_Cover_Class: <class>'."
-    )
-    return predict(image_path, filename, GREEN_MODEL, system_prompt)
-
-# Worker function to process a single image
-def process_single_image(filename, input_dir, completed_files, output_jsonl, lock):
-    if filename in completed_files:
-        print(f"Skipping {filename}, already processed.")
-        return
-
-    image_path = os.path.join(input_dir, filename)
-
-    swimming_pool_prediction = predict_swimming_pool(image_path, filename)
-    roof_type_prediction = predict_roof_type(image_path, filename)
-    green_prediction = predict_green(image_path, filename)
-
-    record = {
-        "Filename": filename,
-        "Swimming_Pool_Prediction": swimming_pool_prediction,
-        "Roof_Type_Prediction": roof_type_prediction,
-        "Green_Prediction": green_prediction
-    }
-
-    with lock:
-        with open(output_jsonl, 'a') as jsonl_file:
-            jsonl_file.write(json.dumps(record) + "\n")
-        print(f"Processed {filename} - Swimming Pool: {swimming_pool_prediction}, Roof Type: {roof_type_prediction}, Green: {green_prediction}")
+        "(0: 0-10%, 1: 10-30%, 2: 30-60%, 3: 60%+). "
+    ) + json_instruction(GREEN_FIELDS)
+    return predict(payload, filename, GREEN_MODEL, system_prompt)
+
+# Images without any sizeable pool-blue region confidently have no pool
+def resolve_swimming_pool(filename):
+    if not pool_filter.resolve(filename):
+        return None
+    return {"Swimming_Pool_Prediction": 0}, POOL_FILTER_SOURCE
+
+# Vegetation cover class from the local green index, unless the mode or a near-boundary score asks for the model
+def resolve_green(filename):
+    green_class = green_index.resolve(filename)
+    if green_class is None:
+        return None
+    return {"Green_Prediction": green_class}, GREEN_INDEX_SOURCE
+
+# Prediction tasks run on every image: task name -> model call and parsed fields
+PREDICTION_TASKS = {
+    "Swimming_Pool_Prediction": PredictionTask(predict_swimming_pool, SWIMMING_POOL_FIELDS, resolve_swimming_pool,
+                                               "Swimming_Pool_Source"),
+    "Roof_Type_Prediction": PredictionTask(predict_roof_type, ROOF_TYPE_FIELDS),
+    "Green_Prediction": PredictionTask(predict_green, GREEN_FIELDS, resolve_green, "Green_Source")
+}
 
 # Main function to process images
-def process_images(input_dir, output_jsonl):
-    image_files = [f for f in os.listdir(input_dir) if f.endswith(('.jpg', '.png'))]
-
-    completed_files = set()
-    if os.path.exists(output_jsonl):
-        with open(output_jsonl, 'r') as jsonl_file:
-            for line in jsonl_file:
-                record = json.loads(line)
-                completed_files.add(record["Filename"])
-
-    from threading import Lock
-    lock = Lock()
-    with ThreadPoolExecutor() as executor:
-        futures = [
-            executor.submit(process_single_image, filename, input_dir, completed_files, output_jsonl, lock)
-            for filename in image_files
-        ]
-        for future in tqdm(futures, desc="Processing Images"):
-            try:
-                future.result()
-            except Exception as e:
-                print(f"Error processing file: {e}")
+def process_images(input_dir, output_jsonl, retry_failed=False):
+    with pool_filter.open(input_dir), green_index.open(input_dir):
+        run_annotation(input_dir, output_jsonl, PREDICTION_TASKS, preprocess_settings, client, retry_failed=retry_failed)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process images and export predictions.")
     parser.add_argument("--input_dir", required=True, help="Directory containing input images.")
     parser.add_argument("--output_jsonl", required=True, help="Path to save output JSONL file.")
+    parser.add_argument("--retry_failed", action="store_true", help="Retry tasks that failed permanently in a previous run.")
     args = parser.parse_args()
 
-    process_images(args.input_dir, args.output_jsonl)
+    process_images(args.input_dir, args.output_jsonl, args.retry_failed)
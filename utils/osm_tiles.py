@@ -0,0 +1,97 @@
+import os
+import json
+import math
+import time
+import requests
+
+# Overpass API endpoint, as used by Overpass.py
+OVERPASS_URL = "http://overpass-api.de/api/interpreter"
+
+# Default cache folder for OSM geometries, one file per kind of way and area tile
+OSM_CACHE_DIR = os.path.join("cache", "osm")
+
+# Metres per degree of latitude, and of longitude at the equator
+METRES_PER_DEGREE = 111320.0
+
+def tile_of(lat, lon, tile_size):
+    """Return the (row, column) of the square tile of `tile_size` degrees containing a point."""
+    return math.floor(lat / tile_size), math.floor(lon / tile_size)
+
+def tile_bbox(tile, tile_size, margin_meters):
+    """Return the (south, west, north, east) bounds of a tile, grown by a margin in metres."""
+    row, column = tile
+    south, west = row * tile_size, column * tile_size
+    north, east = south + tile_size, west + tile_size
+    margin_lat = margin_meters / METRES_PER_DEGREE
+    margin_lon = margin_meters / (METRES_PER_DEGREE * math.cos(math.radians(max(abs(south), abs(north)))))
+    return south - margin_lat, west - margin_lon, north + margin_lat, east + margin_lon
+
+# Group buildings ({'id', 'lat', 'lon', ...}) by the tile they fall in
+def group_by_tile(buildings, tile_size):
+    tiles = {}
+    for building in buildings:
+        tiles.setdefault(tile_of(building["lat"], building["lon"], tile_size), []).append(building)
+    return tiles
+
+def fetch_ways(selector, bbox, timeout=180, retries=3, backoff_factor=5.0):
+    """
+    Fetches the ways matching an Overpass tag selector in a bounding box, with their geometry.
+
+    Parameters:
+        selector (str): Overpass tag filter, e.g. '"highway"' or '"building"'.
+        bbox (tuple): (south, west, north, east) bounds.
+
+    Returns:
+        list: Ways as {"tags": dict, "coords": [[lat, lon], ...]}, or None if every attempt failed.
+    """
+    south, west, north, east = bbox
+    query = f"""
+    [out:json][timeout:{timeout}];
+    way[{selector}]({south},{west},{north},{east});
+    out geom;
+    """
+    for attempt in range(retries):
+        try:
+            response = requests.get(OVERPASS_URL, params={'data': query}, timeout=timeout + 30)
+            response.raise_for_status()
+            elements = response.json()['elements']
+            return [
+                {"tags": element.get("tags", {}), "coords": [[point["lat"], point["lon"]] for point in element["geometry"]]}
+                for element in elements if element.get("type") == "way" and element.get("geometry")
+            ]
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            print(f"Error fetching OSM ways ({selector}) for {bbox} (attempt {attempt + 1}): {e}")
+            time.sleep(backoff_factor * (2 ** attempt))
+    return None
+
+def load_tile_ways(kind, selector, tile, tile_size, margin_meters, cache_dir=OSM_CACHE_DIR):
+    """
+    Returns the ways of one tile, fetched from Overpass once and then read from the cache.
+
+    Returns:
+        list: Ways as {"tags": dict, "coords": [[lat, lon], ...]}, or None when they could not be fetched.
+    """
+    cache_file = os.path.join(cache_dir, f"{kind}_{tile_size}_{tile[0]}_{tile[1]}.json")
+    if os.path.exists(cache_file):
+        with open(cache_file, 'r', encoding='utf-8') as file:
+            return json.load(file)["ways"]
+
+    ways = fetch_ways(selector, tile_bbox(tile, tile_size, margin_meters))
+    if ways is None:
+        return None
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(temp_file, 'w', encoding='utf-8') as file:
+        json.dump({"ways": ways}, file)
+    os.replace(temp_file, cache_file)
+    return ways
+
+def read_buildings(base_file):
+    """Read the id, lat and lon of every building of a base data file."""
+    buildings = []
+    with open(base_file, 'r', encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                building = json.loads(line)
+                buildings.append({"id": int(building["id"]), "lat": building["lat"], "lon": building["lon"]})
+    return buildings
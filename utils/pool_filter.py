@@ -0,0 +1,261 @@
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+from structured_output import MODEL_SOURCE, MalformedPrediction, parse_prediction
+
+# Provenance of a swimming pool answer given by the pixel pre-filter
+POOL_FILTER_SOURCE = "pool_filter"
+
+# Result of the last calibration against model labels, required to enable the filter
+CALIBRATION_FILE = os.path.join("cache", "pool_filter_calibration.json")
+
+class PoolFilterSettings:
+    """
+    Settings of the swimming pool pre-filter.
+
+    A pixel is pool blue when it is bright and its blue and green channels clearly exceed the red one.
+    The score of an image is the area, as a fraction of the image, of its largest connected region of
+    pool-blue pixels. Images scoring below `min_score` are recorded as having no pool without asking
+    the model; `min_score` should be tuned for recall with the calibration mode of this script. The
+    filter is only accepted once that calibration has measured, for the current settings, a recall of
+    at least `target_recall` at `min_score`, over at least `min_pools` labelled pools.
+
+    Parameters:
+        enabled (bool): Whether the pre-filter is used.
+        min_score (float): Largest-region fraction from which an image is sent to the pool model.
+        blue_over_red (int): Minimum blue minus red channel difference.
+        green_over_red (int): Minimum green minus red channel difference.
+        min_brightness (int): Minimum sum of the three channels, to leave out dark water and shadows.
+        sample_size (int): Approximate longest side the image is decoded at before scoring.
+        target_recall (float): Calibrated share of labelled pools the filter must send to the model.
+        min_pools (int): Labelled pools the calibration needs for its recall to be trusted.
+        max_workers (int): Processes scoring images (defaults to the CPU count).
+    """
+
+    def __init__(self, enabled=False, min_score=0.0005, blue_over_red=40, green_over_red=15, min_brightness=300,
+                 sample_size=128, target_recall=0.98, min_pools=20, max_workers=None):
+        self.enabled = enabled
+        self.min_score = min_score
+        self.blue_over_red = blue_over_red
+        self.green_over_red = green_over_red
+        self.min_brightness = min_brightness
+        self.sample_size = int(sample_size)
+        self.target_recall = target_recall
+        self.min_pools = min_pools
+        self.max_workers = max_workers
+
+    def score_parameters(self):
+        """Return the settings a calibration is valid for."""
+        return {"blue_over_red": self.blue_over_red, "green_over_red": self.green_over_red,
+                "min_brightness": self.min_brightness, "sample_size": self.sample_size}
+
+    def check_calibration(self, calibration_file=CALIBRATION_FILE):
+        """Raise ValueError unless an enabled filter was calibrated to reach the target recall."""
+        if not self.enabled:
+            return
+        hint = "run `python utils/pool_filter.py --input_dir ... --labels_jsonl ...` to calibrate it"
+        if not os.path.exists(calibration_file):
+            raise ValueError(f"POOL_FILTER can only be enabled after a calibration against model labels; {hint}")
+        with open(calibration_file, "r") as file:
+            calibration = json.load(file)
+        if calibration.get("parameters") != self.score_parameters():
+            raise ValueError(f"The pool filter calibration was made with other settings; {hint}")
+        if calibration.get("pools", 0) < self.min_pools:
+            raise ValueError(f"The pool filter was calibrated on {calibration.get('pools', 0)} labelled pools, fewer than "
+                             f"min_pools {self.min_pools}; calibrate it on a city with more pools")
+        recall = next((entry["recall"] for entry in calibration.get("thresholds", [])
+                       if abs(entry["min_score"] - self.min_score) < 1e-12), None)
+        if recall is None:
+            raise ValueError(f"The pool filter was not calibrated for min_score {self.min_score}; {hint}")
+        if recall < self.target_recall:
+            raise ValueError(f"POOL_FILTER min_score {self.min_score} keeps {recall:.1%} of the labelled pools, "
+                             f"below target_recall {self.target_recall:.0%}; lower min_score or keep it disabled")
+
+# Load the pool filter settings from config.json
+def load_pool_filter_settings(config_path="config.json"):
+    with open(config_path, "r") as file:
+        config = json.load(file)
+    settings = PoolFilterSettings(**config.get("POOL_FILTER", {}))
+    settings.check_calibration()
+    return settings
+
+def pool_blue_mask(pixels, blue_over_red=40, green_over_red=15, min_brightness=300):
+    """Return the boolean mask of pool-blue pixels of a uint8 RGB array."""
+    red = pixels[..., 0].astype(np.int16)
+    green = pixels[..., 1].astype(np.int16)
+    blue = pixels[..., 2].astype(np.int16)
+    return (blue - red >= blue_over_red) & (green - red >= green_over_red) & (red + green + blue >= min_brightness)
+
+def largest_component(mask):
+    """
+    Returns the pixel count of the largest 4-connected region of a boolean mask.
+
+    Regions are labelled by propagating the smallest pixel index to the neighbours, with pointer
+    jumping so the number of passes grows with the logarithm of the region size.
+    """
+    if not mask.any():
+        return 0
+    # Label only the bounding box of the pool-blue pixels
+    rows = np.flatnonzero(mask.any(axis=1))
+    columns = np.flatnonzero(mask.any(axis=0))
+    mask = mask[rows[0]:rows[-1] + 1, columns[0]:columns[-1] + 1]
+    height, width = mask.shape
+    empty = height * width
+    labels = np.where(mask, np.arange(empty, dtype=np.int32).reshape(height, width), empty)
+    while True:
+        padded = np.pad(labels, 1, constant_values=empty)
+        neighbours = np.minimum.reduce([padded[1:-1, 1:-1], padded[:-2, 1:-1], padded[2:, 1:-1],
+                                        padded[1:-1, :-2], padded[1:-1, 2:]])
+        # Jump to the label of the pixel a label points at, which lies in the same region
+        flat = np.append(neighbours.ravel(), np.int32(empty))
+        updated = np.where(mask, flat[flat[:-1]].reshape(height, width), empty)
+        if np.array_equal(updated, labels):
+            break
+        labels = updated
+    return int(np.bincount(labels[mask]).max())
+
+def score_image(image_path, settings):
+    """Return the largest pool-blue region of an image as a fraction of its area, or None when it cannot be read."""
+    try:
+        with Image.open(image_path) as image:
+            image.draft("RGB", (settings.sample_size, settings.sample_size))
+            pixels = np.asarray(image.convert("RGB"))
+    except OSError:
+        return None
+    mask = pool_blue_mask(pixels, settings.blue_over_red, settings.green_over_red, settings.min_brightness)
+    return largest_component(mask) / mask.size
+
+def _score_batch(image_paths, settings):
+    return [score_image(path, settings) for path in image_paths]
+
+def score_images(image_paths, settings, batch_size=64):
+    """
+    Scores images in a process pool.
+
+    Returns:
+        dict: Image path -> pool score, or None for unreadable images.
+    """
+    batches = [image_paths[i:i + batch_size] for i in range(0, len(image_paths), batch_size)]
+    scores = {}
+    with ProcessPoolExecutor(max_workers=settings.max_workers) as executor:
+        futures = [executor.submit(_score_batch, batch, settings) for batch in batches]
+        for batch, future in zip(batches, futures):
+            scores.update(zip(batch, future.result()))
+    return scores
+
+class PoolFilter:
+    """
+    Swimming pool pre-filter over the images of a directory.
+
+    Images are scored when a worker claims them, in a process pool opened with `open`, so images
+    already annotated in an earlier run are never read.
+
+    Parameters:
+        settings (PoolFilterSettings): Filter settings.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.input_dir = None
+        self.executor = None
+
+    def open(self, input_dir):
+        """Start scoring the images of a directory, when the filter is enabled."""
+        self.input_dir = input_dir
+        if self.settings.enabled and self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.settings.max_workers)
+        return self
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def resolve(self, filename):
+        """
+        Returns:
+            bool: True when the image confidently has no pool, False when the model has to be asked.
+        """
+        if not self.settings.enabled or self.executor is None:
+            return False
+        score = self.executor.submit(score_image, os.path.join(self.input_dir, filename), self.settings).result()
+        return score is not None and score < self.settings.min_score
+
+# Read swimming pool labels from a house annotation file, typed or in the legacy text format
+def load_pool_labels(labels_jsonl):
+    fields = {"Type": ("Swimming_Pool_Prediction", 0, 1)}
+    labels = {}
+    with open(labels_jsonl, 'r', encoding='utf-8') as file:
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            # Only model answers are ground truth; the filter's own zeros would inflate its recall
+            if record.get("Swimming_Pool_Source", MODEL_SOURCE) != MODEL_SOURCE:
+                continue
+            value = record.get("Swimming_Pool_Prediction")
+            if isinstance(value, int):
+                labels[record["Filename"]] = value
+                continue
+            try:
+                labels[record["Filename"]] = parse_prediction(value, fields)["Swimming_Pool_Prediction"]
+            except (MalformedPrediction, KeyError):
+                continue
+    return labels
+
+def calibrate(input_dir, labels_jsonl, settings, target_recall=None, calibration_file=CALIBRATION_FILE):
+    """
+    Reports the filter's recall and the share of images it sends to the model for a range of thresholds,
+    against existing pool labels, suggests the highest `min_score` reaching `target_recall` and records
+    the recall of every threshold so the filter can be enabled.
+    """
+    target_recall = settings.target_recall if target_recall is None else target_recall
+    labels = load_pool_labels(labels_jsonl)
+    filenames = [name for name in labels if os.path.exists(os.path.join(input_dir, name))]
+    scores = score_images([os.path.join(input_dir, name) for name in filenames], settings)
+    scores = {name: scores[os.path.join(input_dir, name)] or 0.0 for name in filenames}
+    positives = [scores[name] for name in filenames if labels[name] == 1]
+    print(f"{len(filenames)} labelled images, {len(positives)} with a pool")
+    if not positives:
+        print("No labelled pools; recall cannot be measured.")
+        return None
+
+    thresholds = sorted(set([0.0, settings.min_score] + positives + [0.0001, 0.0005, 0.001, 0.002, 0.005, 0.01]))
+    suggested = 0.0
+    results = []
+    for threshold in thresholds:
+        recall = sum(1 for score in positives if score >= threshold) / len(positives)
+        sent = sum(1 for score in scores.values() if score >= threshold) / len(scores)
+        results.append({"min_score": threshold, "recall": recall, "sent": sent})
+        print(f"min_score {threshold:.5f}: recall {recall:.1%}, {sent:.1%} of images sent to the model")
+        if recall >= target_recall:
+            suggested = max(suggested, threshold)
+    os.makedirs(os.path.dirname(calibration_file), exist_ok=True)
+    with open(calibration_file, "w") as file:
+        json.dump({"parameters": settings.score_parameters(), "labelled": len(filenames), "pools": len(positives),
+                   "thresholds": results}, file, indent=2)
+    print(f"Suggested min_score for {target_recall:.0%} recall: {suggested:.5f}")
+    print(f"Calibration saved to {calibration_file}")
+    return suggested
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate the swimming pool pre-filter against existing labels.")
+    parser.add_argument("--input_dir", required=True, help="Directory containing Mapbox house images.")
+    parser.add_argument("--labels_jsonl", required=True, help="Existing _house.jsonl annotation file.")
+    parser.add_argument("--target_recall", type=float, default=None,
+                        help="Recall the suggested threshold must reach (default: target_recall of POOL_FILTER).")
+    args = parser.parse_args()
+
+    # Calibration does not need the filter to be enabled or calibrated
+    with open("config.json", "r") as config_file:
+        calibrate(args.input_dir, args.labels_jsonl, PoolFilterSettings(**json.load(config_file).get("POOL_FILTER", {})),
+                  args.target_recall)
@@ -3,11 +3,12 @@ import folium
 from branca.colormap import StepColormap
 import os
 import argparse
+from dataset_store import final_dataset_file, read_dataset
 
 def process_swimming_pool_map(base_file):
     # Generate the actual file to process based on input file
     base_name = os.path.splitext(os.path.basename(base_file))[0]
-    actual_file = os.path.join("output", base_name, f"{base_name}_final.jsonl")
+    actual_file = final_dataset_file(base_name)
 
     if not os.path.exists(actual_file):
         print(f"Expected file {actual_file} does not exist. Please ensure it is generated.")
@@ -18,8 +19,8 @@ def process_swimming_pool_map(base_file):
     os.makedirs(output_folder, exist_ok=True)
     output_file = os.path.join(output_folder, f"{base_name}_SwimmingPool.html")
 
-    # Read the JSONL file
-    data = pd.read_json(actual_file, lines=True)
+    # Read only the columns the map needs from the final dataset (JSONL, Parquet or Arrow)
+    data = read_dataset(actual_file, columns=['lat', 'lon', 'Swimming_Pool_Prediction'])
 
     # Ensure required columns exist
     required_columns = {'lat', 'lon', 'Swimming_Pool_Prediction'}
@@ -0,0 +1,125 @@
+import os
+import json
+import time
+import queue
+import threading
+
+def truncate_torn_tail(path):
+    """
+    Removes a partial last line left by a crash in the middle of a write.
+
+    Returns:
+        int: Number of bytes removed.
+    """
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'rb+') as file:
+        size = file.seek(0, os.SEEK_END)
+        position = size
+        # Walk back block by block to the last newline
+        while position > 0:
+            block_start = max(0, position - 65536)
+            file.seek(block_start)
+            block = file.read(position - block_start)
+            newline = block.rfind(b"\n")
+            if newline != -1:
+                position = block_start + newline + 1
+                break
+            position = block_start
+        if position < size:
+            file.truncate(position)
+        return size - position
+
+def read_records_from(path, offset):
+    """Yield the JSON records of a JSONL file starting at a byte offset."""
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+class ResultSink:
+    """
+    Single writer thread appending records to a JSONL file.
+
+    Workers hand records over through a queue. The writer appends them in batches, flushes and
+    fsyncs each batch, and only then reports the batch through `on_written`, together with the
+    file offset it ends at. A crash can therefore only leave a partial last line, which
+    `truncate_torn_tail` removes before the file is read again.
+
+    Parameters:
+        path (str): Output JSONL file.
+        on_written (callable): Called with (filenames, end offset) after each durable batch.
+        batch_size (int): Maximum number of records per write.
+        flush_interval (float): Seconds a record may wait before its batch is written.
+        fsync (bool): Whether each batch is fsynced to disk.
+    """
+
+    def __init__(self, path, on_written=None, batch_size=256, flush_interval=1.0, fsync=True):
+        self.path = path
+        self.on_written = on_written
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.records = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="result-sink", daemon=True)
+        self.thread.start()
+
+    def put(self, record, message=None):
+        """Queue a record for writing, with an optional console message printed once it is durable."""
+        if self.error is not None:
+            raise RuntimeError(f"Result writer failed: {self.error}")
+        self.records.put((record, message))
+
+    def close(self):
+        """Write the remaining records and stop the writer thread."""
+        self.records.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise RuntimeError(f"Result writer failed: {self.error}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write_batch(self, file, batch):
+        file.write("".join(json.dumps(record) + "\n" for record, _ in batch).encode("utf-8"))
+        file.flush()
+        if self.fsync:
+            os.fsync(file.fileno())
+        if self.on_written is not None:
+            self.on_written([record["Filename"] for record, _ in batch], file.tell())
+        messages = [message for _, message in batch if message]
+        if messages:
+            print("\n".join(messages))
+
+    def _run(self):
+        try:
+            with open(self.path, 'ab') as file:
+                batch = []
+                deadline = None
+                while True:
+                    timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                    try:
+                        item = self.records.get(timeout=timeout)
+                    except queue.Empty:
+                        item = ()
+                    if item is None:
+                        if batch:
+                            self._write_batch(file, batch)
+                        return
+                    if item:
+                        batch.append(item)
+                        if deadline is None:
+                            deadline = time.monotonic() + self.flush_interval
+                    if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                        self._write_batch(file, batch)
+                        batch = []
+                        deadline = None
+        except Exception as e:
+            self.error = e
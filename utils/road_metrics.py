@@ -0,0 +1,357 @@
+import os
+import json
+import math
+import time
+import bisect
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from osm_tiles import METRES_PER_DEGREE, OSM_CACHE_DIR, group_by_tile, load_tile_ways, read_buildings
+from structured_output import MalformedPrediction, filename_to_id, parse_prediction
+
+# Provenance of road metrics computed from OSM road geometry
+ROAD_METRICS_SOURCE = "osm_roads"
+
+# Result of the last calibration against model labels, required to enable the metrics
+CALIBRATION_FILE = os.path.join("cache", "road_metrics_calibration.json")
+
+# Typical carriageway width in metres of each OSM highway type
+ROAD_WIDTHS = {
+    "motorway": 24, "trunk": 20, "primary": 16, "secondary": 13, "tertiary": 11, "unclassified": 8,
+    "residential": 8, "living_street": 6, "service": 5, "pedestrian": 5, "track": 4, "road": 8,
+    "motorway_link": 8, "trunk_link": 8, "primary_link": 8, "secondary_link": 7, "tertiary_link": 7,
+    "footway": 2, "path": 2, "cycleway": 2, "steps": 2, "bridleway": 2, "corridor": 2
+}
+
+# Highway types that are not part of the road network seen from above
+PATH_TYPES = {"footway", "path", "cycleway", "steps", "bridleway", "corridor", "proposed", "construction", "elevator", "platform"}
+
+class RoadMetricsSettings:
+    """
+    Settings of the local road metrics.
+
+    Roads are buffered by the width of their highway type and rasterized on a `grid_size` square grid
+    over a `window_meters` window centred on each building, the same extent as the Mapbox neighbor
+    image. The road coverage ratio (RCR) is the covered share of the window. The fractal dimension (FD)
+    is the box-counting dimension of the road centrelines. Both are mapped to the model's 0-3 classes.
+
+    The metrics can only be enabled once the calibration mode of this script has measured, for the
+    current settings, an agreement of both classes with existing model labels of at least `min_agreement`.
+
+    Parameters:
+        enabled (bool): Whether the road model is replaced by the local metrics.
+        window_meters (float): Side of the neighborhood window.
+        grid_size (int): Cells per side of the raster (a power of two).
+        tile_size (float): Side in degrees of the tiles road geometry is fetched and cached by.
+        rcr_bounds (list): Coverage ratios separating the RCR classes.
+        fd_bounds (list): Fractal dimensions separating the FD classes.
+        include_paths (bool): Whether footways, paths and cycleways count as roads.
+        default_width (float): Width in metres of highway types missing from ROAD_WIDTHS.
+        min_agreement (float): Calibrated agreement with the model labels both classes must reach.
+        max_workers (int): Processes computing windows (defaults to the CPU count).
+    """
+
+    def __init__(self, enabled=False, window_meters=500, grid_size=256, tile_size=0.05, rcr_bounds=(0.10, 0.30, 0.50),
+                 fd_bounds=(1.2, 1.4, 1.6), include_paths=False, default_width=6, min_agreement=0.8, max_workers=None):
+        # Box counting halves the grid down to boxes of 2 cells, over at least two box sizes
+        if int(grid_size) < 8 or int(grid_size) & (int(grid_size) - 1):
+            raise ValueError(f"Road metrics grid_size must be a power of two of at least 8: {grid_size}")
+        self.enabled = enabled
+        self.window_meters = window_meters
+        self.grid_size = int(grid_size)
+        self.tile_size = tile_size
+        self.rcr_bounds = list(rcr_bounds)
+        self.fd_bounds = list(fd_bounds)
+        self.include_paths = include_paths
+        self.default_width = default_width
+        self.min_agreement = min_agreement
+        self.max_workers = max_workers
+
+    def metric_parameters(self):
+        """Return the settings a calibration is valid for."""
+        return {"window_meters": self.window_meters, "grid_size": self.grid_size, "rcr_bounds": self.rcr_bounds,
+                "fd_bounds": self.fd_bounds, "include_paths": self.include_paths, "default_width": self.default_width}
+
+    def check_calibration(self, calibration_file=CALIBRATION_FILE):
+        """Raise ValueError unless enabled metrics were calibrated to agree enough with the model."""
+        if not self.enabled:
+            return
+        hint = "run `python utils/road_metrics.py --calibrate --base_file ... --labels_jsonl ...` to calibrate them"
+        if not os.path.exists(calibration_file):
+            raise ValueError(f"ROAD_METRICS can only be enabled after a calibration against model labels; {hint}")
+        with open(calibration_file, "r") as file:
+            calibration = json.load(file)
+        if calibration.get("parameters") != self.metric_parameters():
+            raise ValueError(f"The road metrics calibration was made with other settings; {hint}")
+        for name, agreement in calibration["agreement"].items():
+            if agreement < self.min_agreement:
+                raise ValueError(f"Road {name} classes agree with the model labels on {agreement:.1%} of the buildings, "
+                                 f"below min_agreement {self.min_agreement:.0%}; keep ROAD_METRICS disabled "
+                                 f"or use the suggested bounds")
+
+# Load the road metrics settings from config.json
+def load_road_metrics_settings(config_path="config.json"):
+    with open(config_path, "r") as file:
+        config = json.load(file)
+    settings = RoadMetricsSettings(**config.get("ROAD_METRICS", {}))
+    settings.check_calibration()
+    return settings
+
+def road_segments(ways, settings):
+    """
+    Splits road ways into straight segments.
+
+    Returns:
+        tuple: (segments, half_widths) arrays; each segment row is (lat1, lon1, lat2, lon2).
+    """
+    segments = []
+    half_widths = []
+    for way in ways:
+        highway = way["tags"].get("highway")
+        if highway is None or (not settings.include_paths and highway in PATH_TYPES):
+            continue
+        coords = np.asarray(way["coords"], dtype=np.float64)
+        if len(coords) < 2:
+            continue
+        segments.append(np.hstack([coords[:-1], coords[1:]]))
+        half_widths.append(np.full(len(coords) - 1, ROAD_WIDTHS.get(highway, settings.default_width) / 2.0))
+    if not segments:
+        return np.empty((0, 4)), np.empty(0)
+    return np.vstack(segments), np.concatenate(half_widths)
+
+def rasterize_segments(segments, half_widths, cell_size, grid_size):
+    """
+    Rasterizes segments given in window coordinates (metres from the window's lower-left corner).
+
+    Every segment only touches the cells of its own bounding box, grown by its half width, where the
+    distance from each cell centre to the segment is computed at once.
+
+    Returns:
+        tuple: (coverage, centreline) boolean grids of shape (grid_size, grid_size).
+    """
+    coverage = np.zeros((grid_size, grid_size), dtype=bool)
+    centreline = np.zeros((grid_size, grid_size), dtype=bool)
+    line_radius = cell_size * 0.75
+    for (x1, y1, x2, y2), half_width in zip(segments, half_widths):
+        reach = max(half_width, line_radius)
+        i0 = max(0, int((min(y1, y2) - reach) / cell_size))
+        i1 = min(grid_size, int((max(y1, y2) + reach) / cell_size) + 1)
+        j0 = max(0, int((min(x1, x2) - reach) / cell_size))
+        j1 = min(grid_size, int((max(x1, x2) + reach) / cell_size) + 1)
+        if i0 >= i1 or j0 >= j1:
+            continue
+        ys = (np.arange(i0, i1) + 0.5)[:, None] * cell_size
+        xs = (np.arange(j0, j1) + 0.5)[None, :] * cell_size
+        dx, dy = x2 - x1, y2 - y1
+        length2 = dx * dx + dy * dy
+        if length2 > 0:
+            t = np.clip(((xs - x1) * dx + (ys - y1) * dy) / length2, 0.0, 1.0)
+        else:
+            t = 0.0
+        distance2 = (xs - x1 - t * dx) ** 2 + (ys - y1 - t * dy) ** 2
+        coverage[i0:i1, j0:j1] |= distance2 <= half_width * half_width
+        centreline[i0:i1, j0:j1] |= distance2 <= line_radius * line_radius
+    return coverage, centreline
+
+def box_counting_dimension(mask, min_box=2):
+    """Return the box-counting dimension of a square boolean grid, or 0.0 when it is empty."""
+    if not mask.any():
+        return 0.0
+    size = mask.shape[0]
+    box_sizes = []
+    counts = []
+    box = min_box
+    while box <= size // 4:
+        blocks = mask.reshape(size // box, box, size // box, box).any(axis=(1, 3))
+        box_sizes.append(box)
+        counts.append(np.count_nonzero(blocks))
+        box *= 2
+    slope = np.polyfit(np.log(1.0 / np.asarray(box_sizes)), np.log(np.asarray(counts)), 1)[0]
+    return float(slope)
+
+def window_metrics(lat, lon, segments, half_widths, settings):
+    """
+    Computes the road coverage ratio and fractal dimension of the window centred on a building.
+
+    Returns:
+        tuple: (coverage ratio, fractal dimension).
+    """
+    half_window = settings.window_meters / 2.0
+    metres_per_lon = METRES_PER_DEGREE * math.cos(math.radians(lat))
+    # Local equirectangular projection, in metres from the window's lower-left corner
+    y1 = (segments[:, 0] - lat) * METRES_PER_DEGREE + half_window
+    x1 = (segments[:, 1] - lon) * metres_per_lon + half_window
+    y2 = (segments[:, 2] - lat) * METRES_PER_DEGREE + half_window
+    x2 = (segments[:, 3] - lon) * metres_per_lon + half_window
+    reach = half_widths
+    inside = ((np.maximum(x1, x2) + reach >= 0) & (np.minimum(x1, x2) - reach <= settings.window_meters) &
+              (np.maximum(y1, y2) + reach >= 0) & (np.minimum(y1, y2) - reach <= settings.window_meters))
+    local = np.column_stack([x1, y1, x2, y2])[inside]
+    cell_size = settings.window_meters / settings.grid_size
+    coverage, centreline = rasterize_segments(local, half_widths[inside], cell_size, settings.grid_size)
+    return float(coverage.mean()), box_counting_dimension(centreline)
+
+def _tile_metrics(buildings, ways, settings):
+    segments, half_widths = road_segments(ways, settings)
+    return [(building["id"],) + window_metrics(building["lat"], building["lon"], segments, half_widths, settings)
+            for building in buildings]
+
+def compute_road_metrics(buildings, settings, cache_dir=OSM_CACHE_DIR):
+    """
+    Computes road metrics for buildings, fetching the road geometry of each tile once.
+
+    Parameters:
+        buildings (list): Buildings as {"id", "lat", "lon"}.
+        settings (RoadMetricsSettings): Metric settings.
+
+    Returns:
+        dict: Building id -> (coverage ratio, fractal dimension); buildings of tiles whose roads
+        could not be fetched are missing.
+    """
+    metrics = {}
+    start = time.monotonic()
+    with ProcessPoolExecutor(max_workers=settings.max_workers) as executor:
+        futures = []
+        for tile, tile_buildings in group_by_tile(buildings, settings.tile_size).items():
+            ways = load_tile_ways("roads", '"highway"', tile, settings.tile_size, settings.window_meters, cache_dir)
+            if ways is None:
+                print(f"No road geometry for tile {tile}; its {len(tile_buildings)} buildings are left to the model.")
+                continue
+            # Large tiles are split so the windows spread over the pool
+            for i in range(0, len(tile_buildings), 256):
+                futures.append(executor.submit(_tile_metrics, tile_buildings[i:i + 256], ways, settings))
+        for future in futures:
+            for building_id, coverage, fractal_dimension in future.result():
+                metrics[building_id] = (coverage, fractal_dimension)
+    print(f"Computed road metrics of {len(metrics)} buildings in {time.monotonic() - start:.1f}s")
+    return metrics
+
+def road_classes(coverage, fractal_dimension, settings):
+    """Map a coverage ratio and fractal dimension to the RCR and FD classes."""
+    return {"RCR": bisect.bisect_right(settings.rcr_bounds, coverage),
+            "FD": bisect.bisect_right(settings.fd_bounds, fractal_dimension)}
+
+class RoadMetrics:
+    """
+    RCR and FD classes of the buildings of a base data file, computed from OSM roads.
+
+    Parameters:
+        settings (RoadMetricsSettings): Metric settings.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.metrics = {}
+
+    def compute(self, base_file):
+        """Compute the metrics of every building of the base data file, when enabled."""
+        if not self.settings.enabled:
+            return
+        if base_file is None or not os.path.exists(base_file):
+            print(f"Base data file not found ({base_file}); road classes are asked from the model.")
+            return
+        self.metrics = compute_road_metrics(read_buildings(base_file), self.settings)
+
+    def resolve(self, building_id):
+        """
+        Returns:
+            dict: RCR and FD classes, or None when the model has to be asked.
+        """
+        if building_id not in self.metrics:
+            return None
+        return road_classes(*self.metrics[building_id], self.settings)
+
+# Read RCR and FD labels from a neighbor annotation file, typed or in the legacy text format
+def load_road_labels(labels_jsonl):
+    fields = {"RCR": ("RCR", 0, 3), "FD": ("FD", 0, 3)}
+    labels = {}
+    with open(labels_jsonl, 'r', encoding='utf-8') as file:
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            # Only model answers are ground truth; classes from an earlier local run are left out
+            if record.get("Road_Source", "model") != "model":
+                continue
+            try:
+                building_id = filename_to_id(record["Filename"])
+                if isinstance(record.get("RCR"), int) and isinstance(record.get("FD"), int):
+                    labels[building_id] = {"RCR": record["RCR"], "FD": record["FD"]}
+                else:
+                    labels[building_id] = parse_prediction(record.get("Road_Prediction"), fields)
+            except (MalformedPrediction, KeyError, ValueError):
+                continue
+    return labels
+
+def matching_bounds(values, labels, classes=4):
+    """Return the bounds that give the metric values the same class shares as the labels."""
+    values = np.asarray(values, dtype=np.float64)
+    labels = np.asarray(labels)
+    shares = [np.mean(labels < k) for k in range(1, classes)]
+    return [round(float(np.quantile(values, share)), 4) for share in shares]
+
+def calibrate(base_file, labels_jsonl, settings, calibration_file=CALIBRATION_FILE):
+    """
+    Compares the RCR and FD classes of the local metrics with existing model labels, suggests the
+    bounds giving both the label class shares, and records the agreement so the metrics can be enabled.
+
+    Returns:
+        dict: Agreement of the RCR and FD classes with the labels, or None when nothing could be compared.
+    """
+    labels = load_road_labels(labels_jsonl)
+    buildings = [building for building in read_buildings(base_file) if building["id"] in labels]
+    metrics = compute_road_metrics(buildings, settings)
+    compared = [building_id for building_id in labels if building_id in metrics]
+    print(f"{len(compared)} labelled buildings with road geometry")
+    if not compared:
+        print("No labelled buildings with road geometry; agreement cannot be measured.")
+        return None
+
+    agreement = {}
+    for index, (name, bounds_key) in enumerate((("RCR", "rcr_bounds"), ("FD", "fd_bounds"))):
+        values = [metrics[building_id][index] for building_id in compared]
+        expected = [labels[building_id][name] for building_id in compared]
+        bounds = getattr(settings, bounds_key)
+        suggested = matching_bounds(values, expected)
+        agreement[name] = np.mean([bisect.bisect_right(bounds, value) == label for value, label in zip(values, expected)])
+        suggested_agreement = np.mean([bisect.bisect_right(suggested, value) == label
+                                       for value, label in zip(values, expected)])
+        print(f"{name}: {agreement[name]:.1%} agreement with {bounds_key} {bounds}; "
+              f"{suggested_agreement:.1%} with suggested {bounds_key} {suggested}")
+        agreement[name] = float(agreement[name])
+
+    os.makedirs(os.path.dirname(calibration_file), exist_ok=True)
+    with open(calibration_file, "w") as file:
+        json.dump({"parameters": settings.metric_parameters(), "labelled": len(compared), "agreement": agreement},
+                  file, indent=2)
+    if min(agreement.values()) < settings.min_agreement:
+        print(f"Agreement is below {settings.min_agreement:.0%}; keep ROAD_METRICS disabled or use the suggested bounds.")
+    print(f"Calibration saved to {calibration_file}")
+    return agreement
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute road coverage ratio and fractal dimension from OSM roads.")
+    parser.add_argument("--base_file", required=True, help="Base data file, e.g. Data/NewYork_United States_100.jsonl.")
+    parser.add_argument("--output_jsonl", help="Path to save the road metrics JSONL file.")
+    parser.add_argument("--calibrate", action="store_true", help="Compare the road classes with existing labels instead.")
+    parser.add_argument("--labels_jsonl", help="Existing _neighbor.jsonl annotation file to calibrate against.")
+    args = parser.parse_args()
+
+    if args.calibrate and not args.labels_jsonl:
+        parser.error("--calibrate requires --labels_jsonl")
+    if not args.calibrate and not args.output_jsonl:
+        parser.error("--output_jsonl is required unless --calibrate is given")
+
+    # Raw metrics and calibration do not need the metrics to be enabled or calibrated
+    with open("config.json", "r") as config_file:
+        settings = RoadMetricsSettings(**json.load(config_file).get("ROAD_METRICS", {}))
+    if args.calibrate:
+        calibrate(args.base_file, args.labels_jsonl, settings)
+    else:
+        metrics = compute_road_metrics(read_buildings(args.base_file), settings)
+        with open(args.output_jsonl, 'w', encoding='utf-8') as file:
+            for building_id, (coverage, fractal_dimension) in metrics.items():
+                record = {"id": building_id, **road_classes(coverage, fractal_dimension, settings),
+                          "Road_Coverage": round(coverage, 4), "Road_FD": round(fractal_dimension, 4)}
+                file.write(json.dumps(record) + "\n")
+        print(f"Road metrics saved to {args.output_jsonl}")
@@ -0,0 +1,69 @@
+import math
+import numpy as np
+
+class GridIndex:
+    """
+    Uniform grid index over points in metric coordinates.
+
+    Points are bucketed by the square cell of `cell_size` metres they fall in, so box queries and
+    nearest-neighbour searches only look at the cells around them.
+
+    Parameters:
+        xs (numpy.ndarray): Point x coordinates in metres.
+        ys (numpy.ndarray): Point y coordinates in metres.
+        cell_size (float): Side of a grid cell in metres.
+    """
+
+    def __init__(self, xs, ys, cell_size):
+        self.xs = np.asarray(xs, dtype=np.float64)
+        self.ys = np.asarray(ys, dtype=np.float64)
+        self.cell_size = float(cell_size)
+        columns = np.floor(self.xs / self.cell_size).astype(np.int64)
+        rows = np.floor(self.ys / self.cell_size).astype(np.int64)
+        order = np.lexsort((rows, columns))
+        self.cells = {}
+        if len(order):
+            keys = np.column_stack([columns[order], rows[order]])
+            starts = np.flatnonzero(np.any(np.diff(keys, axis=0) != 0, axis=1)) + 1
+            for block in np.split(order, starts):
+                self.cells[(int(columns[block[0]]), int(rows[block[0]]))] = block
+
+    def __len__(self):
+        return len(self.xs)
+
+    def cell_of(self, x, y):
+        """Return the (column, row) of the cell containing a point."""
+        return math.floor(x / self.cell_size), math.floor(y / self.cell_size)
+
+    def _gather(self, column_range, row_range):
+        blocks = [self.cells[(column, row)] for column in column_range for row in row_range if (column, row) in self.cells]
+        return np.concatenate(blocks) if blocks else np.empty(0, dtype=np.int64)
+
+    def query_box(self, xmin, ymin, xmax, ymax):
+        """Return the indices of the points inside a box."""
+        column0, row0 = self.cell_of(xmin, ymin)
+        column1, row1 = self.cell_of(xmax, ymax)
+        candidates = self._gather(range(column0, column1 + 1), range(row0, row1 + 1))
+        xs, ys = self.xs[candidates], self.ys[candidates]
+        return candidates[(xs >= xmin) & (xs <= xmax) & (ys >= ymin) & (ys <= ymax)]
+
+    def nearest_distances(self, max_distance):
+        """
+        Returns the distance from every point to its nearest other point.
+
+        Each cell is compared at once with the cells within `max_distance` of it.
+
+        Returns:
+            numpy.ndarray: Distances, inf for points with no other point within `max_distance`.
+        """
+        distances = np.full(len(self.xs), np.inf)
+        reach = int(math.ceil(max_distance / self.cell_size))
+        for (column, row), members in self.cells.items():
+            candidates = self._gather(range(column - reach, column + reach + 1), range(row - reach, row + reach + 1))
+            dx = self.xs[members][:, None] - self.xs[candidates][None, :]
+            dy = self.ys[members][:, None] - self.ys[candidates][None, :]
+            squared = dx * dx + dy * dy
+            squared[members[:, None] == candidates[None, :]] = np.inf
+            distances[members] = np.sqrt(squared.min(axis=1))
+        distances[distances > max_distance] = np.inf
+        return distances
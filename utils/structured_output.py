@@ -0,0 +1,80 @@
+import re
+import json
+from collections import namedtuple
+
+# A prediction task: the function calling the model and the integer fields parsed from its answer.
+# `fields` maps each key of the model's JSON answer to (output column, lowest class, highest class).
+# `resolve(filename)` may answer from local data instead, returning (values, provenance) or None, and
+# `source` names the output column recording where the values came from.
+PredictionTask = namedtuple("PredictionTask", ["predict", "fields", "resolve", "source"], defaults=(None, None))
+
+# Provenance of values answered by the model
+MODEL_SOURCE = "model"
+
+class MalformedPrediction(ValueError):
+    """Raised when a model answer cannot be parsed into valid class values."""
+
+# Extract the building id from an image filename, e.g. '1065043374.jpg' or 'mapbox_image_1065043374_house.png'
+def filename_to_id(filename):
+    match = re.search(r"\d+", filename)
+    if match is None:
+        raise ValueError(f"No building id in filename: {filename}")
+    return int(match.group(0))
+
+def json_instruction(fields):
+    """Return the output instruction appended to a system prompt for the given fields."""
+    keys = ", ".join(f'"{key}": <{key}>' for key in fields)
+    return f"Output a JSON object {{{keys}}} with integer values only."
+
+def _coerce_int(key, value):
+    if isinstance(value, bool):
+        raise MalformedPrediction(f"{key} is not an integer: {value!r}")
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str):
+        match = re.fullmatch(r"\s*(-?\d+)\.?\s*", value)
+        if match:
+            return int(match.group(1))
+    raise MalformedPrediction(f"{key} is not an integer: {value!r}")
+
+def parse_prediction(response, fields):
+    """
+    Parses and validates a model answer into typed class values.
+
+    The JSON object requested in the prompt is preferred; answers in the legacy
+    'Filename: <filename>, Key: <value>' text format the fine-tuned models were trained on
+    are accepted as a fallback.
+
+    Parameters:
+        response (str): Raw message content returned by the model.
+        fields (dict): Answer key -> (output column, lowest class, highest class).
+
+    Returns:
+        dict: Output column -> integer class.
+
+    Raises:
+        MalformedPrediction: If a field is missing, not an integer or out of range.
+    """
+    answer = None
+    try:
+        answer = json.loads(response)
+    except (TypeError, ValueError):
+        pass
+
+    values = {}
+    for key, (column, lowest, highest) in fields.items():
+        if isinstance(answer, dict):
+            if key not in answer:
+                raise MalformedPrediction(f"Missing {key} in {response!r}")
+            value = _coerce_int(key, answer[key])
+        else:
+            match = re.search(rf"\b{re.escape(key)}\s*:\s*(-?\d+)", response or "")
+            if match is None:
+                raise MalformedPrediction(f"Missing {key} in {response!r}")
+            value = int(match.group(1))
+        if not lowest <= value <= highest:
+            raise MalformedPrediction(f"{key} out of range [{lowest}, {highest}]: {value}")
+        values[column] = value
+    return values
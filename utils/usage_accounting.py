@@ -0,0 +1,171 @@
+import json
+import time
+import bisect
+import threading
+
+# Upper bounds (seconds) of the latency histogram buckets: 10% steps from 50 ms to about 10 minutes,
+# so percentiles read from the histogram are within 10% of the exact value
+LATENCY_BUCKETS = [round(0.05 * 1.1 ** i, 3) for i in range(100)] + [float("inf")]
+
+# Return (prompt, completion) USD per 1M tokens of the longest model prefix listed in the pricing table
+def price_for(model, pricing):
+    matches = [prefix for prefix in pricing if model.startswith(prefix)]
+    if not matches:
+        return None
+    price = pricing[max(matches, key=len)]
+    return price["prompt_per_1m"], price["completion_per_1m"]
+
+# Show only the end of an API key in logs and reports
+def mask_key(api_key):
+    return "..." + api_key[-4:]
+
+class UsageSummary:
+    """Token, cost and latency totals of one stage and model."""
+
+    def __init__(self):
+        self.calls = 0
+        self.outcomes = {}
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+        self.priced = True
+        # Latencies are bucketed rather than kept, so a long run holds constant memory
+        self.latency_histogram = [0] * len(LATENCY_BUCKETS)
+        self.latency_seconds = 0.0
+        self.max_latency = 0.0
+
+    def add(self, record, pricing):
+        self.calls += 1
+        self.outcomes[record["outcome"]] = self.outcomes.get(record["outcome"], 0) + 1
+        self.prompt_tokens += record["prompt_tokens"]
+        self.completion_tokens += record["completion_tokens"]
+        latency = record["latency"]
+        self.latency_histogram[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+        self.latency_seconds += latency
+        self.max_latency = max(self.max_latency, latency)
+        price = price_for(record["model"], pricing)
+        if price is None:
+            self.priced = False
+        else:
+            self.cost += (record["prompt_tokens"] * price[0] + record["completion_tokens"] * price[1]) / 1e6
+
+    def percentile(self, percentile):
+        """Upper bound of the histogram bucket holding the given latency percentile, capped at the slowest call."""
+        rank = min(self.calls - 1, int(self.calls * percentile / 100))
+        seen = 0
+        for upper, count in zip(LATENCY_BUCKETS, self.latency_histogram):
+            seen += count
+            if seen > rank:
+                return min(upper, self.max_latency)
+        return 0.0
+
+def summarize(records, pricing):
+    """
+    Rolls call records up by stage and model.
+
+    Returns:
+        tuple: ({(stage, model): UsageSummary}, {masked key: calls}).
+    """
+    summaries = {}
+    keys = {}
+    for record in records:
+        add_record(record, pricing, summaries, keys)
+    return summaries, keys
+
+def add_record(record, pricing, summaries, keys):
+    summaries.setdefault((record["stage"], record["model"]), UsageSummary()).add(record, pricing)
+    keys[record["key"]] = keys.get(record["key"], 0) + 1
+
+def format_usage(summaries, keys, buildings):
+    """
+    Formats a usage report, slowest models first.
+
+    Parameters:
+        summaries (dict): (stage, model) -> UsageSummary.
+        keys (dict): Masked API key -> number of calls.
+        buildings (dict): Stage -> number of buildings annotated, for the projected cost per 1,000 buildings.
+    """
+    lines = []
+    stage_costs = {}
+    unpriced = set()
+    ranked = sorted(summaries.items(), key=lambda item: item[1].latency_seconds, reverse=True)
+    for (stage, model), summary in ranked:
+        outcomes = ", ".join(f"{outcome}: {count}" for outcome, count in sorted(summary.outcomes.items()))
+        cost = f"${summary.cost:.4f}" if summary.priced else "no price"
+        lines.append(f"[{stage}] {model}: {summary.calls} calls ({outcomes}), "
+                     f"{summary.prompt_tokens} prompt + {summary.completion_tokens} completion tokens, {cost}")
+        per_building = ""
+        if summary.priced and buildings.get(stage):
+            per_building = f", ${summary.cost / buildings[stage] * 1000:.2f} per 1,000 buildings"
+        lines.append(f"  latency p50 {summary.percentile(50):.2f}s, p99 {summary.percentile(99):.2f}s, "
+                     f"{summary.latency_seconds:.0f} call-seconds{per_building}")
+        stage_costs[stage] = stage_costs.get(stage, 0.0) + summary.cost
+        if not summary.priced:
+            unpriced.add(stage)
+
+    for stage, cost in sorted(stage_costs.items()):
+        count = buildings.get(stage)
+        projected = f", ${cost / count * 1000:.2f} per 1,000 buildings" if count else ""
+        if stage in unpriced:
+            projected += " (some models have no price)"
+        lines.append(f"Stage {stage}: ${cost:.4f} for {count or 0} buildings{projected}")
+    if len(stage_costs) > 1:
+        # Every building goes through every stage, so the projections add up
+        per_thousand = [cost / buildings[stage] * 1000 for stage, cost in stage_costs.items() if buildings.get(stage)]
+        projected = f", ${sum(per_thousand):.2f} per 1,000 buildings across stages" if per_thousand else ""
+        lines.append(f"Total: ${sum(stage_costs.values()):.4f}{projected}")
+    lines.append("Calls per API key: " + ", ".join(f"{key}: {count}" for key, count in sorted(keys.items())))
+    return "\n".join(lines)
+
+class UsageLedger:
+    """
+    Thread-safe record of every model call: tokens, latency, outcome and API key used.
+
+    Calls are appended to a JSONL log when one is opened, and rolled up in memory for the end-of-run report.
+
+    Parameters:
+        pricing (dict): Model prefix -> {"prompt_per_1m": USD, "completion_per_1m": USD}.
+    """
+
+    def __init__(self, pricing=None):
+        self.pricing = pricing or {}
+        self.stage = None
+        self.log = None
+        self.summaries = {}
+        self.keys = {}
+        self.lock = threading.Lock()
+
+    def open_log(self, path, stage):
+        """Append the calls of this run to `path`, tagged with `stage`."""
+        with self.lock:
+            self.stage = stage
+            self.log = open(path, 'a')
+
+    def record(self, model, api_key, outcome, latency, usage=None, hedge=False):
+        usage = usage or {}
+        record = {
+            "time": round(time.time(), 3),
+            "stage": self.stage,
+            "model": model,
+            "key": mask_key(api_key),
+            "outcome": outcome,
+            "hedge": hedge,
+            "latency": round(latency, 3),
+            "prompt_tokens": usage.get("prompt_tokens", 0),
+            "completion_tokens": usage.get("completion_tokens", 0)
+        }
+        with self.lock:
+            add_record(record, self.pricing, self.summaries, self.keys)
+            if self.log is not None:
+                self.log.write(json.dumps(record) + "\n")
+
+    def close(self):
+        with self.lock:
+            if self.log is not None:
+                self.log.close()
+                self.log = None
+
+    def report(self, buildings):
+        """Return the usage report of the calls recorded so far, for `buildings` annotated in this run."""
+        with self.lock:
+            return format_usage(self.summaries, self.keys, {self.stage: buildings})
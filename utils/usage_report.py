@@ -0,0 +1,56 @@
+import os
+import json
+import argparse
+from usage_accounting import summarize, format_usage
+
+# Annotation stages, named after their output files
+STAGES = ["svi", "house", "neighbor"]
+
+def read_jsonl(path):
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+def usage_report(base_file, config_path="config.json"):
+    """
+    Rolls up the call logs of every annotation stage of a city into one report.
+
+    Parameters:
+        base_file (str): Base data file, e.g. Data/NewYork_United States_100.jsonl.
+        config_path (str): Configuration file holding MODEL_PRICING.
+
+    Returns:
+        str: Tokens, cost and latency by stage and model, with the projected cost per 1,000 buildings.
+    """
+    with open(config_path, 'r') as file:
+        pricing = json.load(file).get("MODEL_PRICING", {})
+
+    base_name = os.path.splitext(os.path.basename(base_file))[0]
+    output_dir = os.path.join("output", base_name)
+
+    records = []
+    buildings = {}
+    for stage in STAGES:
+        usage_file = os.path.join(output_dir, f"{base_name}_{stage}_usage.jsonl")
+        output_file = os.path.join(output_dir, f"{base_name}_{stage}.jsonl")
+        # In neighborhood cell mode the neighbour stage runs on cell images, while its output covers every building
+        cells_usage_file = os.path.join(output_dir, "cells", f"{base_name}_cells_{stage}_usage.jsonl")
+        if not os.path.exists(usage_file) and os.path.exists(cells_usage_file):
+            usage_file = cells_usage_file
+        if not os.path.exists(usage_file):
+            print(f"No usage log for stage {stage}: {usage_file}")
+            continue
+        records.extend(read_jsonl(usage_file))
+        if os.path.exists(output_file):
+            buildings[stage] = sum(1 for _ in read_jsonl(output_file))
+
+    summaries, keys = summarize(records, pricing)
+    return format_usage(summaries, keys, buildings)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report tokens, cost and latency of the annotation stages of a city.")
+    parser.add_argument("--base_file", required=True, help="Base data file, e.g. Data/NewYork_United States_100.jsonl.")
+    args = parser.parse_args()
+
+    print(usage_report(args.base_file))